@@ -14,8 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import hashlib
+import json
 import os
+import random
+import sqlite3
 import sys
+import threading
+import time
+import weakref
+
+import caching
+import schema
 
 try:
   import google.generativeai as genai
@@ -30,20 +41,292 @@ except:
 
 try:
   import mistralai
-  from mistralai import client as mistral_client
+  from mistralai import async_client as mistral_async_client
 except:
   pass
 
+
+class TokenBucket:
+  """Rate limiter allowing bursts of up to capacity requests."""
+
+  def __init__(self, requests_per_minute, capacity=None):
+    self.rate = requests_per_minute / 60.0
+    self.capacity = capacity or max(1, requests_per_minute // 10)
+    self.tokens = self.capacity
+    self.updated_at = time.monotonic()
+    self.lock = threading.Lock()
+
+  async def Take(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      await asyncio.sleep(wait)
+
+
+class ConcurrencyLimit:
+  """Limit of concurrent calls on each event loop.
+
+  Asyncio semaphores are bound to the loop they are used on, so there is one
+  per loop. Synchronous calls all run on the background loop and share one.
+  """
+
+  def __init__(self, max_concurrency):
+    self.max_concurrency = max_concurrency
+    self.semaphores = weakref.WeakKeyDictionary()
+    self.lock = threading.Lock()
+
+  def Semaphore(self):
+    with self.lock:
+      loop = asyncio.get_running_loop()
+      if loop not in self.semaphores:
+        self.semaphores[loop] = asyncio.BoundedSemaphore(self.max_concurrency)
+      return self.semaphores[loop]
+
+  async def __aenter__(self):
+    await self.Semaphore().acquire()
+
+  async def __aexit__(self, *unused_exc_info):
+    self.Semaphore().release()
+
+
+def IsRateLimitError(exception):
+  status = (getattr(exception, 'status_code', None) or
+            getattr(exception, 'code', None))
+  if status == 429:
+    return True
+  if type(exception).__name__ in ('ResourceExhausted', 'RateLimitError',
+                                  'TooManyRequests'):
+    return True
+  message = str(exception).lower()
+  return any(s in message for s in ('429', 'quota', 'rate limit',
+                                    'resource exhausted'))
+
+
+def RetryAfter(exception):
+  """Delay requested by the server in seconds, if any."""
+  headers = getattr(getattr(exception, 'response', None), 'headers', None) or {}
+  try:
+    return float(headers.get('retry-after'))
+  except (TypeError, ValueError):
+    return None
+
+
+background_loop = None
+background_loop_lock = threading.Lock()
+
+
+def BackgroundLoop():
+  """Event loop running synchronous calls, so that clients outlive calls."""
+  global background_loop
+  with background_loop_lock:
+    if background_loop is None:
+      background_loop = asyncio.new_event_loop()
+      threading.Thread(target=background_loop.run_forever,
+                       name='LogicLM AI', daemon=True).start()
+    return background_loop
+
+
+def RunSync(coroutine):
+  return asyncio.run_coroutine_threadsafe(coroutine, BackgroundLoop()).result()
+
+
+class ResponseCache:
+  """On-disk cache of model responses, keyed by hash of the whole request.
+
+  Least recently used responses are removed once total size of responses
+  exceeds max_bytes.
+  """
+
+  def __init__(self, filename, max_bytes=256 * 1024 * 1024):
+    self.filename = filename
+    self.max_bytes = max_bytes
+    directory = os.path.dirname(filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.connection = sqlite3.connect(filename, timeout=30,
+                                      check_same_thread=False)
+    self.connection.execute(
+      'CREATE TABLE IF NOT EXISTS responses ('
+      'key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_used REAL)')
+    self.connection.execute(
+      'CREATE INDEX IF NOT EXISTS responses_last_used '
+      'ON responses (last_used)')
+    self.connection.commit()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  @classmethod
+  def Key(cls, backend, model_name, generation_config, prompt):
+    request = json.dumps([backend, model_name, generation_config, prompt],
+                         sort_keys=True)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+  def Lookup(self, key):
+    with self.lock:
+      row = self.connection.execute(
+        'SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.connection.execute(
+        'UPDATE responses SET last_used = ? WHERE key = ?',
+        (time.time(), key))
+      self.connection.commit()
+      return row[0]
+
+  def Store(self, key, response):
+    size = len(response.encode())
+    with self.lock:
+      self.connection.execute(
+        'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+        (key, response, size, time.time()))
+      total, = self.connection.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+      while total > self.max_bytes:
+        key_to_remove, size_to_remove = self.connection.execute(
+          'SELECT key, size FROM responses ORDER BY last_used LIMIT 1'
+        ).fetchone()
+        self.connection.execute('DELETE FROM responses WHERE key = ?',
+                                (key_to_remove,))
+        total -= size_to_remove
+      self.connection.commit()
+
+  def Stats(self):
+    with self.lock:
+      size, total = self.connection.execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+    return {'size': size, 'bytes': total, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def GetResponseCache():
+  """Cache at path given by LOGICLM_LLM_CACHE, None if it is not set."""
+  global response_cache
+  filename = os.getenv('LOGICLM_LLM_CACHE')
+  if not filename:
+    return None
+  with response_cache_lock:
+    if response_cache is None or response_cache.filename != filename:
+      response_cache = ResponseCache(
+        filename,
+        int(os.getenv('LOGICLM_LLM_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+    return response_cache
+
+
 class AI:
+  # Model and generation config used by Generate by default.
+  model_name = None
+  generation_config = {}
+  # Prompts longer than this are rejected before calling the model.
+  max_prompt_tokens = None
+  # Limits are shared by all instances of a backend.
+  requests_per_minute = 60
+  max_concurrency = 4
+  max_retries = 6
+  initial_backoff_seconds = 1.0
+  max_backoff_seconds = 60.0
+  limits = {}
+  limits_lock = threading.Lock()
+  # Clients are bound to the event loop they are used on, so they are
+  # registered per loop. Synchronous calls all run on the background loop.
+  clients = weakref.WeakKeyDictionary()
+  clients_lock = threading.Lock()
+
   def __init__(self, api_key=None):
     self.api_key = api_key
 
   def SetAPIKey(self, api_key):
     self.api_key = api_key
 
-  def __call__(self, prompt):
+  async def Generate(self, prompt, model_name=None, generation_config=None):
+    """Raw response of the model to the prompt."""
     raise NotImplementedError
 
+  async def CachedGenerate(self, prompt, model_name=None,
+                           generation_config=None):
+    """Generate, answered from the response cache when it is enabled."""
+    cache = GetResponseCache()
+    if cache is None:
+      return await self.WithLimits(self.Generate, prompt,
+                                   model_name, generation_config)
+    key = ResponseCache.Key(type(self).__name__,
+                            model_name or self.model_name,
+                            generation_config or self.generation_config,
+                            prompt)
+    # Cache is a file, so it is read and written off the event loop.
+    response = await asyncio.to_thread(cache.Lookup, key)
+    if response is None:
+      if not self.api_key:
+        raise ValueError('Response of %s is not cached and no API key is '
+                         'set to generate it.' % type(self).__name__)
+      response = await self.WithLimits(self.Generate, prompt,
+                                       model_name, generation_config)
+      # Models may return no content, e.g. when the response was blocked.
+      if response is not None:
+        await asyncio.to_thread(cache.Store, key, response)
+    return response
+
+  async def AsyncCall(self, prompt):
+    return self.CutOffChatter(await self.CachedGenerate(prompt))
+
+  def __call__(self, prompt):
+    return RunSync(self.AsyncCall(prompt))
+
+  @classmethod
+  def Limits(cls):
+    with cls.limits_lock:
+      if cls not in cls.limits:
+        cls.limits[cls] = (TokenBucket(cls.requests_per_minute),
+                           ConcurrencyLimit(cls.max_concurrency))
+      return cls.limits[cls]
+
+  def Client(self, model_name, factory):
+    """Client or model made by factory, created once per API key and model."""
+    key = (type(self).__name__, self.api_key, model_name)
+    with AI.clients_lock:
+      loop_clients = AI.clients.setdefault(asyncio.get_running_loop(), {})
+      if key not in loop_clients:
+        loop_clients[key] = factory()
+      return loop_clients[key]
+
+  async def WithLimits(self, function, *args, **kwargs):
+    """Awaits function respecting limits, backing off on rate limit errors."""
+    bucket, concurrency_limit = self.Limits()
+    delay = self.initial_backoff_seconds
+    for attempt in range(self.max_retries + 1):
+      await bucket.Take()
+      async with concurrency_limit:
+        try:
+          return await function(*args, **kwargs)
+        except Exception as e:
+          if not IsRateLimitError(e) or attempt == self.max_retries:
+            raise
+          backoff = RetryAfter(e) or delay * (1 + random.random() / 2)
+      print('Rate limited by %s, retrying in %.1fs.' % (
+          type(self).__name__, backoff), file=sys.stderr)
+      await asyncio.sleep(backoff)
+      delay = min(delay * 2, self.max_backoff_seconds)
+
+  def CheckPromptSize(self, prompt_template, user_request):
+    tokens = prompt_template.ApproximateTokens(user_request)
+    if self.max_prompt_tokens and tokens > self.max_prompt_tokens:
+      raise ValueError('Prompt of about %d tokens exceeds %d tokens allowed '
+                       'by %s.' % (tokens, self.max_prompt_tokens,
+                                   type(self).__name__))
+
   def InitFromSystemVariable(self):
     key = self.SystemAPIKey()
     assert key, 'Can not initialize %s as system does not have a key.' % self
@@ -59,6 +342,17 @@ class AI:
     yield OpenAI
     yield MistralAI
 
+  @classmethod
+  def CachedOption(cls):
+    """Backend of cached responses, named by LOGICLM_LLM_CACHE_BACKEND."""
+    options = list(cls.Options())
+    name = os.getenv('LOGICLM_LLM_CACHE_BACKEND', options[0].__name__)
+    for option in options:
+      if option.__name__ == name:
+        return option
+    raise ValueError('Unknown LOGICLM_LLM_CACHE_BACKEND %s, expected one '
+                     'of: %s' % (name, [o.__name__ for o in options]))
+
   @classmethod
   def Get(cls):
     system_vars = []
@@ -67,8 +361,11 @@ class AI:
       system_vars.append(option.api_key_system_variable)
       if key:
         return option(key)
+    if GetResponseCache() is not None:
+      # Without a key only responses that are already cached can be used.
+      return cls.CachedOption()()
     assert False, 'Can not initialize AI. None of the AI API keys were set: %s' % system_vars
-  
+
   def CutOffChatter(self, response):
     useful_start = response.index('{')
     useful_end = response.rfind('}') + 1
@@ -81,102 +378,119 @@ class AI:
 
 
 class GoogleGenAI(AI):
-    configured_api_key = None
-    api_key_system_variable = 'LOGICLM_GOOGLE_GENAI_API_KEY'
-    chat=None
-    def __call__(self, prompt):
-        self.api_key = os.environ.get(self.api_key_system_variable)
-        if not self.api_key:
-            raise ValueError(
-                f"Google GenAI API key not found in environment variable: {self.api_key_system_variable}"
-            )
-        if self.configured_api_key != self.api_key:
-            genai.configure(api_key=self.api_key)
-            self.configured_api_key = self.api_key
-        model = genai.GenerativeModel(model_name='gemini-2.0-flash')  # Try accessing GenerativeModel directly
-        try:
-          content = model.generate_content(
-            prompt,
-            generation_config=dict(
-              max_output_tokens=512,
-              temperature=0.2
-            ))
-          return self.CutOffChatter(content.text)
-          #return content.text
-        except Exception as e:
-          print(f"An error occurred: {e}")
-    
-    def CreateLogicProgram(self, prompt):
-      self.api_key = os.environ.get(self.api_key_system_variable)
-      if not self.api_key:
-          raise ValueError(
-              f"Google GenAI API key not found in environment variable: {self.api_key_system_variable}"
-          )
-      if self.configured_api_key != self.api_key:
-          genai.configure(api_key=self.api_key)
-          self.configured_api_key = self.api_key
-      model = genai.GenerativeModel(model_name='gemini-2.5-pro-preview-03-25')  # Try accessing GenerativeModel directly
-      try:
-        content = model.generate_content(
-          prompt,
-          generation_config=dict(
-            max_output_tokens=3000,
-            temperature=0.2
-          ))
-        return content.text
-      except Exception as e:
-        print(f"An error occurred: {e}")
-
-    def CreateNewChat(self):
-      self.api_key = os.environ.get(self.api_key_system_variable)
-      if self.configured_api_key != self.api_key:
-            genai.configure(api_key=self.api_key)
-            self.configured_api_key = self.api_key
-      model = genai.GenerativeModel(model_name='gemini-2.5-pro-preview-03-25')
-      self.chat=model.start_chat()
-    def sendPrompt(self,prompt,max_output_tokens=3000):
-      response=self.chat.send_message(prompt,generation_config=dict(
-              max_output_tokens=max_output_tokens,
-              temperature=1
-            ))
-      return response.text
-   
-     
+  configured_api_key = None
+  api_key_system_variable = 'LOGICLM_GOOGLE_GENAI_API_KEY'
+  model_name = 'gemini-2.0-flash'
+  max_prompt_tokens = 1000000
+  generation_config = dict(max_output_tokens=512, temperature=0.2)
+  logic_program_model_name = 'gemini-2.5-pro-preview-03-25'
+  logic_program_generation_config = dict(max_output_tokens=3000,
+                                         temperature=0.2)
+  chat=None
+
+  def Configure(self):
+    self.api_key = os.environ.get(self.api_key_system_variable)
+    if not self.api_key:
+      raise ValueError(
+          f"Google GenAI API key not found in environment variable: {self.api_key_system_variable}"
+      )
+    if self.configured_api_key != self.api_key:
+      genai.configure(api_key=self.api_key)
+      self.configured_api_key = self.api_key
+
+  async def Generate(self, prompt, model_name=None, generation_config=None):
+    self.Configure()
+    model_name = model_name or self.model_name
+    model = self.Client(
+      model_name, lambda: genai.GenerativeModel(model_name=model_name))
+    content = await model.generate_content_async(
+      prompt,
+      generation_config=generation_config or self.generation_config)
+    return content.text
+
+  async def AsyncCall(self, prompt):
+    try:
+      return await super().AsyncCall(prompt)
+    except Exception as e:
+      print(f"An error occurred: {e}")
+
+  async def AsyncCreateLogicProgram(self, prompt):
+    try:
+      return await self.CachedGenerate(
+        prompt,
+        model_name=self.logic_program_model_name,
+        generation_config=self.logic_program_generation_config)
+    except Exception as e:
+      print(f"An error occurred: {e}")
+
+  def CreateLogicProgram(self, prompt):
+    return RunSync(self.AsyncCreateLogicProgram(prompt))
+
+  def CreateNewChat(self):
+    self.Configure()
+    model = genai.GenerativeModel(model_name=self.logic_program_model_name)
+    self.chat=model.start_chat()
+
+  async def AsyncSendPrompt(self, prompt, max_output_tokens=3000):
+    response = await self.WithLimits(
+      self.chat.send_message_async, prompt,
+      generation_config=dict(
+        max_output_tokens=max_output_tokens,
+        temperature=1
+      ))
+    return response.text
+
+  def sendPrompt(self,prompt,max_output_tokens=3000):
+    return RunSync(self.AsyncSendPrompt(prompt, max_output_tokens))
 
 
 class OpenAI(AI):
   configured_api_key = None
   api_key_system_variable = 'LOGICLM_OPENAI_API_KEY'
+  model_name = 'gpt-4o'
+  max_prompt_tokens = 128000
+  generation_config = dict(temperature=1,
+                           max_tokens=512,
+                           top_p=1,
+                           frequency_penalty=0,
+                           presence_penalty=0)
   
-  def __call__(self, prompt):
-    client = openai.OpenAI(api_key=self.api_key)
-    response = client.chat.completions.create(
-      model="gpt-4o",
+  async def Generate(self, prompt, model_name=None, generation_config=None):
+    model_name = model_name or self.model_name
+    client = self.Client(
+      model_name, lambda: openai.AsyncOpenAI(api_key=self.api_key))
+    response = await client.chat.completions.create(
+      model=model_name,
       messages=[
         {
           "role": "user",
           "content": prompt
         }
       ],
-      temperature=1,
-      max_tokens=512,
-      top_p=1,
-      frequency_penalty=0,
-      presence_penalty=0
+      **(generation_config or self.generation_config)
     )
-    return self.CutOffChatter(response.choices[0].message.content)
+    return response.choices[0].message.content
 
 class MistralAI(AI):
   configuration_api_key = None
   api_key_system_variable = 'LOGICLM_MISTRALAI_API_KEY'
+  model_name = 'mistral-medium'
+  max_prompt_tokens = 32000
 
-  def __call__(self, prompt):
-    client = mistral_client.MistralClient(api_key=self.api_key)
+  async def Generate(self, prompt, model_name=None, generation_config=None):
+    model_name = model_name or self.model_name
+    client = self.Client(
+      model_name,
+      lambda: mistral_async_client.MistralAsyncClient(api_key=self.api_key))
     message = mistralai.models.chat_completion.ChatMessage(
       role="user", content=prompt)
-    chat_response = client.chat(model='mistral-medium',
-                                messages=[message])
-    result = self.CutOffChatter(chat_response.choices[0].message.content)
+    chat_response = await client.chat(model=model_name,
+                                      messages=[message],
+                                      **(generation_config or self.generation_config))
+    return chat_response.choices[0].message.content
+
+  async def AsyncCall(self, prompt):
+    result = await super().AsyncCall(prompt)
     result = result.replace('\\_', '_')
     return result
 
@@ -228,8 +542,48 @@ def GetPromptTemplate(config):
   return '\n'.join(result_lines)
 
 
+class PromptTemplate:
+  """Prompt template split around the user request placeholder."""
+
+  def __init__(self, template, placeholder='__USER_REQUEST__'):
+    self.template = template
+    self.prefix, self.suffix = template.split(placeholder, 1)
+
+  def Render(self, user_request):
+    return ''.join([self.prefix, user_request, self.suffix])
+
+  def Length(self, user_request=''):
+    return len(self.prefix) + len(user_request) + len(self.suffix)
+
+  def ApproximateTokens(self, user_request=''):
+    # Roughly 4 characters per token for English text.
+    return (self.Length(user_request) + 3) // 4
+
+  def __str__(self):
+    return self.template
+
+
+prompt_templates = caching.LruCache(64)
+
+
+def GetCompiledPromptTemplate(config):
+  """PromptTemplate of the config, built once per config.
+
+  Validated configs are frozen, so they are looked up by identity, without
+  serializing them. Other configs are looked up by content.
+  """
+  if isinstance(config, schema.ValidatedConfig):
+    # Cached entry holds the config, so its id is not reused meanwhile.
+    key = id(config)
+  else:
+    key = caching.Fingerprint(json.dumps(config, sort_keys=True, default=str))
+  entry = prompt_templates.Get(key)
+  if entry is None:
+    entry = (config, PromptTemplate(GetPromptTemplate(config)))
+    prompt_templates.Put(key, entry)
+  return entry[1]
+
+
 if __name__ == '__main__':
   ai = AI.Get()
   print(ai(sys.argv[1]))
-
-
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of the AI client layer: limits, retries, caches of responses and prompts."""
+
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import ai
+import schema
+
+
+class RateLimitError(Exception):
+  status_code = 429
+
+
+class FakeAI(ai.AI):
+  """Local backend for exercising the client layer without network.
+
+  Responder maps a prompt to a response, or raises to simulate failures.
+  """
+  api_key_system_variable = 'LOGICLM_FAKE_AI_API_KEY'
+  model_name = 'fake'
+
+  def __init__(self, responder, api_key='fake'):
+    super().__init__(api_key)
+    self.responder = responder
+    self.calls = 0
+
+  async def Generate(self, prompt, model_name=None, generation_config=None):
+    self.calls += 1
+    await asyncio.sleep(0)
+    return self.responder(prompt)
+
+
+class LimitedFakeAI(FakeAI):
+  requests_per_minute = 6000
+  max_concurrency = 2
+  initial_backoff_seconds = 0.001
+  max_retries = 2
+
+
+class FakeAITest(unittest.TestCase):
+
+  def setUp(self):
+    # Responses are not to be served from a cache of the environment.
+    environment = mock.patch.dict(os.environ, {'LOGICLM_LLM_CACHE': ''})
+    environment.start()
+    self.addCleanup(environment.stop)
+    # Each test gets its own limits.
+    ai.AI.limits.pop(LimitedFakeAI, None)
+
+  def testRunSyncCutsOffChatter(self):
+    fake = FakeAI(lambda prompt: 'Sure! {"prompt": "%s"} Bye.' % prompt)
+    self.assertEqual(fake('hi'), '{"prompt": "hi"}')
+    self.assertEqual(fake.calls, 1)
+
+  def testTokenBucketWaitsForTokens(self):
+    bucket = ai.TokenBucket(requests_per_minute=600, capacity=2)
+    async def TakeThree():
+      start = time.monotonic()
+      for _ in range(3):
+        await bucket.Take()
+      return time.monotonic() - start
+    # Two tokens are available at once, third comes after 0.1 seconds.
+    self.assertGreater(ai.RunSync(TakeThree()), 0.05)
+
+  def testConcurrencyLimit(self):
+    running = 0
+    max_running = 0
+    async def Call():
+      nonlocal running, max_running
+      running += 1
+      max_running = max(max_running, running)
+      await asyncio.sleep(0.01)
+      running -= 1
+    fake = LimitedFakeAI(None)
+    async def CallMany():
+      await asyncio.gather(*[fake.WithLimits(Call) for _ in range(8)])
+    ai.RunSync(CallMany())
+    self.assertEqual(max_running, 2)
+
+  def testRetriesRateLimitErrors(self):
+    failures = [RateLimitError('Too many requests'),
+                Exception('Quota exceeded')]
+    def Respond(prompt):
+      if failures:
+        raise failures.pop(0)
+      return '{}'
+    fake = LimitedFakeAI(Respond)
+    self.assertEqual(fake('hi'), '{}')
+    self.assertEqual(fake.calls, 3)
+
+  def testGivesUpAfterMaxRetries(self):
+    def Respond(prompt):
+      raise RateLimitError('Too many requests')
+    fake = LimitedFakeAI(Respond)
+    with self.assertRaises(RateLimitError):
+      fake('hi')
+    self.assertEqual(fake.calls, LimitedFakeAI.max_retries + 1)
+
+  def testDoesNotRetryOtherErrors(self):
+    def Respond(prompt):
+      raise ValueError('Broken prompt')
+    fake = LimitedFakeAI(Respond)
+    with self.assertRaises(ValueError):
+      fake('hi')
+    self.assertEqual(fake.calls, 1)
+
+  def testIsRateLimitError(self):
+    self.assertTrue(ai.IsRateLimitError(RateLimitError()))
+    self.assertTrue(ai.IsRateLimitError(Exception('429 Resource exhausted')))
+    self.assertFalse(ai.IsRateLimitError(ValueError('Broken prompt')))
+
+  def testRetryAfter(self):
+    error = RateLimitError()
+    error.response = mock.Mock(headers={'retry-after': '2.5'})
+    self.assertEqual(ai.RetryAfter(error), 2.5)
+    self.assertIsNone(ai.RetryAfter(RateLimitError()))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.filename = os.path.join(directory.name, 'responses.sqlite')
+    environment = mock.patch.dict(os.environ,
+                                  {'LOGICLM_LLM_CACHE': self.filename})
+    environment.start()
+    self.addCleanup(environment.stop)
+    self.fake = FakeAI(lambda prompt: '{"prompt": "%s"}' % prompt)
+
+  def Generate(self, prompt, model_name=None):
+    return ai.RunSync(self.fake.CachedGenerate(prompt, model_name))
+
+  def testAnswersRepeatedPromptFromCache(self):
+    self.assertEqual(self.Generate('hi'), '{"prompt": "hi"}')
+    self.assertEqual(self.Generate('hi'), '{"prompt": "hi"}')
+    self.assertEqual(self.fake.calls, 1)
+    self.Generate('bye')
+    self.assertEqual(self.fake.calls, 2)
+    self.assertEqual(ai.GetResponseCache().Stats()['hits'], 1)
+
+  def testMissesAfterModelChange(self):
+    self.Generate('hi')
+    self.Generate('hi', model_name='other')
+    self.assertEqual(self.fake.calls, 2)
+    self.Generate('hi', model_name='other')
+    self.assertEqual(self.fake.calls, 2)
+
+  def testIsDisabledByEmptyPath(self):
+    with mock.patch.dict(os.environ, {'LOGICLM_LLM_CACHE': ''}):
+      self.assertIsNone(ai.GetResponseCache())
+      self.Generate('hi')
+      self.Generate('hi')
+    self.assertEqual(self.fake.calls, 2)
+    self.assertFalse(os.path.exists(self.filename))
+
+  def testEvictsLeastRecentlyUsedAtSizeLimit(self):
+    cache = ai.ResponseCache(self.filename, max_bytes=10)
+    # Clock ticks on every call, so that last uses are ordered.
+    with mock.patch.object(ai.time, 'time', side_effect=itertools.count()):
+      cache.Store('a', 'aaaaa')
+      cache.Store('b', 'bbbbb')
+      self.assertEqual(cache.Lookup('a'), 'aaaaa')
+      cache.Store('c', 'ccccc')
+    self.assertEqual(cache.Lookup('a'), 'aaaaa')
+    self.assertIsNone(cache.Lookup('b'))
+    self.assertEqual(cache.Lookup('c'), 'ccccc')
+    self.assertEqual(cache.Stats()['bytes'], 10)
+
+
+class PromptTemplateTest(unittest.TestCase):
+
+  def testBuildsTemplateOncePerConfig(self):
+    with open('examples/car_1/car_1.json') as f:
+      config = json.load(f)
+    validated_config = schema.ValidatedConfig(config)
+    template = ai.GetCompiledPromptTemplate(validated_config)
+    self.assertIs(ai.GetCompiledPromptTemplate(validated_config), template)
+    self.assertIs(ai.GetCompiledPromptTemplate(config),
+                  ai.GetCompiledPromptTemplate(json.loads(json.dumps(config))))
+    self.assertEqual(str(ai.GetCompiledPromptTemplate(config)), str(template))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""LogicLM server on asyncio, serving the same routes as server.py.
+
+Connections are handled on a single event loop. LLM calls and report
+execution run on separate bounded thread pools, and requests that would
+queue beyond max_pending_requests are rejected with 503.
+"""
+
+import asyncio
+from concurrent import futures
+from http import HTTPStatus
+import json
+import threading
+import traceback
+from urllib import parse
+
+import columnar
+import server
+
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+
+class Overloaded(Exception):
+  pass
+
+
+class BoundedExecutor:
+  """Thread pool that rejects work when too much of it is waiting."""
+
+  def __init__(self, name, workers, max_pending):
+    self.name = name
+    self.workers = workers
+    self.max_pending = max_pending
+    self.executor = futures.ThreadPoolExecutor(workers,
+                                               thread_name_prefix=name)
+    self.pending = 0
+    self.rejected = 0
+    self.lock = threading.Lock()
+
+  async def Run(self, function, *args, may_reject=True):
+    """Runs function on the pool, raises Overloaded if the queue is full.
+
+    Work continuing an accepted request, e.g. reading the next chunk of a
+    streamed response, passes may_reject=False to be counted, but not
+    rejected.
+    """
+    with self.lock:
+      if may_reject and self.pending >= self.workers + self.max_pending:
+        self.rejected += 1
+        raise Overloaded(self.name)
+      self.pending += 1
+    try:
+      return await asyncio.get_running_loop().run_in_executor(
+          self.executor, function, *args)
+    finally:
+      with self.lock:
+        self.pending -= 1
+
+  def Stats(self):
+    with self.lock:
+      return {'workers': self.workers,
+              'max_pending': self.max_pending,
+              'pending': self.pending,
+              'rejected': self.rejected}
+
+  def Shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HttpRequest:
+  def __init__(self, method, path, version, headers, body):
+    self.method = method
+    self.url = parse.urlparse(path)
+    self.version = version
+    self.headers = headers
+    self.body = body
+
+  def KeepAlive(self):
+    connection = self.headers.get('Connection', '').lower()
+    if self.version == 'HTTP/1.0':
+      return connection == 'keep-alive'
+    return connection != 'close'
+
+
+class BadRequest(Exception):
+  def __init__(self, status):
+    super().__init__(status.phrase)
+    self.status = status
+
+
+async def ReadRequest(reader):
+  """Next request on the connection, None when client closed it."""
+  try:
+    head = await reader.readuntil(b'\r\n\r\n')
+  except asyncio.IncompleteReadError as e:
+    if e.partial.strip():
+      raise BadRequest(HTTPStatus.BAD_REQUEST)
+    return None
+  except asyncio.LimitOverrunError:
+    raise BadRequest(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+  lines = head.decode('latin-1').split('\r\n')
+  try:
+    method, path, version = lines[0].split(' ')
+  except ValueError:
+    raise BadRequest(HTTPStatus.BAD_REQUEST)
+  headers = {}
+  for line in lines[1:]:
+    if ':' in line:
+      name, value = line.split(':', 1)
+      headers[name.strip().title()] = value.strip()
+  body = b''
+  try:
+    content_length = int(headers.get('Content-Length', '0') or '0')
+  except ValueError:
+    raise BadRequest(HTTPStatus.BAD_REQUEST)
+  if content_length < 0:
+    raise BadRequest(HTTPStatus.BAD_REQUEST)
+  if content_length > MAX_BODY_BYTES:
+    raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+  if content_length:
+    body = await reader.readexactly(content_length)
+  return HttpRequest(method, path, version, headers, body)
+
+
+def ParseJsonBody(request):
+  """JSON of the request body, raises BadRequest if it is malformed."""
+  try:
+    return json.loads(request.body.decode('utf-8'))
+  except ValueError:
+    # UnicodeDecodeError and json.JSONDecodeError are both ValueError.
+    raise BadRequest(HTTPStatus.BAD_REQUEST)
+
+
+class AsyncLogicLMServer:
+  """Serves LogicLM heart of the config with asyncio.
+
+  Config fields llm_workers, sql_workers and max_pending_requests set sizes
+  of the thread pools and of their queues.
+  """
+
+  def __init__(self, config):
+    self.config = config
+    self.heart = server.LogicLMServerHeart(config)
+    max_pending = config.get('max_pending_requests', 64)
+    self.llm_executor = BoundedExecutor('llm', config.get('llm_workers', 8),
+                                        max_pending)
+    self.sql_executor = BoundedExecutor('sql', config.get('sql_workers', 4),
+                                        max_pending)
+
+  def Stats(self):
+    return self.heart.CacheStats() | {
+        'llm_executor': self.llm_executor.Stats(),
+        'sql_executor': self.sql_executor.Stats()}
+
+  async def HandleConnection(self, reader, writer):
+    try:
+      while True:
+        try:
+          request = await ReadRequest(reader)
+        except BadRequest as e:
+          await self.Send(writer, e.status, 'text/plain',
+                          e.status.phrase.encode(), keep_alive=False)
+          return
+        if request is None:
+          return
+        keep_alive = request.KeepAlive()
+        try:
+          keep_alive = await self.Route(request, writer) and keep_alive
+        except BadRequest as e:
+          # Body was read whole, so the connection can still be reused.
+          await self.Send(writer, e.status, 'text/plain',
+                          e.status.phrase.encode(), keep_alive=keep_alive)
+        except Overloaded as e:
+          print('Rejecting request, %s executor is full.' % e)
+          await self.Send(writer, HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain',
+                          b'Server is busy, please retry.',
+                          {'Retry-After': '1'}, keep_alive=keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+          raise
+        except Exception:
+          print(traceback.format_exc())
+          # Route may have sent part of a response, so the connection is not
+          # reused.
+          await self.Send(writer, HTTPStatus.INTERNAL_SERVER_ERROR,
+                          'text/plain', b'Internal server error.',
+                          keep_alive=False)
+          return
+        if not keep_alive:
+          return
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except Exception:
+      print(traceback.format_exc())
+    finally:
+      writer.close()
+
+  async def Route(self, request, writer):
+    """Responds to the request, returns whether connection can be reused."""
+    keep_alive = request.KeepAlive()
+    path = request.url.path
+    if request.method == 'POST' and path == '/understand_command':
+      user_request = request.body.decode('utf-8')
+      print('User request:', user_request)
+      json_request = await self.llm_executor.Run(
+          self.heart.NaturalLanguageToRequestJson, user_request)
+      print('LLM translation:', json.dumps(json_request, indent=' '))
+      await self.Send(writer, HTTPStatus.OK, 'text/plain',
+                      json.dumps(json_request).encode('utf8'),
+                      keep_alive=keep_alive)
+      return keep_alive
+    if request.method == 'POST' and path == '/execute_config':
+      json_request = ParseJsonBody(request)
+      if not isinstance(json_request, dict):
+        raise BadRequest(HTTPStatus.BAD_REQUEST)
+      print('JSON request:', json_request)
+      stream_format = server.StreamFormat(request.url, request.headers)
+      if stream_format:
+        pieces = await self.sql_executor.Run(
+            self.heart.ExecuteConfigStreamed, json_request, stream_format)
+        await self.SendChunked(writer, pieces,
+                               server.STREAM_CONTENT_TYPES[stream_format])
+        return False
+      result_format = columnar.ResultFormat(parse.parse_qs(request.url.query),
+                                            request.headers)
+      if result_format is None:
+        await self.Send(writer, HTTPStatus.NOT_ACCEPTABLE, 'text/plain',
+                        b'Unknown result format, or pyarrow is missing.',
+                        keep_alive=keep_alive)
+        return keep_alive
+      response = await self.sql_executor.Run(self.heart.ExecuteConfig,
+                                             json_request)
+      content_type, body = columnar.EncodeResponse(response, result_format)
+      await self.Send(writer, HTTPStatus.OK, content_type, body,
+                      keep_alive=keep_alive)
+      return keep_alive
+    if request.method == 'POST' and path == '/execute_batch':
+      json_requests = ParseJsonBody(request)
+      if not (isinstance(json_requests, list) and
+              all(isinstance(r, dict) for r in json_requests)):
+        raise BadRequest(HTTPStatus.BAD_REQUEST)
+      print('Batch of %d requests.' % len(json_requests))
+      loop = asyncio.get_running_loop()
+      def Submit(function, *args):
+        return asyncio.run_coroutine_threadsafe(
+            self.sql_executor.Run(function, *args), loop)
+      # Reports of the batch run on the SQL executor, each counted as a
+      # request, so the batch itself waits on a thread of its own.
+      responses = await asyncio.to_thread(self.heart.ExecuteBatch,
+                                          json_requests, Submit)
+      await self.Send(writer, HTTPStatus.OK, 'application/json',
+                      json.dumps({'results': responses}).encode('utf8'),
+                      keep_alive=keep_alive)
+      return keep_alive
+    if request.method == 'POST':
+      await self.Send(writer, HTTPStatus.NOT_FOUND, 'text/plain',
+                      b'Unknown path.', keep_alive=keep_alive)
+      return keep_alive
+    if path == '/cache_stats':
+      await self.Send(writer, HTTPStatus.OK, 'application/json',
+                      json.dumps(self.Stats()).encode('utf8'),
+                      keep_alive=keep_alive)
+    else:
+      name = 'logiclm.png' if path == '/logiclm.png' else 'index.html'
+      status, headers, body = self.heart.Asset(name).Response(request.headers)
+      await self.Send(writer, HTTPStatus(status), headers.pop('Content-Type'),
+                      body, headers, keep_alive=keep_alive)
+    return keep_alive
+
+  async def Send(self, writer, status, content_type, body, headers=None,
+                 keep_alive=True):
+    lines = ['HTTP/1.1 %d %s' % (status, status.phrase),
+             'Content-Type: %s' % content_type,
+             'Content-Length: %d' % len(body),
+             'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+    lines.extend('%s: %s' % header for header in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+  async def SendChunked(self, writer, pieces, content_type):
+    """Sends pieces with chunked encoding, reading them on sql executor.
+
+    Reading of chunks is counted as pending work of the executor, so that
+    streams reading slowly make the server reject new requests.
+    """
+    writer.write(('HTTP/1.1 200 OK\r\n'
+                  'Content-Type: %s\r\n'
+                  'Transfer-Encoding: chunked\r\n'
+                  'Connection: close\r\n\r\n' % content_type).encode('latin-1'))
+    try:
+      while True:
+        # Rows may be read from the database, so pieces are not read on the
+        # event loop. Slow clients hold a worker for the time of a chunk only.
+        chunk = await self.sql_executor.Run(NextChunk, pieces,
+                                            may_reject=False)
+        if not chunk:
+          break
+        writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+        await writer.drain()
+      writer.write(b'0\r\n\r\n')
+      await writer.drain()
+    finally:
+      await self.sql_executor.Run(pieces.close, may_reject=False)
+
+  async def Serve(self, port):
+    tcp_server = await asyncio.start_server(
+        self.HandleConnection, 'localhost', port, limit=MAX_HEADER_BYTES,
+        backlog=1024)
+    async with tcp_server:
+      await tcp_server.serve_forever()
+
+  def Shutdown(self):
+    self.llm_executor.Shutdown()
+    self.sql_executor.Shutdown()
+
+
+def NextChunk(pieces):
+  """Bytes of pieces up to server.STREAM_CHUNK_BYTES, empty at the end."""
+  chunk = []
+  size = 0
+  for piece in pieces:
+    chunk.append(piece.encode('utf8'))
+    size += len(chunk[-1])
+    if size >= server.STREAM_CHUNK_BYTES:
+      break
+  return b''.join(chunk)
+
+
+def StartServer(config):
+  async_server = AsyncLogicLMServer(config)
+  port = config.get('port', 1791)
+  print('Starting asynchronous LogicLM server for "%s" intelligence '
+        'configuration at port %d.' % (config['name'], port))
+  try:
+    asyncio.run(async_server.Serve(port))
+  except KeyboardInterrupt:
+    print('Server terminated with Ctrl-C')
+  finally:
+    async_server.Shutdown()
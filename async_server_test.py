@@ -0,0 +1,105 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of reading requests and of backpressure of the asyncio server."""
+
+import asyncio
+from http import HTTPStatus
+import json
+import threading
+import unittest
+from unittest import mock
+
+import ai
+import async_server
+
+
+def ReadRequest(data):
+  async def Read():
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return await async_server.ReadRequest(reader)
+  return asyncio.run(Read())
+
+
+class ReadRequestTest(unittest.TestCase):
+
+  def testReadsBody(self):
+    request = ReadRequest(b'POST /execute_config HTTP/1.1\r\n'
+                          b'Content-Length: 2\r\n\r\n{}')
+    self.assertEqual(request.method, 'POST')
+    self.assertEqual(request.url.path, '/execute_config')
+    self.assertEqual(request.body, b'{}')
+
+  def testRejectsMalformedContentLength(self):
+    for content_length in [b'two', b'-1', b'1.5']:
+      with self.assertRaises(async_server.BadRequest) as context:
+        ReadRequest(b'POST /execute_config HTTP/1.1\r\n'
+                    b'Content-Length: %s\r\n\r\n{}' % content_length)
+      self.assertEqual(context.exception.status, HTTPStatus.BAD_REQUEST)
+
+
+class BackpressureTest(unittest.TestCase):
+
+  def setUp(self):
+    with open('examples/car_1/car_1.json') as f:
+      config = json.load(f)
+    config |= {'sql_workers': 2, 'max_pending_requests': 0,
+               'fuse_requests': False}
+    with mock.patch.object(ai.AI, 'Get'):
+      self.server = async_server.AsyncLogicLMServer(config)
+    self.addCleanup(self.server.Shutdown)
+    self.release = threading.Event()
+    self.started = threading.Semaphore(0)
+    def ExecuteConfig(json_request):
+      self.started.release()
+      self.release.wait(10)
+      return json_request | {'data': []}
+    self.server.heart.ExecuteConfig = ExecuteConfig
+
+  async def Post(self, port, path, body):
+    reader, writer = await asyncio.open_connection('localhost', port)
+    body = json.dumps(body).encode()
+    writer.write(b'POST %s HTTP/1.1\r\nContent-Length: %d\r\n'
+                 b'Connection: close\r\n\r\n%s' % (path, len(body), body))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b' ')[1])
+
+  def testReportsOfBatchCountAgainstSqlWorkers(self):
+    async def Run():
+      tcp_server = await asyncio.start_server(self.server.HandleConnection,
+                                              'localhost', 0)
+      port = tcp_server.sockets[0].getsockname()[1]
+      requests = [{'measures': [m], 'dimensions': []}
+                  for m in ['NumCars()', 'AvgWeight()']]
+      batch = asyncio.create_task(self.Post(port, b'/execute_batch', requests))
+      # Both reports of the batch take a worker.
+      for _ in requests:
+        await asyncio.to_thread(self.started.acquire, timeout=10)
+      single_status = await self.Post(port, b'/execute_config', requests[0])
+      self.release.set()
+      batch_status = await batch
+      tcp_server.close()
+      return single_status, batch_status
+    self.assertEqual(asyncio.run(Run()),
+                     (HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.OK))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caches shared by LogicLM server and command line tools."""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+class LruCache:
+  """Bounded thread-safe least-recently-used cache with statistics."""
+
+  def __init__(self, max_size=256):
+    self.max_size = max_size
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def Get(self, key, default=None):
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return default
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return self.entries[key]
+
+  def Put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def Clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def Stats(self):
+    with self.lock:
+      return {'size': len(self.entries),
+              'max_size': self.max_size,
+              'hits': self.hits,
+              'misses': self.misses,
+              'evictions': self.evictions}
+
+
+def Fingerprint(s):
+  return hashlib.md5(str(s).encode()).hexdigest()
+
+
+# Maps filename to ((mtime_ns, size), content hash), so that unchanged files
+# are not reread on every request.
+file_hashes = {}
+file_hashes_lock = threading.Lock()
+
+
+def FileFingerprint(filename):
+  """Content hash of a file, recomputed only when its mtime or size change."""
+  stat = os.stat(filename)
+  stamp = (stat.st_mtime_ns, stat.st_size)
+  with file_hashes_lock:
+    known_stamp, content_hash = file_hashes.get(filename, (None, None))
+  if known_stamp == stamp:
+    return content_hash
+  with open(filename, 'rb') as f:
+    content_hash = hashlib.md5(f.read()).hexdigest()
+  with file_hashes_lock:
+    file_hashes[filename] = (stamp, content_hash)
+  return content_hash
+
+
+def ConfigFingerprint(config):
+  """Fingerprint of a config together with the Logica program it refers to."""
+  program_hash = ''
+  if 'logica_program' in config:
+    program_hash = FileFingerprint(config['logica_program'])
+  return Fingerprint(json.dumps(config, sort_keys=True, default=str) +
+                     program_hash)
+
+
+class PlanCache:
+  """Logica program and SQL compiled for requests.
+
+  Whole cache is invalidated when the config or its Logica program change.
+  """
+
+  def __init__(self, max_size=256):
+    self.plans = LruCache(max_size)
+    self.config_fingerprint = None
+    self.invalidations = 0
+    self.lock = threading.Lock()
+
+  def CheckConfig(self, config):
+    fingerprint = ConfigFingerprint(config)
+    with self.lock:
+      if fingerprint != self.config_fingerprint:
+        if self.config_fingerprint is not None:
+          self.invalidations += 1
+        self.plans.Clear()
+        self.config_fingerprint = fingerprint
+
+  def Get(self, config, request_key):
+    self.CheckConfig(config)
+    return self.plans.Get(request_key)
+
+  def Put(self, config, request_key, plan):
+    self.CheckConfig(config)
+    self.plans.Put(request_key, plan)
+
+  def Clear(self):
+    with self.lock:
+      self.invalidations += 1
+      self.plans.Clear()
+
+  def Stats(self):
+    return self.plans.Stats() | {'invalidations': self.invalidations}
+
+
+def DatabaseFingerprint(sql):
+  """Path, mtime and size of every database file attached by the SQL."""
+  result = []
+  for filename in sorted(set(re.findall(r"ATTACH DATABASE '([^']*)'", sql))):
+    try:
+      stat = os.stat(filename)
+      result.append((filename, stat.st_mtime_ns, stat.st_size))
+    except OSError:
+      result.append((filename, None, None))
+  return tuple(result)
+
+
+def HasDatabaseFingerprint(engine):
+  """Whether DatabaseFingerprint of SQL of the engine sees changes of data."""
+  # Only SQLite programs name the files they read in ATTACH statements.
+  return engine == 'sqlite'
+
+
+def ApproximateSize(data):
+  return sys.getsizeof(data) + sum(
+      sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in data)
+
+
+class ResultCache:
+  """Results of executed SQL with time-to-live and a memory budget.
+
+  Entries are keyed on SQL text and fingerprint of the attached database
+  files, so that rewriting a database makes its cached results unreachable.
+  Least recently used entries are evicted when the budget is exceeded.
+  """
+
+  def __init__(self, ttl_seconds=300, max_bytes=64 * 1024 * 1024):
+    self.ttl_seconds = ttl_seconds
+    self.max_bytes = max_bytes
+    self.entries = collections.OrderedDict()
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def Key(self, sql):
+    return (sql, DatabaseFingerprint(sql))
+
+  def Get(self, sql):
+    key = self.Key(sql)
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return None
+      expires_at, size, data = self.entries[key]
+      if expires_at < time.monotonic():
+        del self.entries[key]
+        self.bytes -= size
+        self.expirations += 1
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(key)
+    return [list(data[0])] + list(data[1:])
+
+  def Put(self, sql, data):
+    """Stores [header] + rows as tuples."""
+    data = tuple(map(tuple, data))
+    size = ApproximateSize(data)
+    if size > self.max_bytes:
+      return
+    key = self.Key(sql)
+    with self.lock:
+      if key in self.entries:
+        self.bytes -= self.entries.pop(key)[1]
+      self.entries[key] = (time.monotonic() + self.ttl_seconds, size, data)
+      self.bytes += size
+      while self.bytes > self.max_bytes:
+        unused_key, (unused_expires_at, evicted_size, unused_data) = (
+            self.entries.popitem(last=False))
+        self.bytes -= evicted_size
+        self.evictions += 1
+
+  def Clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.bytes = 0
+
+  def Stats(self):
+    with self.lock:
+      return {'size': len(self.entries),
+              'bytes': self.bytes,
+              'max_bytes': self.max_bytes,
+              'ttl_seconds': self.ttl_seconds,
+              'hits': self.hits,
+              'misses': self.misses,
+              'evictions': self.evictions,
+              'expirations': self.expirations}
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Column-oriented report data and its encodings.
+
+Report data, which reports return as rows, is transposed into a header and
+a list of values for each column when it is encoded. It is encoded as JSON
+{"columns": {<column>: [<values>]}}, which takes one list per column instead
+of one per row, or as Arrow IPC stream if pyarrow is installed. Repeated
+column names get suffixes _2, _3 and so on, so that no column is lost.
+"""
+
+import json
+
+try:
+  import pyarrow
+  from pyarrow import ipc
+except ImportError:
+  pyarrow = None
+
+
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Content types of responses to /execute_config in each result format.
+RESULT_CONTENT_TYPES = {
+  'rows': 'text/plain',
+  'columns': 'application/json',
+  'arrow': ARROW_CONTENT_TYPE
+}
+
+
+def UniqueNames(header):
+  """Names of the header with suffixes making repeated names distinct."""
+  result = []
+  for name in header:
+    unique_name = name
+    suffix = 1
+    while unique_name in result:
+      suffix += 1
+      unique_name = '%s_%d' % (name, suffix)
+    result.append(unique_name)
+  return result
+
+
+class ColumnarData:
+  def __init__(self, header, columns):
+    assert len(header) == len(columns), (header, len(columns))
+    self.header = UniqueNames(header)
+    self.columns = columns
+
+  @classmethod
+  def FromRows(cls, header, rows):
+    if not rows:
+      return cls(header, [[] for _ in header])
+    return cls(header, [list(column) for column in zip(*rows)])
+
+  @classmethod
+  def FromData(cls, data):
+    """From [header] + rows, as reports are returned by the server."""
+    return cls.FromRows(data[0], data[1:])
+
+  def AsJson(self):
+    return {'columns': dict(zip(self.header, self.columns))}
+
+  def AsArrow(self, metadata=None):
+    if pyarrow is None:
+      raise ImportError('Arrow encoding requires pyarrow.')
+    arrays = []
+    for column in self.columns:
+      try:
+        arrays.append(pyarrow.array(column))
+      except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        # Columns mixing types, e.g. numbers and strings, are sent as text.
+        arrays.append(pyarrow.array(
+            [None if v is None else str(v) for v in column],
+            type=pyarrow.string()))
+    table = pyarrow.Table.from_arrays(arrays, names=self.header)
+    if metadata:
+      table = table.replace_schema_metadata(metadata)
+    return table
+
+  def ArrowIpc(self, metadata=None):
+    """Bytes of Arrow IPC stream with the data."""
+    table = self.AsArrow(metadata)
+    sink = pyarrow.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema) as writer:
+      writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def EncodeResponse(response, result_format):
+  """Body of /execute_config response with data in the result format.
+
+  Arrow stream carries the rest of the response as JSON in schema metadata
+  under 'logiclm_response'. Responses without data, e.g. errors, are JSON.
+  Returns content type and body.
+  """
+  if result_format == 'rows' or 'data' not in response:
+    return (RESULT_CONTENT_TYPES['rows'],
+            json.dumps(response).encode('utf8'))
+  data = ColumnarData.FromData(response['data'])
+  if result_format == 'columns':
+    return (RESULT_CONTENT_TYPES['columns'],
+            json.dumps(response | {'data': data.AsJson()}).encode('utf8'))
+  assert result_format == 'arrow', result_format
+  rest = {k: v for k, v in response.items() if k != 'data'}
+  return (RESULT_CONTENT_TYPES['arrow'],
+          data.ArrowIpc({'logiclm_response': json.dumps(rest)}))
+
+
+def ResultFormat(url_query, headers):
+  """Result format asked by format parameter or Accept header, or None."""
+  result_format = url_query.get('format', [None])[0]
+  if result_format is None:
+    accept = headers.get('Accept', '')
+    if ARROW_CONTENT_TYPE in accept and pyarrow is not None:
+      return 'arrow'
+    return 'rows'
+  if result_format not in RESULT_CONTENT_TYPES:
+    return None
+  if result_format == 'arrow' and pyarrow is None:
+    return None
+  return result_format
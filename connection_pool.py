@@ -0,0 +1,205 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pool of warm SQLite connections extended with Logica functions."""
+
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import sqlite3_logica
+
+
+class ConnectionPool:
+  """Thread-safe pool of SQLite connections to a database.
+
+  At most max_size connections are open at a time, callers wait for a
+  connection to be released when all of them are in use, raising TimeoutError
+  after acquire_timeout_seconds if it is set. Connections idle for longer
+  than idle_seconds are closed. Bootstrap, e.g. applying the schema, is run
+  on the first connection only.
+  """
+
+  def __init__(self, database=':memory:', max_size=8, idle_seconds=300,
+               bootstrap=None, acquire_timeout_seconds=None):
+    self.database = database
+    self.max_size = max_size
+    self.idle_seconds = idle_seconds
+    self.acquire_timeout_seconds = acquire_timeout_seconds
+    self.bootstrap = bootstrap
+    self.bootstrapped = False
+    self.bootstrap_lock = threading.Lock()
+    # Pairs of connection and time when it was released.
+    self.idle_connections = []
+    self.size = 0
+    self.condition = threading.Condition()
+
+  def Connect(self):
+    connection = sqlite3.connect(self.database, check_same_thread=False)
+    sqlite3_logica.ExtendConnectionWithLogicaFunctions(connection)
+    with self.bootstrap_lock:
+      if self.bootstrap and not self.bootstrapped:
+        try:
+          self.bootstrap(connection)
+        except Exception:
+          connection.close()
+          raise
+        self.bootstrapped = True
+    return connection
+
+  def EvictIdle(self):
+    """Closes expired idle connections, must be called holding condition."""
+    deadline = time.monotonic() - self.idle_seconds
+    expired = [c for c, released in self.idle_connections if released < deadline]
+    self.idle_connections = [(c, released)
+                             for c, released in self.idle_connections
+                             if released >= deadline]
+    self.size -= len(expired)
+    for connection in expired:
+      connection.close()
+
+  def Acquire(self):
+    with self.condition:
+      self.EvictIdle()
+      if not self.condition.wait_for(
+          lambda: self.idle_connections or self.size < self.max_size,
+          self.acquire_timeout_seconds):
+        raise TimeoutError('All %d connections to %s are in use.' %
+                           (self.max_size, self.database))
+      if self.idle_connections:
+        return self.idle_connections.pop()[0]
+      self.size += 1
+    try:
+      return self.Connect()
+    except Exception:
+      self.Discard(None)
+      raise
+
+  def Release(self, connection):
+    with self.condition:
+      self.idle_connections.append((connection, time.monotonic()))
+      self.EvictIdle()
+      self.condition.notify()
+
+  def Discard(self, connection):
+    if connection is not None:
+      connection.close()
+    with self.condition:
+      self.size -= 1
+      self.condition.notify()
+
+  @contextlib.contextmanager
+  def Connection(self):
+    connection = self.Acquire()
+    try:
+      yield connection
+    except Exception:
+      # Connection may be left mid-transaction, so it is not reused.
+      self.Discard(connection)
+      raise
+    self.Release(connection)
+
+  def Close(self):
+    with self.condition:
+      connections = [c for c, unused_released in self.idle_connections]
+      self.idle_connections = []
+      self.size -= len(connections)
+    for connection in connections:
+      connection.close()
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def GetPool(database, bootstrap_key=None, **pool_args):
+  """Pool shared by all callers using the database with the same bootstrap.
+
+  Bootstrap is run by the first connection of a pool only, so callers
+  bootstrapping differently, e.g. applying another schema file, pass distinct
+  bootstrap_key and get distinct pools.
+  """
+  key = (database, bootstrap_key)
+  with pools_lock:
+    if key not in pools:
+      pools[key] = ConnectionPool(database, **pool_args)
+    return pools[key]
+
+
+def SplitSqlScript(script):
+  """Splits SQL script into complete statements."""
+  statements = []
+  current = ''
+  for piece in script.split(';'):
+    current += piece + ';'
+    if sqlite3.complete_statement(current):
+      if current.strip(' \n\t;'):
+        statements.append(current.strip())
+      current = ''
+  if current.strip(' \n\t;'):
+    statements.append(current.strip())
+  return statements
+
+
+def AttachedDatabases(connection):
+  """Maps name of each attached database to its file."""
+  return {name: filename for unused_seq, name, filename
+          in connection.execute('PRAGMA database_list')}
+
+
+def SameFile(attached_file, filename):
+  return (bool(attached_file) and
+          os.path.realpath(attached_file) == os.path.realpath(filename))
+
+
+def RunSqlScript(connection, sql):
+  """Runs SQL compiled by Logica, returning header and rows of the last statement."""
+  cursor = ExecuteSqlScript(connection, sql)
+  header = [d[0] for d in cursor.description]
+  rows = cursor.fetchall()
+  return header, rows
+
+
+def ExecuteSqlScript(connection, sql):
+  """Runs SQL compiled by Logica, returning cursor of the last statement.
+
+  Connections are reused, so databases attached by a previous script are
+  not attached again, unless the name now refers to another file. Files
+  that do not exist are not attached, as SQLite would create them empty.
+  """
+  statements = SplitSqlScript(sql)
+  assert statements, 'RunSqlScript requires non-empty SQL.'
+  attached = None
+  for statement in statements[:-1]:
+    attach = re.match(r"ATTACH DATABASE '([^']*)' AS (\w+)", statement)
+    if attach:
+      filename, name = attach.groups()
+      if filename not in ('', ':memory:') and not os.path.exists(filename):
+        raise sqlite3.OperationalError(
+            'Database file %s attached as %s does not exist.' %
+            (filename, name))
+      if attached is None:
+        attached = AttachedDatabases(connection)
+      if name in attached:
+        if SameFile(attached[name], filename):
+          continue
+        connection.execute('DETACH DATABASE %s' % name)
+      attached[name] = filename
+    connection.executescript(statement)
+  return connection.execute(statements[-1])
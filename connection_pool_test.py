@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of running Logica SQL scripts on pooled connections."""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import connection_pool
+
+
+class ExecuteSqlScriptTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.pool = connection_pool.ConnectionPool()
+
+  def tearDown(self):
+    self.pool.Close()
+    self.directory.cleanup()
+
+  def Run(self, sql):
+    with self.pool.Connection() as connection:
+      return connection_pool.RunSqlScript(connection, sql)
+
+  def testAttachesExistingFileOnce(self):
+    filename = os.path.join(self.directory.name, 'facts.db')
+    with sqlite3.connect(filename) as connection:
+      connection.execute('CREATE TABLE t (x)')
+      connection.execute('INSERT INTO t VALUES (1)')
+    sql = "ATTACH DATABASE '%s' AS facts;\nSELECT x FROM facts.t;" % filename
+    self.assertEqual(self.Run(sql), (['x'], [(1,)]))
+    # Connection is reused, so facts is attached already.
+    self.assertEqual(self.Run(sql), (['x'], [(1,)]))
+
+  def testDoesNotCreateMissingFile(self):
+    filename = os.path.join(self.directory.name, 'missing.db')
+    with self.assertRaisesRegex(sqlite3.OperationalError, 'does not exist'):
+      self.Run("ATTACH DATABASE '%s' AS missing;\nSELECT 1;" % filename)
+    self.assertFalse(os.path.exists(filename))
+
+
+if __name__ == '__main__':
+  unittest.main()
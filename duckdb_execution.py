@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Long-lived in-process DuckDB databases.
+
+Logica scripts for DuckDB detach and attach their databases on every run.
+Here databases stay attached, so attaching the same file under the same
+name again is skipped, and every script runs on its own cursor of the
+shared database. Queries in flight may read an attached database, so a name
+is never attached to another file of the same shared database.
+"""
+
+from concurrent import futures
+import re
+import threading
+
+import duckdb
+
+import connection_pool
+
+
+class DuckDbDatabase:
+  """DuckDB database shared by threads, each query runs on its own cursor."""
+
+  def __init__(self, database=':memory:', bootstrap=None):
+    self.connection = duckdb.connect(database)
+    # Maps name of attached database to its file.
+    self.attached = {}
+    self.lock = threading.Lock()
+    if bootstrap:
+      bootstrap(self)
+
+  def Cursor(self):
+    return self.connection.cursor()
+
+  def Attach(self, name, filename, options=''):
+    """Attaches the file unless it is already attached under the name."""
+    with self.lock:
+      if self.attached.get(name) == filename:
+        return
+      if name in self.attached:
+        # Detaching would break queries of other threads reading it.
+        raise duckdb.InvalidInputException(
+            'Database %s is attached to %s, can not attach it to %s.' %
+            (name, self.attached[name], filename))
+      self.connection.execute("ATTACH DATABASE '%s' AS %s%s" % (
+          filename, name, options))
+      self.attached[name] = filename
+
+  def Execute(self, sql):
+    """Runs SQL compiled by Logica, returning cursor of the last statement."""
+    statements = connection_pool.SplitSqlScript(sql)
+    assert statements, 'Execute requires non-empty SQL.'
+    cursor = self.Cursor()
+    try:
+      for statement in statements[:-1]:
+        if re.match(r'DETACH DATABASE IF EXISTS \w+', statement):
+          # Databases stay attached, see Attach below.
+          continue
+        attach = re.match(r"ATTACH DATABASE '([^']*)' AS (\w+)(.*);",
+                          statement, re.DOTALL)
+        if attach:
+          filename, name, options = attach.groups()
+          self.Attach(name, filename, options)
+          continue
+        cursor.execute(statement)
+      cursor.execute(statements[-1])
+    except Exception:
+      cursor.close()
+      raise
+    return cursor
+
+  def RunSqlScript(self, sql):
+    """Header and rows of the last statement of SQL compiled by Logica."""
+    cursor = self.Execute(sql)
+    try:
+      header = [d[0] for d in cursor.description]
+      return header, cursor.fetchall()
+    finally:
+      cursor.close()
+
+  def Close(self):
+    self.connection.close()
+
+
+databases = {}
+databases_lock = threading.Lock()
+
+
+def GetDatabase(key, **database_args):
+  """Database shared by all callers using the key, e.g. a SQLite file.
+
+  The first caller builds the database outside of the lock, so bootstrap of
+  one key does not hold up callers of other keys, and callers of the same
+  key wait for it.
+  """
+  with databases_lock:
+    future = databases.get(key)
+    building = future is None
+    if building:
+      future = databases[key] = futures.Future()
+  if building:
+    try:
+      future.set_result(DuckDbDatabase(**database_args))
+    except Exception as e:
+      with databases_lock:
+        # Next caller tries to build it again.
+        del databases[key]
+      future.set_exception(e)
+  return future.result()
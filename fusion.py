@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fusion of requests that differ only in measures into a single report.
+
+Requests with the same dimensions and filters whose measures are all
+computed from the same fact table are answered by one report computing the
+union of their measures, so the fact table is scanned once. Rows of the
+fused report are then split back into the report of each request, ordering
+of the requests is applied to the split rows. Requests with a limit are not
+fused, as their SQL would no longer limit the rows read.
+
+Rows are ordered as SQLite orders them, so only requests of SQLite programs
+are fused.
+
+Measures of a fact table are computed by one rule in any case, so the fused
+report has the rows that a request with all the measures would have.
+"""
+
+import collections
+import functools
+
+import olap
+
+
+def OrderKey(order):
+  """Predicate call and whether the order is descending."""
+  for direction in ['asc', 'desc']:
+    if order.endswith(' ' + direction):
+      return order.removesuffix(' ' + direction), direction == 'desc'
+  return order, False
+
+
+def FusionKey(o):
+  """Key of requests that can be fused with the Olap request, or None.
+
+  Requests are fused when they have the same dimensions and filters and
+  all of their measures come from one fact table.
+  """
+  if o.limit >= 0 or len(o.measures_to_compute_from_table) != 1:
+    return None
+  columns = o.dimensions + o.measures
+  if (not o.measures or not o.dimensions or
+      len(set(columns)) != len(columns)):
+    return None
+  if any(OrderKey(order)[0] not in columns for order in o.order):
+    return None
+  [fact_table] = o.measures_to_compute_from_table
+  return (fact_table, tuple(sorted(o.dimensions)), tuple(sorted(set(o.filters))))
+
+
+class FusedReport:
+  """Request computing measures of all the fused requests."""
+
+  def __init__(self, requests):
+    self.requests = requests
+    first = requests[0]
+    self.dimensions = olap.GetPredicateCallsField(first, 'dimensions')
+    self.measures = []
+    for request in requests:
+      for measure in olap.GetPredicateCallsField(request, 'measures'):
+        if measure not in self.measures:
+          self.measures.append(measure)
+    self.request = {
+      'measures': self.measures,
+      'dimensions': self.dimensions,
+      'filters': list(first.get('filters', [])),
+      'order': [],
+      'limit': -1,
+      'chartType': 'Table()'
+    }
+
+  def Split(self, data, request):
+    """Rows of the request computed from [header] + rows of fused report."""
+    fused_columns = self.dimensions + self.measures
+    columns = (olap.GetPredicateCallsField(request, 'dimensions') +
+               olap.GetPredicateCallsField(request, 'measures'))
+    positions = [fused_columns.index(c) for c in columns]
+    header = [data[0][i] for i in positions]
+    rows = [[row[i] for i in positions] for row in data[1:]]
+    return [header] + OrderAndLimit(columns, rows, request)
+
+
+def OrderAndLimit(columns, rows, request):
+  """Rows ordered and limited as the request asks, columns are predicate calls."""
+  orders = [OrderKey(order)
+            for order in olap.GetPredicateCallsField(request, 'order')]
+  # Sorting is stable, so sorting by keys from the last to the first orders
+  # by all of them. SQLite places nulls before all other values.
+  for column, descending in reversed(orders):
+    i = columns.index(column)
+    rows.sort(key=functools.partial(SortKey, i), reverse=descending)
+  limit = request.get('limit', -1)
+  if limit is not None and limit >= 0:
+    rows = rows[:limit]
+  return rows
+
+
+def SortKey(i, row):
+  value = row[i]
+  if value is None:
+    return (0, 0)
+  if isinstance(value, (int, float)):
+    return (1, value)
+  return (2, str(value))
+
+
+def FuseRequests(config, model, requests):
+  """Splits requests into groups answered by one report each.
+
+  Returns list of (FusedReport or None, indices of requests in the group).
+  Groups of a single request and requests that can not be fused have None
+  for the report and are to be run as they are.
+  """
+  groups = collections.defaultdict(list)
+  single = []
+  for i, request in enumerate(requests):
+    try:
+      key = None
+      if model.engine == 'sqlite':
+        key = FusionKey(olap.Olap(config, request, model))
+    except Exception:
+      # Broken requests are run alone to report their error.
+      key = None
+    if key is None:
+      single.append(i)
+    else:
+      groups[key].append(i)
+  result = [(None, [i]) for i in single]
+  for indices in groups.values():
+    if len(indices) == 1:
+      result.append((None, indices))
+    else:
+      result.append((FusedReport([requests[i] for i in indices]), indices))
+  return result
@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of fusing requests into one report."""
+
+import json
+import unittest
+
+import fusion
+import olap
+
+
+def Request(measure, limit=-1):
+  return {'measures': [measure], 'dimensions': ['Continent()'],
+          'filters': [], 'order': [measure + ' desc'], 'limit': limit}
+
+
+class FuseRequestsTest(unittest.TestCase):
+
+  def Fuse(self, config_file, requests):
+    with open(config_file) as f:
+      config = json.load(f)
+    return fusion.FuseRequests(config, olap.CompiledOlapModel(config),
+                               requests)
+
+  def testFusesRequestsDifferingInMeasures(self):
+    [(report, indices)] = self.Fuse(
+        'examples/car_1/car_1.json',
+        [Request('NumCars()'), Request('AvgWeight()')])
+    self.assertEqual(indices, [0, 1])
+    self.assertEqual(report.measures, ['NumCars()', 'AvgWeight()'])
+
+  def testDoesNotFuseRequestsWithLimit(self):
+    groups = self.Fuse('examples/car_1/car_1.json',
+                       [Request('NumCars()', 3), Request('AvgWeight()', 3)])
+    self.assertEqual(groups, [(None, [0]), (None, [1])])
+
+  def testDoesNotFuseRequestsOfOtherEngines(self):
+    groups = self.Fuse(
+        'examples/baby_names/baby_names.json',
+        [{'measures': ['NumberOfBabies()'], 'dimensions': ['State()']},
+         {'measures': ['NameFraction(name: "Alice")'],
+          'dimensions': ['State()']}])
+    self.assertEqual(groups, [(None, [0]), (None, [1])])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -31,7 +31,12 @@ from logica.common import logica_lib
 from logica.type_inference.research import infer
 from logica.parser_py import parse
 import run_sql_db
+import caching
 import collections
+import functools
+import itertools
+import threading
+from concurrent import futures
 from logica.compiler import universe
 
 
@@ -57,8 +62,9 @@ def create_and_write_file(filepath, content):
 
 def Understand(config, user_request):
   mind = ai.AI.Get()
-  template = ai.GetPromptTemplate(config)
-  json_str = mind(template.replace('__USER_REQUEST__', user_request))
+  template = ai.GetCompiledPromptTemplate(config)
+  mind.CheckPromptSize(template, user_request)
+  json_str = mind(template.Render(user_request))
   try:
     json_obj = json.loads(json_str)
     # Skipping ordering
@@ -71,13 +77,180 @@ def Understand(config, user_request):
   return json_obj
 
 
+class NotALiteral(Exception):
+  pass
+
+
+def LiteralValue(expression):
+  """Python value of a literal Logica expression."""
+  if 'literal' in expression:
+    literal = expression['literal']
+    if 'the_string' in literal:
+      return literal['the_string']['the_string']
+    if 'the_number' in literal:
+      number = literal['the_number']['number']
+      return float(number) if '.' in number or 'e' in number else int(number)
+    if 'the_bool' in literal:
+      return literal['the_bool']['the_bool'] == 'true'
+    if 'the_null' in literal:
+      return None
+    if 'the_list' in literal:
+      return [LiteralValue(e) for e in literal['the_list']['element']]
+  if 'record' in expression:
+    return RecordValue(expression['record'])
+  if 'call' in expression and expression['call']['predicate_name'] == '->':
+    arrow = RecordValue(expression['call']['record'])
+    return {'arg': arrow['left'], 'value': arrow['right']}
+  raise NotALiteral(expression.get('expression_heritage'))
+
+
+def RecordValue(record):
+  return {fv['field']: LiteralValue(fv['value']['expression'])
+          for fv in record['field_value']}
+
+
+def LogicLMFromRules(rules):
+  """LogicLM record and engine read from the program without running it.
+
+  Returns None if they are not given as literals.
+  """
+  config = None
+  engine = None
+  for rule in rules:
+    predicate_name = rule['head']['predicate_name']
+    if 'body' in rule:
+      continue
+    try:
+      if predicate_name == 'LogicLM':
+        config = RecordValue(rule['head']['record'])
+      if predicate_name == '@Engine':
+        engine = RecordValue(rule['head']['record'])[0]
+    except NotALiteral:
+      return None
+  if config is None or engine is None:
+    return None
+  return config, engine
+
+
+def ReferencedPredicates(syntax):
+  """Names of all predicates the parsed syntax refers to.
+
+  Unlike olap.CalledPredicates, which finds calls only, this finds any
+  predicate_name, e.g. of rule heads and of predicate literals given to
+  functors.
+  """
+  if isinstance(syntax, dict):
+    if 'predicate_name' in syntax:
+      yield syntax['predicate_name']
+    for v in syntax.values():
+      yield from ReferencedPredicates(v)
+  elif isinstance(syntax, list):
+    for v in syntax:
+      yield from ReferencedPredicates(v)
+
+
+def RulesDefining(rules, predicates):
+  """Rules of the predicates and of everything they depend on."""
+  rules_of = collections.defaultdict(list)
+  for rule in rules:
+    rules_of[rule['head']['predicate_name']].append(rule)
+  needed = set()
+  to_visit = list(predicates)
+  while to_visit:
+    p = to_visit.pop()
+    if p in needed:
+      continue
+    needed.add(p)
+    for rule in rules_of[p]:
+      to_visit.extend(ReferencedPredicates(rule))
+  return [r for r in rules if r['head']['predicate_name'] in needed]
+
+
+# Version of the config building logic, stored configs of other versions
+# are ignored.
+CONFIG_CACHE_VERSION = '2'
+
+
+def ImportedFiles(filename, import_root=''):
+  """Files of the modules the Logica program imports, directly or not."""
+  result = []
+  pending = [filename]
+  while pending:
+    with open(pending.pop()) as f:
+      program = f.read()
+    for module in re.findall(r'(?:^|;)\s*import\s+([\w.]+)\.\w+', program,
+                             re.MULTILINE):
+      imported = os.path.join(import_root, module.replace('.', '/') + '.l')
+      if imported not in result and os.path.exists(imported):
+        result.append(imported)
+        pending.append(imported)
+  return sorted(result)
+
+
+def ConfigCacheFilename(config_filename):
+  directory = os.getenv('LOGICLM_CONFIG_CACHE',
+                        os.path.join(os.path.expanduser('~'), '.cache',
+                                     'logiclm', 'configs'))
+  files = [config_filename] + ImportedFiles(config_filename)
+  key = caching.Fingerprint(json.dumps(
+      [CONFIG_CACHE_VERSION] +
+      [(os.path.abspath(f), caching.FileFingerprint(f)) for f in files]))
+  return os.path.join(directory, key + '.json')
+
+
 def JsonConfigFromLogicLMPredicate(config_filename):
+  """Config for the program, stored in LOGICLM_CONFIG_CACHE directory.
+
+  Stored config is reused while the content of the program and of the files
+  it imports is the same. Configs with values that are not JSON, e.g. numpy
+  numbers, are not stored. Setting LOGICLM_CONFIG_CACHE to an empty string
+  disables storing.
+  """
+  if os.getenv('LOGICLM_CONFIG_CACHE') == '':
+    return BuildJsonConfigFromLogicLMPredicate(config_filename)
+  cache_filename = ConfigCacheFilename(config_filename)
+  if os.path.exists(cache_filename):
+    with open(cache_filename) as f:
+      return json.loads(f.read())
+  config = BuildJsonConfigFromLogicLMPredicate(config_filename)
+  try:
+    config_json = json.dumps(config)
+  except (TypeError, ValueError) as e:
+    # Stored values would not load back as they are.
+    print('Config of %s is not stored: %s' % (config_filename, e))
+    return config
+  try:
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    temp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+    with open(temp_filename, 'w') as w:
+      w.write(config_json)
+    os.replace(temp_filename, cache_filename)
+  except OSError as e:
+    print('Could not store config in %s: %s' % (cache_filename, e))
+  return config
+
+
+def BuildJsonConfigFromLogicLMPredicate(config_filename):
   def RunPredicate(predicate):
     return logica_lib.RunPredicateToPandas(config_filename, predicate)
-  config = RunPredicate('LogicLM').iloc[0].to_dict()
-  engine = RunPredicate('@Engine')['col0'][0]
-  rules = parse.ParseFile(open(config_filename).read())['rule']
-  types = infer.TypesInferenceEngine(rules, 'duckdb')
+  rules = logica_lib.ParseOrExit(config_filename)
+  config_and_engine = LogicLMFromRules(rules)
+  if config_and_engine:
+    config, engine = config_and_engine
+  else:
+    config = RunPredicate('LogicLM').iloc[0].to_dict()
+    engine = RunPredicate('@Engine')['col0'][0]
+  def FieldContent(field):
+    field_content=config.get(field, [])
+    if isinstance(field_content,str):
+      field_content=json.loads(field_content)
+    return field_content
+  # Types are only inferred for predicates that config refers to.
+  referenced_predicates = set(FieldContent('dimensions') +
+                              FieldContent('measures') +
+                              FieldContent('filters'))
+  types = infer.TypesInferenceEngine(RulesDefining(rules, referenced_predicates),
+                                     'duckdb')
   types.InferTypes()
   fact_tables = config['fact_tables']
   if isinstance(fact_tables,str):
@@ -97,9 +270,7 @@ def JsonConfigFromLogicLMPredicate(config_filename):
             for f in types.predicate_signature[p].keys()
             if not isinstance(f, int) and f != 'logica_value']
   def BuildCalls(role, field,fact_table={}):
-    field_content=config[field]
-    if isinstance(field_content,str):
-      field_content=json.loads(field_content)
+    field_content=FieldContent(field)
     output=[{role: {'predicate_name': p,
                     'parameters': Params(p)}}
             for p in field_content]
@@ -121,6 +292,8 @@ def JsonConfigFromLogicLMPredicate(config_filename):
   chart_data = [{"predicate": {"predicate_name": chart, "parameters": []}}
                 for chart in chart_types]
   if 'suffix_lines' in config:
+    if isinstance(config['suffix_lines'], str):
+      config['suffix_lines'] = json.loads(config['suffix_lines'])
     config['suffix_lines'] = list(config['suffix_lines'])
   config['chart_types'] = chart_data
   config['logica_program'] = config_filename
@@ -143,7 +316,45 @@ def getSchema(db_name):
       return item_path
       
 
-def runQueries(str_query="Select * from continents;",db_name="car_1",debug=False):
+def QueryEngine(engine=None):
+  """Engine running queries: sqlite, duckdb or duckdb_import.
+
+  Engine defaults to LOGICLM_QUERY_ENGINE, or sqlite if it is not set.
+  """
+  engine = engine or os.getenv("LOGICLM_QUERY_ENGINE", "sqlite")
+  assert engine in ("sqlite", "duckdb", "duckdb_import"), (
+      "Unknown query engine: %s" % engine)
+  return engine
+
+def ProgramForQueryEngine(logic_program, engine=None):
+  """Logic program compiling to SQL of the query engine.
+
+  Programs for SQLite are kept as they are. For DuckDB the @Engine
+  annotation of the program is replaced, or added if it is missing.
+  """
+  if QueryEngine(engine) == "sqlite":
+    return logic_program
+  logic_program, replaced = re.subn(r'@Engine\(\s*"\w+"',
+                                    '@Engine("duckdb"', logic_program)
+  if not replaced:
+    logic_program = '@Engine("duckdb");\n' + logic_program
+  return logic_program
+
+def OlapSQL(config, request, engine=None):
+  """SQL of the OLAP request for the query engine."""
+  if QueryEngine(engine) == "sqlite":
+    return olap.Olap(config, request).GetSQL()
+  # Report columns are quoted the DuckDB way as well.
+  analyzer = olap.Olap(dict(config, dialect="duckdb"), request)
+  return GetSQL(ProgramForQueryEngine(analyzer.GetFullLogicProgram(), engine))
+
+def runQueries(str_query="Select * from continents;",db_name="car_1",debug=False,engine=None):
+  """Runs query on the database, engine is sqlite, duckdb or duckdb_import.
+
+  Engine defaults to LOGICLM_QUERY_ENGINE, or sqlite if it is not set.
+  Golden Spider queries are in SQLite dialect and run with engine sqlite.
+  """
+  engine = QueryEngine(engine)
   if str_query.lower().startswith("select")==False:
     index=str_query.lower().find("with")
     str_query =str_query[index:]
@@ -151,7 +362,11 @@ def runQueries(str_query="Select * from continents;",db_name="car_1",debug=False
   sqlite_file_name = getSQLite(db_name)
   if debug:
     print("The query which is going to run ....................................................: ", str_query)
-  df = run_sql_db.run_query(sqlite_file_name,sql_file_name,str_query)
+  if engine == "sqlite":
+    df = run_sql_db.run_query(sqlite_file_name,sql_file_name,str_query)
+  else:
+    df = run_sql_db.run_query_duckdb(sqlite_file_name,sql_file_name,str_query,
+                                     import_tables=engine == "duckdb_import")
   if debug:
     print(df)
   return df
@@ -205,27 +420,21 @@ def GetQuestions(db_name):
     mind.CreateNewChat()
     step1=mind.sendPrompt(f"Please Understand this Yodaql Info: {yodaql_info}")
     print("Yodaql Info Step Done")
-    time.sleep(20)
     print(step1[:100])
     step2=mind.sendPrompt(f"Please Understand this Input Schema: {converted_schema}")
     print("Input Schema Step Done")
-    time.sleep(20)
     print(step2[:100])
     step3=mind.sendPrompt(f"Please Understand this Questions : {','.join(questions)}")
     print("Questions  Step Done")
-    time.sleep(20)
     print(step3[:100])
     step4=mind.sendPrompt(f"Please Understand this Example Yodaql Config 1 : {example_yodaql_config1}")
     print("Example Yodaql Config 1 Step Done")
-    time.sleep(20)
     print(step4[:100])
     step4=mind.sendPrompt(f"Please Understand this Example Yodaql Config 2 : {example_yodaql_config2}")
     print("Example Yodaql Config 2 Step Done")
-    time.sleep(20)
     print(step4[:100])
     step4=mind.sendPrompt(f"Please Understand this Example Yodaql Config 3 : {example_yodaql_config3}")
     print("Example Yodaql Config 3 Step Done")
-    time.sleep(20)
     print(step4[:100])
     new_config=mind.sendPrompt("Please provide a yodaql config for Input Schema which answers the questions. Please do not include any hashtags or comments.",30000)
     create_and_write_file(f"examples/{db_name}/{db_name}_new.l",new_config)
@@ -264,7 +473,7 @@ def GetLogicProgram(db_name,question):
     logic_answer = mind.CreateLogicProgram(prompt)
     logic_answer = cleanup_content(logic_answer)
     print("LOGIC PROGRAM: ",logic_answer,"\n")
-    sql=GetSQL(logic_answer)
+    sql=GetSQL(ProgramForQueryEngine(logic_answer))
     print("GENERATED SQL: ",sql.replace('\n', ''),"\n")
     answer=runQueries(sql,db_name,False)
     return "success",answer
@@ -275,6 +484,42 @@ def GetLogicProgram(db_name,question):
     print("Error is: ", e)
     return "error",e
 
+def RunTasks(tasks,workers=None,per_database=None):
+  """Runs (db_name, function) tasks concurrently, returning results in order of tasks.
+
+  At most per_database tasks of the same database run at the same time.
+  Defaults are taken from LOGICLM_WORKERS and LOGICLM_WORKERS_PER_DATABASE.
+  """
+  workers=workers or int(os.getenv("LOGICLM_WORKERS","8"))
+  per_database=per_database or int(os.getenv("LOGICLM_WORKERS_PER_DATABASE","2"))
+  semaphores={db_name:threading.Semaphore(per_database) for db_name,_ in tasks}
+  def Run(db_name,function):
+    with semaphores[db_name]:
+      return function()
+  # Submitting tasks round-robin over databases, so that workers are not
+  # all waiting for the same database.
+  by_database=collections.defaultdict(list)
+  for indx,(db_name,function) in enumerate(tasks):
+    by_database[db_name].append((indx,function))
+  interleaved=[t for batch in itertools.zip_longest(*by_database.values())
+               for t in batch if t]
+  results=[None]*len(tasks)
+  with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    submitted={executor.submit(Run,tasks[indx][0],function):indx
+               for indx,function in interleaved}
+    for future in futures.as_completed(submitted):
+      results[submitted[future]]=future.result()
+  return results
+
+def EvaluateLogicProgram(db_name,question,golden_query):
+  print("QUESTION------------------------------->: ", db_name,question,"\n")
+  status,output = GetLogicProgram(db_name,question)
+  if status=="error":
+    return "error",[db_name,question,output]
+  print("ACTUAL SQL: ",golden_query,"\n")
+  answer=runQueries(golden_query,db_name,engine="sqlite")
+  return "answer",[db_name,question,answer.to_string().replace('\n', ''),output.to_string().replace('\n', ''),len(answer),len(output)]
+
 def GetLogicPrograms(db_name,first_n=10):
   db_question_name = "spider_data/dev.json"
   questions=[]
@@ -287,15 +532,10 @@ def GetLogicPrograms(db_name,first_n=10):
     if test_case["db_id"]==db_name:
       questions.append(test_case["question"])
       golden_queries.append(test_case["query"])
-  for indx in range(min(len(questions),first_n)):
-    print("QUESTION------------------------------->: ", questions[indx],"\n")
-    status,output = GetLogicProgram(db_name,questions[indx])
-    if status=="error":
-      errors.append([db_name,questions[indx],output])
-      continue
-    print("ACTUAL SQL: ",golden_queries[indx],"\n")
-    answer=runQueries(golden_queries[indx],db_name)
-    answers.append([db_name,questions[indx],answer.to_string().replace('\n', ''),output.to_string().replace('\n', ''),len(answer),len(output)])
+  tasks=[(db_name,functools.partial(EvaluateLogicProgram,db_name,questions[indx],golden_queries[indx]))
+         for indx in range(min(len(questions),first_n))]
+  for status,row in RunTasks(tasks):
+    (errors if status=="error" else answers).append(row)
   answers_df=pd.DataFrame(answers,columns=["db_name","Question","Actual Output","Logical Output","Actual Len","Logical Len"])
   errors_df=pd.DataFrame(errors,columns=["db_name","Question","Error"])
   answers_df.to_csv("logic_answers.txt", index=False)
@@ -316,18 +556,14 @@ def GetAllLogicProgram():
     if getSchema(test_case["db_id"]):
       questions[test_case["db_id"]].append(test_case["question"])
       golden_queries[test_case["db_id"]].append(test_case["query"])
+  tasks=[]
   for db_name in questions:
     golden_query=golden_queries[db_name]
     question_list=questions[db_name]
     for indx in range(len(question_list)):
-      print("QUESTION------------------------------->: ", db_name,question_list[indx],"\n")
-      status,output = GetLogicProgram(db_name,question_list[indx])
-      if status=="error":
-        errors.append([db_name,question_list[indx],output])
-        continue
-      print("ACTUAL SQL: ",golden_query[indx],"\n")
-      answer=runQueries(golden_query[indx],db_name)
-      answers.append([db_name,question_list[indx],answer.to_string().replace('\n', ''),output.to_string().replace('\n', ''),len(answer),len(output)])
+      tasks.append((db_name,functools.partial(EvaluateLogicProgram,db_name,question_list[indx],golden_query[indx])))
+  for status,row in RunTasks(tasks):
+    (errors if status=="error" else answers).append(row)
   answers_df=pd.DataFrame(answers,columns=["db_name","Question","Actual Output","Logical Output","Actual Len","Logical Len"])
   errors_df=pd.DataFrame(errors,columns=["db_name","Question","Error"])
   answers_df.to_csv("logic_answers.txt", index=False)
@@ -388,6 +624,44 @@ def write_list_of_lists_to_file(data, filename):
     except Exception as e:
         print(f"An error occurred while writing to the file: {e}")
 
+def TestingSetup(db_name,file_path,question,sql_query):
+  """Checks the config on the first question, returns None on failure."""
+  try:
+    print("Will do testing for db_name:",db_name)
+    print(question)
+    print(sql_query)
+    print(runQueries(sql_query,db_name,engine="sqlite"))
+    config=JsonConfigFromLogicLMPredicate(file_path)
+    request = Understand(config,question)
+    print(runQueries(OlapSQL(config, request),db_name))
+    return config
+  except BaseException as e:
+    print("Could no do testing for:", db_name)
+    print(f"An error occurred: {e}")
+    return None
+
+def TestQuestion(db_name,config,question,sql_query):
+  try:
+    answer=[]
+    answer.append(db_name)
+    answer.append(question)
+    actual_df=runQueries(sql_query,db_name,engine="sqlite")
+
+    answer.append(actual_df.to_string().replace('\n', ''))
+    request = Understand(config,question )
+
+    tested_df=runQueries(OlapSQL(config, request),db_name)
+
+    answer.append(tested_df.to_string().replace('\n', ''))
+
+    answer.append(len(actual_df))
+    answer.append(len(tested_df))
+    return "answer",answer
+  except BaseException as e:
+    print(e)
+    print(f"We failed this question ->{question} for db_name: {db_name}")
+    return "error",[db_name,question,e]
+
 def Testing():
   questions=collections.defaultdict(list)
   sql_queries=collections.defaultdict(list)
@@ -401,7 +675,7 @@ def Testing():
     if test_case["db_id"]:
       questions[test_case["db_id"]].append(test_case["question"])
       sql_queries[test_case["db_id"]].append(test_case["query"])
-  testing_done=0
+  setup_tasks=[]
   for db_name in questions:
     file_path = f"examples/{db_name}/{db_name}_new.l"
     if os.path.exists(file_path)==False:
@@ -413,43 +687,20 @@ def Testing():
       print("LOGIC LM not in: ", file_path)
       delete_configs.append(db_name)
       continue
+    setup_tasks.append((db_name,functools.partial(
+      TestingSetup,db_name,file_path,questions[db_name][0],sql_queries[db_name][0])))
 
-    try:
-      print("Will do testing for db_name:",db_name)
-      print(questions[db_name][0])
-      print(sql_queries[db_name][0])
-      print(runQueries(sql_queries[db_name][0],db_name))
-      config=JsonConfigFromLogicLMPredicate(file_path)
-      request = Understand(config,questions[db_name][0] )
-      analyzer = olap.Olap(config, request)
-      print(runQueries(analyzer.GetSQL(),db_name))
-      testing_done+=1
-      for indx,question in enumerate(questions[db_name]):
-        try:
-          answer=[]
-          answer.append(db_name)
-          answer.append(question)
-          actual_df=runQueries(sql_queries[db_name][indx],db_name)
-
-          answer.append(actual_df.to_string().replace('\n', ''))
-          request = Understand(config,question )
-          analyzer = olap.Olap(config, request)
-
-          tested_df=runQueries(analyzer.GetSQL(),db_name)
-
-          answer.append(tested_df.to_string().replace('\n', ''))
-
-          answer.append(len(actual_df))
-          answer.append(len(tested_df))
-          answers.append(answer)
-        except BaseException as e:
-          errors.append([db_name,question,e])
-          print(e)
-          print(f"We failed this question ->{question} for db_name: {db_name}")
-    except BaseException as e:
-      print("Could no do testing for:", db_name)
+  tasks=[]
+  for (db_name,_),config in zip(setup_tasks,RunTasks(setup_tasks)):
+    if config is None:
       delete_configs.append(db_name)
-      print(f"An error occurred: {e}")
+      continue
+    for indx,question in enumerate(questions[db_name]):
+      tasks.append((db_name,functools.partial(
+        TestQuestion,db_name,config,question,sql_queries[db_name][indx])))
+  testing_done=len({db_name for db_name,_ in tasks})
+  for status,row in RunTasks(tasks):
+    (errors if status=="error" else answers).append(row)
   print("Delete Configs: ",delete_configs)
   answers_df=pd.DataFrame(answers,columns=["db_name","Question","Actual Output","Logical Output","Actual Len","Logical Len"])
   errors_df=pd.DataFrame(errors,columns=["db_name","Question","Error"])
@@ -536,12 +787,11 @@ def main(argv):
   elif command == 'understand_sql_run':
     user_request = argv[3]
     request = Understand(config, user_request)
-    analyzer = olap.Olap(config, request)
     try:
       if len(argv)>=5:
-        runQueries(analyzer.GetSQL(),argv[4],True)
+        runQueries(OlapSQL(config, request),argv[4],True)
       else:
-        runQueries(analyzer.GetSQL())
+        runQueries(OlapSQL(config, request))
     except parse.ParsingException as parsing_exception:
       parsing_exception.ShowMessage()
       sys.exit(1)
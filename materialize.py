@@ -0,0 +1,279 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Snapshots of consolidated fact tables in a local SQLite database.
+
+Config lists fact tables to materialize, e.g.
+"materialized_fact_tables": ["ReachAndPopulation"], and optionally
+"snapshot_database" and "snapshot_refresh_seconds". Consolidations of the
+listed fact tables, and of the fact tables that listed unions are made of,
+are computed once per set of dimensions and stored in the snapshot
+database. Requests with no filters reaching inside of a consolidation read
+its snapshot instead of consolidating the facts again. Filters that need
+ephemeral dimensions only restrict the domain of dimensions, so they still
+apply to snapshots.
+
+Snapshots are refreshed every snapshot_refresh_seconds. At most
+snapshot_max_tables of them are kept, e.g. for consolidations depending on
+parameters of dimensions, least recently used ones are dropped. They are
+computed for SQLite engine only.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+import caching
+import connection_pool
+
+from logica.tools import avatar
+
+
+SNAPSHOT_DATABASE_NAME = 'snapshots'
+
+
+def DefaultDatabase(config, kind):
+  """File in ~/.cache/logiclm/<kind> specific to the config."""
+  directory = os.path.join(os.path.expanduser('~'), '.cache', 'logiclm', kind)
+  os.makedirs(directory, exist_ok=True)
+  return os.path.join(directory,
+                      caching.ConfigFingerprint(config) + '.sqlite')
+
+
+def StoreTable(database, table, columns, rows):
+  """Replaces the table in SQLite database in one transaction."""
+  connection = sqlite3.connect(database, isolation_level=None)
+  try:
+    connection.execute('BEGIN IMMEDIATE')
+    connection.execute('DROP TABLE IF EXISTS %s' % table)
+    connection.execute('CREATE TABLE %s (%s)' % (
+        table, ', '.join('"%s"' % c for c in columns)))
+    connection.executemany('INSERT INTO %s VALUES (%s)' % (
+        table, ', '.join('?' for _ in columns)), rows)
+    connection.execute('COMMIT')
+  finally:
+    connection.close()
+
+
+def DropTables(database, tables):
+  if not tables:
+    return
+  connection = sqlite3.connect(database, isolation_level=None)
+  try:
+    for table in tables:
+      connection.execute('DROP TABLE IF EXISTS %s' % table)
+  finally:
+    connection.close()
+
+
+def MaterializedConsolidations(model, fact_tables):
+  """Consolidated fact tables that are materialized for the listed tables."""
+  result = set()
+  pending = list(fact_tables)
+  while pending:
+    t = pending.pop()
+    if t in model.consolidation_info:
+      result.add(t)
+    elif t in model.union_info:
+      pending.extend(model.union_info[t][0])
+    else:
+      raise ValueError(
+          'Materialized fact table %s is neither consolidation nor union.' % t)
+  return result
+
+
+class Snapshot:
+  def __init__(self, table, columns, sql):
+    self.table = table
+    self.columns = columns
+    self.sql = sql
+    self.built_at = None
+
+
+class Materializer:
+  """Builds snapshots of consolidations and rules reading them."""
+
+  def __init__(self, config, model, database=None, refresh_seconds=3600,
+               max_tables=64, on_evict=None):
+    self.fact_tables = MaterializedConsolidations(
+        model, config.get('materialized_fact_tables', []))
+    self.database = database or DefaultDatabase(config, 'snapshots')
+    self.refresh_seconds = refresh_seconds
+    self.max_tables = max_tables
+    # Called when snapshots are evicted, so that plans reading them are
+    # dropped.
+    self.on_evict = on_evict
+    self.pool = connection_pool.ConnectionPool()
+    # Maps table name to Snapshot, least recently used first.
+    self.snapshots = collections.OrderedDict()
+    # Tables of evicted snapshots, dropped on the next refresh, as queries
+    # planned before the eviction may still read them.
+    self.retired_tables = []
+    self.lock = threading.Lock()
+    # Building is serialized, so that a snapshot is built once.
+    self.build_lock = threading.Lock()
+    # Writes of snapshot tables are serialized with updates of snapshots, so
+    # that refreshing or dropping a table never races with its eviction.
+    self.store_lock = threading.Lock()
+    self.supported = True
+    self.refresher = None
+    self.hits = 0
+    self.builds = 0
+    self.failures = 0
+
+  def Covers(self, o, fact_table, filters):
+    """Whether consolidation of the fact table can be read from snapshot."""
+    if not self.supported or fact_table not in self.fact_tables:
+      return False
+    source_table = o.consolidation_info[fact_table][0]
+    # Consolidations of built tables depend on domain of the request.
+    return not filters and source_table not in o.direct_dependency
+
+  def AttachRule(self):
+    return avatar.Predicate('@AttachDatabase')(
+        avatar.Literal(SNAPSHOT_DATABASE_NAME),
+        avatar.Literal(self.database)) << None
+
+  def SnapshotRule(self, o, consolidating_rule):
+    """Rule reading the consolidating rule from its snapshot, None on failure.
+
+    Snapshot is built when the consolidation is met for the first time.
+    """
+    table = TableName(consolidating_rule)
+    with self.lock:
+      snapshot = self.snapshots.get(table)
+      if snapshot:
+        self.snapshots.move_to_end(table)
+        self.hits += 1
+    if snapshot is None:
+      snapshot = self.Build(o, consolidating_rule, table)
+    if snapshot is None:
+      return None
+    args = {c: avatar.Variable(c) for c in snapshot.columns}
+    head = avatar.Predicate(consolidating_rule.head.predicate_name)(**args)
+    body = avatar.Predicate(
+        SNAPSHOT_DATABASE_NAME + '.' + snapshot.table)(**args)
+    rule = head << body
+    rule.comment_before_rule = 'Reading snapshot of the consolidation.'
+    return rule
+
+  def Build(self, o, consolidating_rule, table):
+    with self.build_lock:
+      with self.lock:
+        if table in self.snapshots:
+          return self.snapshots[table]
+      columns = list(consolidating_rule.head.named_args)
+      program = avatar.Program([])
+      program.AddRule(consolidating_rule)
+      args = {c: avatar.Variable(c) for c in columns}
+      program.AddRule(
+          avatar.Predicate('Report')(**args) <<
+          avatar.Predicate(consolidating_rule.head.predicate_name)(**args))
+      try:
+        sql = o.CompileSQL(program)
+        if o.engine != 'sqlite':
+          print('Snapshots are built for SQLite engine only, not for %s.' %
+                o.engine)
+          self.supported = False
+          return None
+        snapshot = Snapshot(table, columns, sql)
+        rows = self.Compute(snapshot)
+        with self.store_lock:
+          StoreTable(self.database, table, columns, rows)
+          snapshot.built_at = time.time()
+          with self.lock:
+            self.snapshots[table] = snapshot
+            self.builds += 1
+            evicted = []
+            while len(self.snapshots) > self.max_tables:
+              evicted.append(self.snapshots.popitem(last=False)[0])
+            self.retired_tables.extend(
+                t for t in evicted if t not in self.retired_tables)
+      except Exception:
+        print('Failure of building snapshot %s:' % table)
+        print(traceback.format_exc())
+        with self.lock:
+          self.failures += 1
+        return None
+      if evicted and self.on_evict:
+        self.on_evict()
+      return snapshot
+
+  def Compute(self, snapshot):
+    """Rows of the snapshot."""
+    with self.pool.Connection() as connection:
+      header, rows = connection_pool.RunSqlScript(connection, snapshot.sql)
+    assert header == snapshot.columns, (header, snapshot.columns)
+    return rows
+
+  def Refresh(self):
+    """Recomputes all snapshots, keeping the old ones if that fails.
+
+    Snapshots are computed without holding locks, so that requests can
+    build new snapshots meanwhile. Tables of evicted snapshots are dropped.
+    """
+    with self.lock:
+      snapshots = list(self.snapshots.values())
+    for snapshot in snapshots:
+      try:
+        rows = self.Compute(snapshot)
+        with self.store_lock:
+          with self.lock:
+            if self.snapshots.get(snapshot.table) is not snapshot:
+              continue
+          StoreTable(self.database, snapshot.table, snapshot.columns, rows)
+          snapshot.built_at = time.time()
+      except Exception:
+        print('Failure of refreshing snapshot %s:' % snapshot.table)
+        print(traceback.format_exc())
+        with self.lock:
+          self.failures += 1
+    with self.store_lock:
+      with self.lock:
+        # Evicted snapshots may have been built again since.
+        retired_tables = [t for t in self.retired_tables
+                          if t not in self.snapshots]
+        self.retired_tables = []
+      DropTables(self.database, retired_tables)
+
+  def Start(self):
+    """Starts refreshing snapshots in the background."""
+    def RefreshForever():
+      while True:
+        time.sleep(self.refresh_seconds)
+        self.Refresh()
+    self.refresher = threading.Thread(target=RefreshForever, daemon=True)
+    self.refresher.start()
+
+  def Stats(self):
+    with self.lock:
+      built_at = [s.built_at for s in self.snapshots.values() if s.built_at]
+      return {'size': len(self.snapshots),
+              'max_size': self.max_tables,
+              'hits': self.hits,
+              'builds': self.builds,
+              'failures': self.failures,
+              'oldest_seconds': (time.time() - min(built_at)
+                                 if built_at else None)}
+
+
+def TableName(consolidating_rule):
+  """Name of snapshot table, the rule determines its content."""
+  return '%s_%s' % (consolidating_rule.head.predicate_name,
+                    caching.Fingerprint(str(consolidating_rule))[:16])
@@ -15,9 +15,12 @@
 # limitations under the License.
 
 
+import caching
+import collections
+import copy
 import hashlib
-import jsonschema
 import json
+import os
 import schema
 import sys
 
@@ -27,63 +30,45 @@ from logica.tools import avatar
 from logica.parser_py import parse
 
 
+class QuotedLiteral(avatar.Literal):
+  """String literal that may contain double quotes, as DuckDB columns do."""
+
+  def __str__(self):
+    if '"' in self.value:
+      return '"""%s"""' % self.value
+    return super().__str__()
+
+
 def GetPredicateCallsField(request, field_name):
   predicate_calls = request.get(field_name, [])
   return [c.replace("'", '"')
           for c in predicate_calls]
 
 
-class Olap:
-  def __init__(self, config, request):
-    jsonschema.validate(config, schema.OlapConfig())
+class CompiledOlapModel:
+  """Structures of a config that do not depend on the request.
+
+  Built once per config and shared by Olap of every request.
+  """
+  def __init__(self, config):
+    if not isinstance(config, schema.ValidatedConfig):
+      schema.ValidateOlapConfig(config)
     self.config = config
-    self.request = request
-    self.called_predicate_cache = {}
-    self.measures = GetPredicateCallsField(request, 'measures')
     default_fact_table = config['default_fact_table']
     self.fact_table_of_measure = {
       m['aggregating_function']['predicate_name']: m.get('fact_table',
                                                          default_fact_table)
       for m in self.config['measures']}
-    
     self.default_fact_table = default_fact_table
-    self.dimensions = GetPredicateCallsField(request, 'dimensions')
-    self.filters = GetPredicateCallsField(request, 'filters')
-    self.limit = request.get('limit', -1)
-    if self.limit is None:
-      self.limit = -1
-    self.order = GetPredicateCallsField(request, 'order')
     self.direct_dependency = self.BuildDirectFactualDependencies()
     self.fact_dependencies = self.BuildFactualDependencies()
-    self.fact_table_to_measures = self.BuildFactTableToMeasures()
     self.consolidation_info = self.GetConsolidationInfo()
     self.union_info = self.GetUnionInfo()
-    self.table_needed_by_measure = {
-        m: self.fact_table_of_measure[self.CalledPredicate(m)]
-        for m in self.measures}
-    self.measures_to_compute_from_table = self.BuildMeasuresToComputeFromTable()
-    self.relevant_fact_tables = self.BuildListOfAllNeededTables()
     self.table_to_ephemeral_dimensions = self.BuildEphemeralDimensions()
     self.filter_to_needed_dimensions = self.BuildFilterToNeededDimensions()
+    self.single_valued_dimensions = SingleValuedDimensions(config)
     self.dialect = config.get('dialect', 'psql')
-
-  def QuotedField(self, field):
-    if self.dialect == 'duckdb':
-      return '"%s"' % field
-    return "`%s`" % field
-
-  def DimensionsDomainRule(self) -> avatar.Rule:
-    dimensions_domain_predicate = avatar.Predicate('DimensionsDomain')
-    fact_variable = avatar.Variable('fact')
-    dimensions_args = {
-        self.ColumnName(d): self.AsPredicateCall(d)(fact_variable)
-        for d in self.dimensions
-    }
-    head = dimensions_domain_predicate(**dimensions_args)
-    filters_proposition = avatar.Conjunction([
-      self.AsPredicateCall(f)(fact_variable) for f in self.filters])
-    body = filters_proposition & avatar.Predicate(self.default_fact_table)(fact_variable)
-    return +head << body
+    self.engine = ProgramEngine(config)
 
   def BuildFilterToNeededDimensions(self):
     result = {}
@@ -98,27 +83,6 @@ class Olap:
       result[t['fact_table']] = t.get('ephemeral_dimensions', [])
     return result
 
-  def BuildListOfAllNeededTables(self):
-    result = set()
-    for t in self.measures_to_compute_from_table:
-      result |= {t}
-      result |= set(self.fact_dependencies[t])
-    return list(sorted(result))
-
-  def BuildMeasuresToComputeFromTable(self):
-    result = {}
-    for measure, table in self.table_needed_by_measure.items():
-      result[table] = result.get(table, []) + [measure]
-    return result
-
-  def BuildFactTableToMeasures(self):
-    result = {}
-    for m in self.request['measures']:
-      measure = self.CalledPredicate(m)
-      table = self.fact_table_of_measure[measure]
-      result[table] = result.get(table, []) + [measure]
-    return result
- 
   def GetConsolidationInfo(self):
     result = {}
     for f in self.config['fact_tables']:
@@ -138,7 +102,7 @@ class Olap:
                         union.get('consolidated_dimensions', []),
                         union.get('projected_dimensions', []))
     return result
-                        
+
   def BuildDirectFactualDependencies(self):
     direct_dependency = {}
     all_fact_tables = []
@@ -153,8 +117,6 @@ class Olap:
     for k, v in direct_dependency.items():
       assert k in all_fact_tables, (k, v)
       assert v <= set(all_fact_tables), ((k, v), all_fact_tables)
-
-
     return direct_dependency
 
   def BuildFactualDependencies(self):
@@ -177,6 +139,84 @@ class Olap:
     return {t: sorted(all_dependencies[t])
             for t in all_fact_tables}
 
+
+class Olap:
+  def __init__(self, config, request, model=None, materializer=None,
+               preaggregates=None):
+    if model is None:
+      model = CompiledOlapModel(config)
+    # Olap reads the config of the model only.
+    assert config is model.config or config == model.config, (
+        'Olap is given a model of another config.')
+    self.model = model
+    self.config = model.config
+    self.request = request
+    self.called_predicate_cache = {}
+    self.measures = GetPredicateCallsField(request, 'measures')
+    self.fact_table_of_measure = model.fact_table_of_measure
+    self.default_fact_table = model.default_fact_table
+    self.dimensions = GetPredicateCallsField(request, 'dimensions')
+    self.filters = GetPredicateCallsField(request, 'filters')
+    self.limit = request.get('limit', -1)
+    if self.limit is None:
+      self.limit = -1
+    self.order = GetPredicateCallsField(request, 'order')
+    self.all_fact_tables = model.all_fact_tables
+    self.direct_dependency = model.direct_dependency
+    self.fact_dependencies = model.fact_dependencies
+    self.fact_table_to_measures = self.BuildFactTableToMeasures()
+    self.consolidation_info = model.consolidation_info
+    self.union_info = model.union_info
+    self.table_needed_by_measure = {
+        m: self.fact_table_of_measure[self.CalledPredicate(m)]
+        for m in self.measures}
+    self.measures_to_compute_from_table = self.BuildMeasuresToComputeFromTable()
+    self.relevant_fact_tables = self.BuildListOfAllNeededTables()
+    self.table_to_ephemeral_dimensions = model.table_to_ephemeral_dimensions
+    self.filter_to_needed_dimensions = model.filter_to_needed_dimensions
+    self.dialect = model.dialect
+    self.materializer = materializer
+    self.preaggregates = preaggregates
+
+  def QuotedField(self, field):
+    if self.dialect == 'duckdb':
+      return '"%s"' % field
+    return "`%s`" % field
+
+  def DimensionsDomainRule(self) -> avatar.Rule:
+    dimensions_domain_predicate = avatar.Predicate('DimensionsDomain')
+    fact_variable = avatar.Variable('fact')
+    dimensions_args = {
+        self.ColumnName(d): self.AsPredicateCall(d)(fact_variable)
+        for d in self.dimensions
+    }
+    head = dimensions_domain_predicate(**dimensions_args)
+    filters_proposition = avatar.Conjunction([
+      self.AsPredicateCall(f)(fact_variable) for f in self.filters])
+    body = filters_proposition & avatar.Predicate(self.default_fact_table)(fact_variable)
+    return +head << body
+
+  def BuildListOfAllNeededTables(self):
+    result = set()
+    for t in self.measures_to_compute_from_table:
+      result |= {t}
+      result |= set(self.fact_dependencies[t])
+    return list(sorted(result))
+
+  def BuildMeasuresToComputeFromTable(self):
+    result = {}
+    for measure, table in self.table_needed_by_measure.items():
+      result[table] = result.get(table, []) + [measure]
+    return result
+
+  def BuildFactTableToMeasures(self):
+    result = {}
+    for m in self.request['measures']:
+      measure = self.CalledPredicate(m)
+      table = self.fact_table_of_measure[measure]
+      result[table] = result.get(table, []) + [measure]
+    return result
+
   def OldLogicProgram(self, request):
     Report = avatar.Predicate('Report')
     fact = avatar.Variable('fact')
@@ -269,26 +309,49 @@ class Olap:
     return consolidating_predicate_name, rule
 
   def ParseExpression(self, s):
-    return parse.ParseExpression(parse.HeritageAwareString(s))
+    return ParsePredicateCall(s).expression
 
   def CalledPredicate(self, predicate_call):
     if predicate_call not in self.called_predicate_cache:
-      parsed_call = self.ParseExpression(predicate_call)
-      assert 'call' in parsed_call, parsed_call
-      self.called_predicate_cache[predicate_call] = parsed_call['call']['predicate_name']
+      self.called_predicate_cache[predicate_call] = (
+          ParsePredicateCall(predicate_call).predicate_name)
     return self.called_predicate_cache[predicate_call]
 
   def AsPredicateCall(self, predicate_call_str):
-    parsed_call = self.ParseExpression(predicate_call_str)
-    call = avatar.LogicalTerm.FromSyntax(parsed_call)
-    return call
+    return ParsePredicateCall(predicate_call_str).Term()
 
   def FactTableDimensions(self, t):
     return [
       d for d in self.dimensions
       if self.CalledPredicate(d) not in self.table_to_ephemeral_dimensions[t]]
-  
+
+  def ReportColumnName(self, predicate_call_str):
+    return self.QuotedField(
+      predicate_call_str.replace('(', '<').replace(')', '>').replace('"', "'").replace('"', "'"))
+
+  def AddOrderAndLimit(self, program):
+    if self.limit >= 0:
+      program.AddRule(avatar.Predicate('@Limit')(
+        avatar.Literal('Report'), avatar.Literal(self.limit)) << None)
+    if self.order:
+      def DecorateOrder(s):
+        for suffix in ['asc', 'desc']:
+          if s.endswith(suffix):
+            direction = suffix
+            s = s.removesuffix(' ' + suffix)
+            break
+        else:
+          direction = 'asc'
+        return self.ReportColumnName(s) + ' ' + direction
+      program.AddRule(avatar.Predicate('@OrderBy')(
+        avatar.Literal('Report'), *map(lambda x: QuotedLiteral(DecorateOrder(x)),
+                                       self.order)) << None)
+
   def GetLogicProgram(self):
+    if self.preaggregates:
+      program = self.preaggregates.RoutedProgram(self)
+      if program:
+        return program
     self.source_of_measure = {}
     needs_building = []
     # Computing each measure.
@@ -296,6 +359,7 @@ class Olap:
     program = avatar.Program([])
     dimensions_domain_rule = self.DimensionsDomainRule()
     need_dimensions_domain = False
+    need_snapshots = False
     for i, (fact_table, measures) in enumerate(self.measures_to_compute_from_table.items()):
       dimensions = [
         d for d in self.dimensions
@@ -324,8 +388,6 @@ class Olap:
       fact_table_to_build = needs_building[i]
       if fact_table_to_build in self.consolidation_info:
         t, c, p = self.consolidation_info[fact_table_to_build]
-        if t in self.direct_dependency:
-          needs_building += [t]
         dimensions = self.FactTableDimensions(t)
         filters = [
           f for f in self.filters
@@ -337,7 +399,17 @@ class Olap:
           {x['name']: x['dimension'] for x in p},
           translucent_dimensions=[],
           consolidating_predicate_name=fact_table_to_build + 'Step1')
-        program.AddRule(rule)
+        snapshot_rule = None
+        if (self.materializer and
+            self.materializer.Covers(self, fact_table_to_build, filters)):
+          snapshot_rule = self.materializer.SnapshotRule(self, rule)
+        if snapshot_rule:
+          program.AddRule(snapshot_rule)
+          need_snapshots = True
+        else:
+          program.AddRule(rule)
+        if t in self.direct_dependency and not snapshot_rule:
+          needs_building += [t]
         program.AddRule(self.WrapFacts(fact_table_to_build, rule, dimensions_domain_rule))
         need_dimensions_domain = True
       elif fact_table_to_build in self.union_info:
@@ -357,30 +429,14 @@ class Olap:
     if need_dimensions_domain:
       program.AddRule(dimensions_domain_rule
                       )
-    def ColumnName(predicate_call_str):
-      return self.QuotedField(
-        predicate_call_str.replace('(', '<').replace(')', '>').replace('"', "'").replace('"', "'"))
+    if need_snapshots:
+      program.AddRule(self.materializer.AttachRule())
     # Assembling all the measures together.
-    measures_args = {ColumnName(m): avatar.Variable(self.ColumnName(m))
+    measures_args = {self.ReportColumnName(m): avatar.Variable(self.ColumnName(m))
                      for m in self.measures}
-    dimensions_args = {ColumnName(d): avatar.Variable(self.ColumnName(d))
+    dimensions_args = {self.ReportColumnName(d): avatar.Variable(self.ColumnName(d))
                        for d in self.dimensions}
-    if self.limit >= 0:
-      program.AddRule(avatar.Predicate('@Limit')(
-        avatar.Literal('Report'), avatar.Literal(self.limit)) << None)
-    if self.order:
-      def DecorateOrder(s):
-        for suffix in ['asc', 'desc']:
-          if s.endswith(suffix):
-            direction = suffix
-            s = s.removesuffix(' ' + suffix)
-            break
-        else:
-          direction = 'asc'
-        return ColumnName(s) + ' ' + direction
-      program.AddRule(avatar.Predicate('@OrderBy')(
-        avatar.Literal('Report'), *map(lambda x: avatar.Literal(DecorateOrder(x)),
-                                       self.order)) << None)
+    self.AddOrderAndLimit(program)
     head = avatar.Predicate('Report')(**(dimensions_args | measures_args))
     body = avatar.Conjunction([])
     for rule in rules_for_measures:
@@ -392,21 +448,182 @@ class Olap:
     program.AddRule(rule)
     return program
 
-  def GetFullLogicProgram(self):
-    base_program = open(self.config['logica_program']).read()
-    incremental_program = self.GetLogicProgram()
+  def GetFullLogicProgram(self, incremental_program=None):
+    base_program, unused_base_rules = ParsedProgram(self.config['logica_program'])
+    incremental_program = incremental_program or self.GetLogicProgram()
     program = base_program + ';\n' + str(incremental_program)
     return program
 
   def GetSQL(self):
-    program = self.GetFullLogicProgram()
-
-    print(program)
-    rules = parse.ParseFile(program)['rule']
+    incremental_program = self.GetLogicProgram()
+    print(self.GetFullLogicProgram(incremental_program))
+    return self.CompileSQL(incremental_program)
+
+  def CompileSQL(self, incremental_program):
+    unused_base_program, base_rules = ParsedProgram(self.config['logica_program'])
+    # Compiler is given its own copy of the shared base rules, as Logica does
+    # not promise to leave rules intact. Copying costs ~1% of compilation.
+    rules = (copy.deepcopy(base_rules) +
+             parse.ParseFile(str(incremental_program))['rule'])
     logic_program = universe.LogicaProgram(rules)
+    self.engine = logic_program.annotations.Engine()
     sql = logic_program.FormattedPredicateSql('Report')
     return sql
 
+
+parsed_programs = caching.LruCache(16)
+
+
+def ParsedProgram(filename):
+  """Text and parsed rules of a Logica program, parsed once per file content."""
+  key = (filename, caching.FileFingerprint(filename))
+  result = parsed_programs.Get(key)
+  if result is None:
+    with open(filename) as program_file:
+      program = program_file.read()
+    result = (program, parse.ParseFile(program)['rule'])
+    parsed_programs.Put(key, result)
+  return result
+
+
+def ProgramEngine(config):
+  """Logica engine of the program of the config, None if there is no program."""
+  if not os.path.exists(config.get('logica_program', '')):
+    return None
+  unused_program, rules = ParsedProgram(config['logica_program'])
+  return universe.Annotations(copy.deepcopy(rules), {}).Engine()
+
+
+def CalledPredicates(syntax):
+  """Names of predicates called anywhere in the parsed syntax."""
+  if isinstance(syntax, dict):
+    result = set()
+    if 'predicate_name' in syntax.get('call', {}):
+      result.add(syntax['call']['predicate_name'])
+    for value in syntax.values():
+      result |= CalledPredicates(value)
+    return result
+  if isinstance(syntax, list):
+    return set().union(*map(CalledPredicates, syntax))
+  return set()
+
+
+def SingleValuedDimensions(config):
+  """Names of dimension predicates having exactly one value for each fact.
+
+  Dimensions may declare it with single_valued. Otherwise a dimension is
+  single-valued if it is a constant, or if it is defined by one rule without
+  body calling no predicates of the program, e.g. State(fact) = fact.state.
+  Dimensions like CumulativeYear, mapping a fact to a range of values, are
+  not single-valued.
+  """
+  rules = []
+  if os.path.exists(config.get('logica_program', '')):
+    unused_program, rules = ParsedProgram(config['logica_program'])
+  rules_of_predicate = collections.defaultdict(list)
+  for rule in rules:
+    rules_of_predicate[rule['head']['predicate_name']].append(rule)
+  result = set()
+  for d in config['dimensions']:
+    name = d['function']['predicate_name']
+    if 'single_valued' in d:
+      single_valued = d['single_valued']
+    elif 'constant' in d:
+      single_valued = True
+    else:
+      single_valued = (
+          len(rules_of_predicate[name]) == 1 and
+          'body' not in rules_of_predicate[name][0] and
+          not (CalledPredicates(rules_of_predicate[name][0]['head']) &
+               set(rules_of_predicate)))
+    if single_valued:
+      result.add(name)
+  return result
+
+
+class ParsedPredicateCall(collections.namedtuple(
+    'ParsedPredicateCall', ['expression', 'predicate_name', 'term'])):
+  """Predicate call string parsed once, expression is frozen."""
+
+  def Term(self):
+    # Calling avatar.PredicateCall modifies its positional arguments, so every
+    # user gets a copy of the term.
+    return avatar.PredicateCall(self.term.predicate_name,
+                                list(self.term.positional_args),
+                                dict(self.term.named_args))
+
+
+parsed_predicate_calls = caching.LruCache(4096)
+
+
+def ParsePredicateCall(predicate_call):
+  """Parsed predicate call, shared by Olap of all requests."""
+  result = parsed_predicate_calls.Get(predicate_call)
+  if result is None:
+    expression = parse.ParseExpression(
+        parse.HeritageAwareString(predicate_call))
+    assert 'call' in expression, expression
+    result = ParsedPredicateCall(
+        expression=schema.Freeze(expression),
+        predicate_name=expression['call']['predicate_name'],
+        term=avatar.LogicalTerm.FromSyntax(expression))
+    parsed_predicate_calls.Put(predicate_call, result)
+  return result
+
+
+def WithoutHeritage(syntax):
+  """Parsed syntax without the source text of its expressions."""
+  if isinstance(syntax, dict):
+    return {k: WithoutHeritage(v) for k, v in syntax.items()
+            if k != 'expression_heritage'}
+  if isinstance(syntax, (list, tuple)):
+    return [WithoutHeritage(v) for v in syntax]
+  return syntax
+
+
+def CanonicalPredicateCall(predicate_call):
+  """Parsed predicate call as JSON, same for calls differing in spacing only.
+
+  String literals are kept as they are. Calls that do not parse are read
+  with single quotes replaced by double ones, as Olap reads all calls.
+  """
+  for text in [predicate_call, predicate_call.replace("'", '"')]:
+    try:
+      expression = ParsePredicateCall(text).expression
+    except parse.ParsingException:
+      continue
+    return json.dumps(WithoutHeritage(expression), sort_keys=True)
+  return predicate_call
+
+
+def CanonicalOrder(order):
+  for direction in [' asc', ' desc']:
+    if order.endswith(direction):
+      return CanonicalPredicateCall(order.removesuffix(direction)) + direction
+  return CanonicalPredicateCall(order)
+
+
+def CanonicalRequest(request):
+  """Key identifying everything in the request that affects the plan.
+
+  Filters are a conjunction, so their order does not matter. Order of measures
+  and dimensions defines the columns of the report, so it is kept.
+  """
+  limit = request.get('limit', -1)
+  if limit is None:
+    limit = -1
+  return json.dumps({
+      'measures': [CanonicalPredicateCall(c)
+                   for c in request.get('measures') or []],
+      'dimensions': [CanonicalPredicateCall(c)
+                     for c in request.get('dimensions') or []],
+      'filters': sorted({CanonicalPredicateCall(c)
+                         for c in request.get('filters') or []}),
+      'order': [CanonicalOrder(c) for c in request.get('order') or []],
+      'limit': limit
+  }, sort_keys=True)
+
+
 def Hash(s):
   return abs(int(hashlib.md5(str(s).encode()).hexdigest()[:16], 16) - (1 << 63))
 
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of keys of plans compiled for requests."""
+
+import unittest
+
+import olap
+
+
+def Request(filters, order=None):
+  return {'measures': ['NumberOfBabies()'], 'dimensions': ['State()'],
+          'filters': filters, 'order': order or [], 'limit': -1}
+
+
+class CanonicalRequestTest(unittest.TestCase):
+
+  def testKeepsQuotesInsideStringLiterals(self):
+    self.assertNotEqual(
+        olap.CanonicalRequest(Request(['NameIs(name: "O\'Brien")'])),
+        olap.CanonicalRequest(Request(["NameIs(name: 'O\"Brien')"])))
+
+  def testIgnoresSpacingAndOrderOfFilters(self):
+    self.assertEqual(
+        olap.CanonicalRequest(Request(['StateIn(states: ["NY", "WA"])',
+                                       'YearIs(year: 2000)'],
+                                      ['State() desc'])),
+        olap.CanonicalRequest(Request(['YearIs(year:2000)',
+                                       'StateIn(states: ["NY","WA"])'],
+                                      ['State( ) desc'])))
+
+  def testReadsSingleQuotesAsDoubleOnes(self):
+    self.assertEqual(
+        olap.CanonicalRequest(Request(["NameIs(name: 'Mary')"])),
+        olap.CanonicalRequest(Request(['NameIs(name: "Mary")'])))
+    self.assertNotEqual(
+        olap.CanonicalRequest(Request(['NameIs(name: "Mary")'])),
+        olap.CanonicalRequest(Request(['NameIs(name: "Maria")'])))
+
+
+if __name__ == '__main__':
+  unittest.main()
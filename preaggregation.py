@@ -0,0 +1,370 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pre-aggregated summary tables chosen from the log of requests.
+
+Requests are logged as views: the set of their dimensions, without the
+constant ones, and their filters. Views to pre-aggregate are chosen
+greedily over the lattice of logged views and their unions, taking the
+view with the largest benefit per row until the storage budget is used up.
+Benefit of a view is the number of rows that logged requests would no
+longer read, the same as in "Implementing Data Cubes Efficiently" by
+Harinarayan, Rajaraman and Ullman.
+
+Summary table of a view has all measures of the default fact table that
+declare their rollup, grouped by the dimensions of the view. A request
+with the filters of a view, measures from the summary table and dimensions
+among the dimensions of the view, including all multi-valued ones, is
+computed from the smallest such summary table.
+
+Config field preaggregation_budget_rows turns pre-aggregation on, summary
+tables are rebuilt every preaggregation_refresh_seconds in
+preaggregation_database. Summary tables are built for SQLite engine only.
+"""
+
+import collections
+import threading
+import time
+import traceback
+
+import caching
+import connection_pool
+import materialize
+import olap
+import rollup
+
+from logica.tools import avatar
+
+
+PREAGGREGATES_DATABASE_NAME = 'preaggregates'
+
+# Logica aggregating function rolling up each kind of measure.
+ROLLUP_AGGREGATIONS = {
+  'sum': 'Sum',
+  'count': 'Sum',
+  'min': 'Min',
+  'max': 'Max'
+}
+
+
+# Multi-valued dimensions of a view, e.g. CumulativeYear, put a fact into
+# several groups, so requests dropping them can not be rolled up from it.
+View = collections.namedtuple(
+    'View', ['dimensions', 'filters', 'multi_valued_dimensions'],
+    defaults=[()])
+
+
+def Covers(view, query):
+  return (view.filters == query.filters and
+          set(query.dimensions) <= set(view.dimensions) and
+          set(view.multi_valued_dimensions) <= set(query.dimensions))
+
+
+def CandidateViews(frequencies, max_candidates):
+  """Logged views and unions of views with the same filters."""
+  candidates = sorted(frequencies, key=lambda v: -frequencies[v])
+  candidates = candidates[:max_candidates]
+  i = 0
+  while i < len(candidates) and len(candidates) < max_candidates:
+    for other in candidates[:i]:
+      if other.filters != candidates[i].filters:
+        continue
+      union = View(tuple(sorted(set(other.dimensions) |
+                                set(candidates[i].dimensions))),
+                   other.filters,
+                   tuple(sorted(set(other.multi_valued_dimensions) |
+                                set(candidates[i].multi_valued_dimensions))))
+      if union not in candidates and len(candidates) < max_candidates:
+        candidates.append(union)
+    i += 1
+  return candidates
+
+
+def SelectViews(frequencies, sizes, fact_counts, budget_rows):
+  """Greedy selection of views to pre-aggregate.
+
+  Args:
+    frequencies: Number of logged requests of each view.
+    sizes: Number of rows of summary table of each candidate view.
+    fact_counts: Number of facts passing the filters of each view.
+    budget_rows: Total number of rows of the selected summary tables.
+  Returns:
+    List of selected views, in the order of selection.
+  """
+  selected = []
+  used_rows = 0
+  def Cost(query):
+    return min([fact_counts[query.filters]] +
+               [sizes[v] for v in selected if Covers(v, query)])
+  costs = {q: Cost(q) for q in frequencies}
+  while True:
+    best_view, best_score = None, 0
+    for view, size in sizes.items():
+      if view in selected or used_rows + size > budget_rows:
+        continue
+      benefit = sum(frequency * max(0, costs[q] - size)
+                    for q, frequency in frequencies.items()
+                    if Covers(view, q))
+      score = benefit / max(size, 1)
+      if score > best_score:
+        best_view, best_score = view, score
+    if best_view is None:
+      return selected
+    selected.append(best_view)
+    used_rows += sizes[best_view]
+    costs = {q: Cost(q) for q in frequencies}
+
+
+class SummaryTable:
+  def __init__(self, view, table, columns, size):
+    self.view = view
+    self.table = table
+    # Maps predicate call of each dimension and measure to column name.
+    self.columns = columns
+    self.size = size
+
+
+class Preaggregates:
+  """Log of requests and summary tables built for them.
+
+  Summary tables of a previous refresh are dropped one refresh later, so
+  that programs compiled before the refresh can still run.
+  """
+
+  def __init__(self, config, model, database=None, budget_rows=100000,
+               refresh_seconds=600, max_candidates=64, max_logged_views=1024,
+               on_refresh=None):
+    self.config = config
+    self.model = model
+    self.database = database or materialize.DefaultDatabase(
+        config, 'preaggregates')
+    self.budget_rows = budget_rows
+    self.refresh_seconds = refresh_seconds
+    self.max_candidates = max_candidates
+    self.max_logged_views = max_logged_views
+    self.on_refresh = on_refresh
+    self.measures = RollupMeasures(config, model)
+    self.pool = connection_pool.ConnectionPool()
+    self.frequencies = collections.Counter()
+    # Maps view to SummaryTable.
+    self.summary_tables = {}
+    self.retired_tables = []
+    self.generation = 0
+    # Summary tables are built for SQLite engine only.
+    self.supported = olap.ProgramEngine(config) == 'sqlite'
+    self.lock = threading.Lock()
+    self.refresh_lock = threading.Lock()
+    self.refresher = None
+    self.routed = 0
+    self.builds = 0
+    self.failures = 0
+
+  def RequestView(self, o):
+    """View of the Olap request, None if summary tables can not answer it."""
+    columns = o.dimensions + o.measures
+    if len(set(columns)) != len(columns):
+      return None
+    if not set(o.measures) <= set(self.measures):
+      return None
+    constants = rollup.DimensionConstants(o)
+    dimensions = tuple(sorted({d for d in o.dimensions if d not in constants}))
+    return View(dimensions, tuple(sorted(set(o.filters))),
+                tuple(d for d in dimensions if o.CalledPredicate(d) not in
+                      o.model.single_valued_dimensions))
+
+  def Log(self, o):
+    view = self.RequestView(o)
+    if view is None:
+      return
+    with self.lock:
+      if (view in self.frequencies or
+          len(self.frequencies) < self.max_logged_views):
+        self.frequencies[view] += 1
+
+  def CoveringTable(self, o):
+    """Smallest summary table answering the request, or None."""
+    if not self.supported:
+      return None
+    view = self.RequestView(o)
+    if view is None:
+      return None
+    with self.lock:
+      tables = [t for t in self.summary_tables.values() if Covers(t.view, view)]
+    if not tables:
+      return None
+    return min(tables, key=lambda t: t.size)
+
+  def RoutedProgram(self, o):
+    """Program computing the request from a summary table, or None."""
+    summary_table = self.CoveringTable(o)
+    if summary_table is None:
+      return None
+    rollups = rollup.MeasureRollups(o)
+    constants = rollup.DimensionConstants(o)
+    head_args = {}
+    body_args = {}
+    for d in o.dimensions:
+      if d in constants:
+        head_args[o.ReportColumnName(d)] = avatar.Literal(constants[d])
+      else:
+        column = summary_table.columns[d]
+        head_args[o.ReportColumnName(d)] = avatar.Variable(column)
+        body_args[column] = avatar.Variable(column)
+    for m in o.measures:
+      column = summary_table.columns[m]
+      aggregation = ROLLUP_AGGREGATIONS[rollups[o.CalledPredicate(m)]]
+      head_args[o.ReportColumnName(m)] = avatar.Aggregation(
+          aggregation, avatar.Variable(column))
+      body_args[column] = avatar.Variable(column)
+    program = avatar.Program([])
+    program.AddRule(avatar.Predicate('@AttachDatabase')(
+        avatar.Literal(PREAGGREGATES_DATABASE_NAME),
+        avatar.Literal(self.database)) << None)
+    o.AddOrderAndLimit(program)
+    rule = +avatar.Predicate('Report')(**head_args) << avatar.Predicate(
+        PREAGGREGATES_DATABASE_NAME + '.' + summary_table.table)(**body_args)
+    rule.comment_before_rule = 'Rolling up pre-aggregated %s.' % (
+        ', '.join(summary_table.view.dimensions) or 'total')
+    program.AddRule(rule)
+    with self.lock:
+      self.routed += 1
+    return program
+
+  def SummaryOlap(self, view, measures=None):
+    request = {'measures': measures or self.measures,
+               'dimensions': list(view.dimensions),
+               'filters': list(view.filters),
+               'order': [],
+               'limit': -1}
+    return olap.Olap(self.config, request, self.model)
+
+  def Run(self, sql):
+    with self.pool.Connection() as connection:
+      return connection_pool.RunSqlScript(connection, sql)
+
+  def ViewSizes(self, views):
+    """Number of rows of summary table of each view.
+
+    Groups of views with the same filters are counted from one report by
+    all of their dimensions.
+    """
+    sizes = {}
+    for filters in {v.filters for v in views}:
+      group = [v for v in views if v.filters == filters]
+      finest = View(tuple(sorted(set().union(*(v.dimensions for v in group)))),
+                    filters)
+      o = self.SummaryOlap(finest, self.measures[:1])
+      sql = o.CompileSQL(o.GetLogicProgram())
+      positions = [[finest.dimensions.index(d) for d in v.dimensions]
+                   for v in group]
+      distinct_rows = [set() for v in group]
+      with self.pool.Connection() as connection:
+        for row in connection_pool.ExecuteSqlScript(connection, sql):
+          for rows, row_positions in zip(distinct_rows, positions):
+            rows.add(tuple(row[i] for i in row_positions))
+      sizes.update(zip(group, map(len, distinct_rows)))
+    return sizes
+
+  def FactCount(self, filters):
+    o = self.SummaryOlap(View((), filters))
+    fact = avatar.Variable('fact')
+    head = +avatar.Predicate('Report')(
+        num_facts=avatar.Aggregation('Sum', avatar.Literal(1)))
+    body = avatar.Predicate(o.default_fact_table)(fact) & avatar.Conjunction(
+        [o.AsPredicateCall(f)(fact) for f in filters])
+    program = avatar.Program([])
+    program.AddRule(head << body)
+    unused_header, rows = self.Run(o.CompileSQL(program))
+    return rows[0][0] if rows else 0
+
+  def Advise(self):
+    """Views to pre-aggregate and sizes of candidate views."""
+    with self.lock:
+      frequencies = dict(self.frequencies)
+    candidates = CandidateViews(frequencies, self.max_candidates)
+    sizes = self.ViewSizes(candidates)
+    fact_counts = {f: self.FactCount(f) for f in {v.filters for v in candidates}}
+    return SelectViews(frequencies, sizes, fact_counts, self.budget_rows), sizes
+
+  def Build(self, view, generation):
+    o = self.SummaryOlap(view)
+    sql = o.CompileSQL(o.GetLogicProgram())
+    header, rows = self.Run(sql)
+    calls = o.dimensions + o.measures
+    columns = {c: o.ColumnName(c) for c in calls}
+    table = 'summary_%d_%s' % (generation, caching.Fingerprint(repr(view))[:12])
+    materialize.StoreTable(self.database, table,
+                           [columns[c] for c in calls], rows)
+    return SummaryTable(view, table, columns, len(rows))
+
+  def Refresh(self):
+    """Chooses views from the log and rebuilds their summary tables."""
+    if not self.supported or not self.measures:
+      return
+    with self.refresh_lock:
+      try:
+        views, unused_sizes = self.Advise()
+        generation = self.generation + 1
+        summary_tables = {v: self.Build(v, generation) for v in views}
+      except Exception:
+        print('Failure of building summary tables:')
+        print(traceback.format_exc())
+        with self.lock:
+          self.failures += 1
+        return
+      with self.lock:
+        dropped_tables = self.retired_tables
+        self.retired_tables = [t.table for t in self.summary_tables.values()]
+        self.summary_tables = summary_tables
+        self.generation = generation
+        self.builds += len(summary_tables)
+      materialize.DropTables(self.database, dropped_tables)
+      if self.on_refresh:
+        self.on_refresh()
+
+  def Start(self):
+    """Starts refreshing summary tables in the background."""
+    if not self.supported:
+      print('Summary tables are built for SQLite engine only, not for %s.' %
+            olap.ProgramEngine(self.config))
+      return
+    def RefreshForever():
+      while True:
+        time.sleep(self.refresh_seconds)
+        self.Refresh()
+    self.refresher = threading.Thread(target=RefreshForever, daemon=True)
+    self.refresher.start()
+
+  def Stats(self):
+    with self.lock:
+      return {'logged_views': len(self.frequencies),
+              'logged_requests': sum(self.frequencies.values()),
+              'summary_tables': len(self.summary_tables),
+              'summary_rows': sum(t.size for t in self.summary_tables.values()),
+              'budget_rows': self.budget_rows,
+              'routed': self.routed,
+              'builds': self.builds,
+              'failures': self.failures}
+
+
+def RollupMeasures(config, model):
+  """Calls of measures of default fact table that declare their rollup."""
+  return [m['aggregating_function']['predicate_name'] + '()'
+          for m in config['measures']
+          if m.get('rollup') in ROLLUP_AGGREGATIONS and
+          not m['aggregating_function'].get('parameters') and
+          model.fact_table_of_measure[m['aggregating_function']['predicate_name']] ==
+          model.default_fact_table]
@@ -0,0 +1,77 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of choosing summary tables for requests."""
+
+import json
+import unittest
+
+import olap
+import preaggregation
+
+
+class PreaggregatesTest(unittest.TestCase):
+
+  def setUp(self):
+    with open('examples/baby_names/baby_names.json') as f:
+      self.config = json.load(f)
+    self.model = olap.CompiledOlapModel(self.config)
+    self.preaggregates = preaggregation.Preaggregates(
+        self.config, self.model, database=':memory:')
+
+  def RequestView(self, dimensions):
+    return self.preaggregates.RequestView(olap.Olap(
+        self.config, {'measures': ['NumberOfBabies()'],
+                      'dimensions': dimensions,
+                      'filters': []}, self.model))
+
+  def testViewCoversCoarserRequest(self):
+    view = self.RequestView(['State()', 'Year()'])
+    self.assertTrue(preaggregation.Covers(view, self.RequestView(['State()'])))
+    self.assertTrue(preaggregation.Covers(view, self.RequestView([])))
+
+  def testViewDoesNotRollUpCumulativeDimension(self):
+    cumulative_year = 'CumulativeYear(to_year: 2000)'
+    view = self.RequestView(['State()', cumulative_year])
+    self.assertEqual(view.multi_valued_dimensions, (cumulative_year,))
+    self.assertFalse(preaggregation.Covers(view, self.RequestView(['State()'])))
+    self.assertTrue(preaggregation.Covers(
+        view, self.RequestView([cumulative_year])))
+
+  def testUnionKeepsMultiValuedDimensions(self):
+    cumulative_year = 'CumulativeYear(to_year: 2000)'
+    frequencies = {self.RequestView(['State()', cumulative_year]): 2,
+                   self.RequestView(['Gender()']): 1}
+    candidates = preaggregation.CandidateViews(frequencies, 8)
+    [union] = [v for v in candidates if v not in frequencies]
+    self.assertEqual(union.multi_valued_dimensions, (cumulative_year,))
+    self.assertFalse(preaggregation.Covers(
+        union, self.RequestView(['Gender()'])))
+
+  def testDoesNotBuildSummaryTablesForOtherEngines(self):
+    # Baby names program runs on BigQuery.
+    self.assertFalse(self.preaggregates.supported)
+    self.preaggregates.Log(olap.Olap(
+        self.config, {'measures': ['NumberOfBabies()'],
+                      'dimensions': ['State()'],
+                      'filters': []}, self.model))
+    self.preaggregates.Refresh()
+    self.assertEqual(self.preaggregates.Stats()['failures'], 0)
+    self.assertEqual(self.preaggregates.summary_tables, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Answering requests by rolling up cached reports of finer granularity.
+
+Measures declare in the config how their values combine over groups, e.g.
+{"aggregating_function": {"predicate_name": "NumCars"}, "rollup": "count"},
+and dimensions that are the same for all facts declare their value, e.g.
+{"function": {"predicate_name": "Total"}, "constant": "total"}.
+Reports are rolled up only over single-valued dimensions, see
+olap.SingleValuedDimensions.
+"""
+
+import collections
+import functools
+import threading
+import time
+
+import caching
+import fusion
+
+
+def Sum(values):
+  values = [v for v in values if v is not None]
+  return sum(values) if values else None
+
+
+def Min(values):
+  values = [v for v in values if v is not None]
+  return min(values) if values else None
+
+
+def Max(values):
+  values = [v for v in values if v is not None]
+  return max(values) if values else None
+
+
+# Counts of groups are added up to count their union.
+ROLLUP_FUNCTIONS = {
+  'sum': Sum,
+  'count': Sum,
+  'min': Min,
+  'max': Max
+}
+
+
+def ColumnName(predicate_call):
+  """Name of report column of the predicate call, as Olap names it."""
+  return predicate_call.replace('(', '<').replace(')', '>').replace('"', "'")
+
+
+class CachedReport:
+  def __init__(self, o, logic_program, sql, data, expires_at):
+    self.dimensions = list(o.dimensions)
+    self.measures = list(o.measures)
+    self.filters = frozenset(o.filters)
+    self.logic_program = logic_program
+    self.sql = sql
+    self.header = list(data[0])
+    self.rows = [tuple(row) for row in data[1:]]
+    self.expires_at = expires_at
+    self.database_fingerprint = caching.DatabaseFingerprint(sql)
+    self.columns = self.dimensions + self.measures
+
+
+class AggregateCache:
+  """Reports of requests without limit, also answering coarser requests.
+
+  A request is answered from a cached report with the same filters if the
+  report has all of its measures, and each of its dimensions is either a
+  dimension of the report or a constant. If the request drops dimensions
+  of the report, they must be single-valued and all of its measures must
+  declare their rollup.
+  Reports expire after ttl_seconds or when the database file changes.
+  """
+
+  def __init__(self, max_reports=64, max_rows=100000, ttl_seconds=300):
+    self.max_reports = max_reports
+    self.max_rows = max_rows
+    self.ttl_seconds = ttl_seconds
+    self.reports = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def Put(self, o, logic_program, sql, data):
+    if not data or o.limit >= 0 or len(data) - 1 > self.max_rows:
+      return
+    if len(set(o.dimensions + o.measures)) != len(o.dimensions + o.measures):
+      return
+    report = CachedReport(o, logic_program, sql, data,
+                          time.monotonic() + self.ttl_seconds)
+    key = (tuple(report.dimensions), tuple(report.measures), report.filters)
+    with self.lock:
+      self.reports[key] = report
+      self.reports.move_to_end(key)
+      while len(self.reports) > self.max_reports:
+        self.reports.popitem(last=False)
+
+  def Get(self, o):
+    """Logic program, SQL and data answering the request, or None."""
+    with self.lock:
+      reports = list(reversed(self.reports.values()))
+    now = time.monotonic()
+    for report in reports:
+      if report.expires_at < now:
+        continue
+      if self.CanAnswer(o, report):
+        if caching.DatabaseFingerprint(report.sql) != report.database_fingerprint:
+          continue
+        with self.lock:
+          self.hits += 1
+        # Request was not compiled, so it is described by commented out
+        # program and SQL of the report it is computed from.
+        note = ('Request was computed in memory from the cached report of '
+                'dimensions %s and measures %s:' % (
+                    ', '.join(report.dimensions) or 'none',
+                    ', '.join(report.measures)))
+        return (Commented(report.logic_program, '# ', note),
+                Commented(report.sql, '-- ', note),
+                self.Answer(o, report))
+    with self.lock:
+      self.misses += 1
+    return None
+
+  def CanAnswer(self, o, report):
+    if frozenset(o.filters) != report.filters:
+      return False
+    if not set(o.measures) <= set(report.measures):
+      return False
+    if any(fusion.OrderKey(order)[0] not in o.dimensions + o.measures
+           for order in o.order):
+      return False
+    constants = DimensionConstants(o)
+    if any(d not in report.dimensions and d not in constants
+           for d in o.dimensions):
+      return False
+    rolled_up = set(report.dimensions) - set(o.dimensions)
+    if not rolled_up:
+      return True
+    # Facts are in several groups of a multi-valued dimension, e.g.
+    # CumulativeYear, so rolling it up would count them several times.
+    if any(o.CalledPredicate(d) not in o.model.single_valued_dimensions
+           for d in rolled_up):
+      return False
+    # Fact tables of measures lack their ephemeral dimensions, e.g. population
+    # is the same for every Device, so rolling one up would repeat it.
+    if any(o.CalledPredicate(d) in o.table_to_ephemeral_dimensions[
+               o.fact_table_of_measure[o.CalledPredicate(m)]]
+           for d in rolled_up for m in o.measures):
+      return False
+    rollups = MeasureRollups(o)
+    return all(rollups.get(o.CalledPredicate(m)) in ROLLUP_FUNCTIONS
+               for m in o.measures)
+
+  def Answer(self, o, report):
+    """[header] + rows of the request computed from the report."""
+    constants = DimensionConstants(o)
+    rollups = MeasureRollups(o)
+    kept_dimensions = [d for d in report.dimensions if d in o.dimensions]
+    key_positions = [report.columns.index(d) for d in kept_dimensions]
+    groups = collections.OrderedDict()
+    for row in report.rows:
+      key = tuple(row[i] for i in key_positions)
+      groups.setdefault(key, []).append(row)
+    rolled_up = set(report.dimensions) - set(o.dimensions)
+    measures = [(report.columns.index(m),
+                 ROLLUP_FUNCTIONS[rollups[o.CalledPredicate(m)]]
+                 if rolled_up else None)
+                for m in o.measures]
+    columns = o.dimensions + o.measures
+    rows = []
+    for key, group_rows in groups.items():
+      group = dict(zip(kept_dimensions, key))
+      row = [group[d] if d in group else constants[d] for d in o.dimensions]
+      for i, rollup_function in measures:
+        if rollup_function:
+          row.append(rollup_function([r[i] for r in group_rows]))
+        else:
+          # Groups are the same as in the report.
+          [r] = group_rows
+          row.append(r[i])
+      rows.append(row)
+    if rolled_up:
+      # Reports are ordered by their dimensions unless asked otherwise.
+      for i in reversed(range(len(o.dimensions))):
+        rows.sort(key=functools.partial(fusion.SortKey, i))
+    header = [report.header[report.columns.index(c)] if c in report.columns
+              else ColumnName(c)
+              for c in columns]
+    return [header] + fusion.OrderAndLimit(columns, rows, o.request)
+
+  def Clear(self):
+    with self.lock:
+      self.reports.clear()
+
+  def Stats(self):
+    with self.lock:
+      return {'size': len(self.reports),
+              'max_size': self.max_reports,
+              'hits': self.hits,
+              'misses': self.misses}
+
+
+def Commented(text, prefix, note):
+  """Note and the text, with each line commented out by the prefix."""
+  return '\n'.join((prefix + line).rstrip()
+                   for line in [note, ''] + text.splitlines())
+
+
+def MeasureRollups(o):
+  return {m['aggregating_function']['predicate_name']: m.get('rollup')
+          for m in o.config['measures']}
+
+
+def DimensionConstants(o):
+  """Values of dimensions of the request that are constant."""
+  constant_of_predicate = {
+    d['function']['predicate_name']: d['constant']
+    for d in o.config['dimensions'] if 'constant' in d}
+  return {d: constant_of_predicate[o.CalledPredicate(d)]
+          for d in o.dimensions
+          if o.CalledPredicate(d) in constant_of_predicate}
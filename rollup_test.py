@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of answering requests from cached reports."""
+
+import json
+import unittest
+
+import olap
+import rollup
+
+
+def BabyNamesOlap(dimensions):
+  with open('examples/baby_names/baby_names.json') as f:
+    config = json.load(f)
+  return olap.Olap(config, {'measures': ['NumberOfBabies()'],
+                            'dimensions': dimensions,
+                            'filters': []})
+
+
+def ReachOlap(dimensions):
+  with open('examples/reach/reach.json') as f:
+    config = json.load(f)
+  for m in config['measures']:
+    if m['aggregating_function']['predicate_name'] == 'Population':
+      m['rollup'] = 'sum'
+  return olap.Olap(config, {'measures': ['Population()'],
+                            'dimensions': dimensions,
+                            'filters': []})
+
+
+class AggregateCacheTest(unittest.TestCase):
+
+  def Cache(self, o, rows):
+    cache = rollup.AggregateCache()
+    header = [rollup.ColumnName(c) for c in o.dimensions + o.measures]
+    cache.Put(o, 'Report() :- 1;', 'SELECT 1;', [header] + rows)
+    return cache
+
+  def testRollsUpSingleValuedDimension(self):
+    cache = self.Cache(BabyNamesOlap(['State()', 'Year()']),
+                       [('WA', 1999, 10), ('WA', 2000, 15), ('NY', 2000, 7)])
+    unused_program, unused_sql, data = cache.Get(BabyNamesOlap(['State()']))
+    self.assertEqual(data, [['State<>', 'NumberOfBabies<>'],
+                            ['NY', 7], ['WA', 25]])
+
+  def testDescribesRolledUpRequestByCommentedReport(self):
+    cache = self.Cache(BabyNamesOlap(['State()', 'Year()']),
+                       [('WA', 1999, 10)])
+    program, sql, unused_data = cache.Get(BabyNamesOlap(['State()']))
+    note = ('Request was computed in memory from the cached report of '
+            'dimensions State(), Year() and measures NumberOfBabies():')
+    self.assertEqual(program, '# %s\n#\n# Report() :- 1;' % note)
+    self.assertEqual(sql, '-- %s\n--\n-- SELECT 1;' % note)
+
+  def testDoesNotRollUpCumulativeDimension(self):
+    cumulative_year = 'CumulativeYear(to_year: 2000)'
+    # Babies of 1999 are counted in both cumulative years.
+    cache = self.Cache(BabyNamesOlap(['State()', cumulative_year]),
+                       [('WA', 1999, 10), ('WA', 2000, 15)])
+    self.assertIsNone(cache.Get(BabyNamesOlap(['State()'])))
+    unused_program, unused_sql, data = cache.Get(
+        BabyNamesOlap(['State()', cumulative_year]))
+    self.assertEqual(data[1:], [['WA', 1999, 10], ['WA', 2000, 15]])
+
+  def testDoesNotRollUpEphemeralDimension(self):
+    # PopulationData has no Device, so each device repeats the population.
+    cache = self.Cache(ReachOlap(['Gender()', 'Device()']),
+                       [('F', 'mobile', 100), ('F', 'desktop', 100)])
+    self.assertIsNone(cache.Get(ReachOlap(['Gender()'])))
+    cache = self.Cache(ReachOlap(['Gender()', 'Age()']),
+                       [('F', '18-24', 40), ('F', '25-34', 60)])
+    unused_program, unused_sql, data = cache.Get(ReachOlap(['Gender()']))
+    self.assertEqual(data[1:], [['F', 100]])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Latency benchmarks of LogicLM.
+# Usage:
+#   python3 run_benchmarks.py <benchmark> [config] [request] [repetitions]
+
+
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import columnar
+import connection_pool
+import fusion
+import olap
+import preaggregation
+import server
+import sqlite3_logica
+from logica.common import color
+from logica.common import sqlite3_logica as logica_sqlite3_logica
+
+
+def Timed(f, repetitions):
+  times = []
+  result = None
+  for _ in range(repetitions):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+      result = f()
+    times.append(time.perf_counter() - start)
+  return result, times
+
+
+def ShowTimes(name, times):
+  print('%-40s median %9.2f ms   min %9.2f ms   runs %d' % (
+      name, statistics.median(times) * 1000, min(times) * 1000, len(times)))
+
+
+def BenchmarkExecution(config, request, repetitions):
+  """Executing report with Logica from temp file vs in-process SQL."""
+  o = olap.Olap(config, request)
+  incremental_program = o.GetLogicProgram()
+  logic_program = o.GetFullLogicProgram(incremental_program)
+  with contextlib.redirect_stdout(io.StringIO()):
+    sql = o.CompileSQL(incremental_program)
+  assert o.engine == 'sqlite', 'In-process execution requires SQLite engine.'
+  pool = connection_pool.ConnectionPool()
+  logica_result, logica_times = Timed(
+      lambda: server.RunLogicProgram(logic_program), repetitions)
+  in_process_result, in_process_times = Timed(
+      lambda: server.RunSqlInProcess(sql, pool), repetitions)
+  assert list(logica_result[1]) == list(in_process_result[1]), (
+      'Execution paths disagree.')
+  ShowTimes('Temp file + run_in_terminal', logica_times)
+  ShowTimes('In-process on pooled connection', in_process_times)
+
+
+def BenchmarkParsing(config, request, repetitions):
+  """Parses of predicate calls and time of building the program per request."""
+  model = olap.CompiledOlapModel(config)
+  distinct_calls = {c for field in ['measures', 'dimensions', 'filters', 'order']
+                    for c in olap.GetPredicateCallsField(request, field)}
+  cache = olap.parsed_predicate_calls
+  def Run():
+    return olap.Olap(config, request, model).GetLogicProgram()
+  def Parses():
+    stats = cache.Stats()
+    return stats['misses'], stats['hits'] + stats['misses']
+  cache.Clear()
+  start_parses, start_lookups = Parses()
+  unused_program, cold_times = Timed(Run, 1)
+  cold_parses, cold_lookups = Parses()
+  unused_program, warm_times = Timed(Run, repetitions)
+  warm_parses, warm_lookups = Parses()
+  print('Distinct predicate calls in request: %d' % len(distinct_calls))
+  print('Uses of parsed calls per request: %d' % (cold_lookups - start_lookups))
+  print('Parses of first request: %d' % (cold_parses - start_parses))
+  print('Parses of %d repeated requests: %d' % (
+      repetitions, warm_parses - cold_parses))
+  ShowTimes('First request', cold_times)
+  ShowTimes('Repeated request', warm_times)
+
+
+def DashboardRequests(config, request):
+  """Requests of dashboard tiles, or one request per measure of the config."""
+  dashboard = config.get('dashboard') or {}
+  tiles = [tile
+           for chart in dashboard.get('dashboardCharts', [])
+           for tile in chart.get('dashboardChartContents', [])
+           if tile.get('measures')] if isinstance(dashboard, dict) else []
+  if tiles:
+    return tiles
+  return [request | {'measures': [m['aggregating_function']['predicate_name'] + '()'],
+                     'order': [], 'limit': -1}
+          for m in config['measures']]
+
+
+def FactTableScans(program):
+  return sum(rule.head.predicate_name.startswith('Consolidating')
+             for rule in program.rules)
+
+
+def BenchmarkFusion(config, request, repetitions):
+  """Fact table scans and time of dashboard requests with and without fusion."""
+  model = olap.CompiledOlapModel(config)
+  tiles = DashboardRequests(config, request)
+  groups = fusion.FuseRequests(config, model, tiles)
+  reports = []
+  for report, indices in groups:
+    if report:
+      reports.append(report.request)
+    else:
+      reports.extend(tiles[i] for i in indices)
+  def Compile(requests):
+    result = []
+    for r in requests:
+      o = olap.Olap(config, r, model)
+      program = o.GetLogicProgram()
+      with contextlib.redirect_stdout(io.StringIO()):
+        sql = o.CompileSQL(program)
+      result.append((program, sql, o.engine))
+    return result
+  separate = Compile(tiles)
+  fused = Compile(reports)
+  print('Requests: %d, queries without fusion: %d, with fusion: %d' % (
+      len(tiles), len(separate), len(fused)))
+  print('Fact table scans without fusion: %d, with fusion: %d' % (
+      sum(FactTableScans(p) for p, unused_sql, unused_engine in separate),
+      sum(FactTableScans(p) for p, unused_sql, unused_engine in fused)))
+  if any(engine != 'sqlite' for unused_program, unused_sql, engine in fused):
+    print('Execution is timed for SQLite engine only.')
+    return
+  pool = connection_pool.ConnectionPool()
+  def Run(plans):
+    return [server.RunSqlInProcess(sql, pool) for unused_program, sql, unused_engine in plans]
+  unused_result, separate_times = Timed(lambda: Run(separate), repetitions)
+  unused_result, fused_times = Timed(lambda: Run(fused), repetitions)
+  ShowTimes('Without fusion', separate_times)
+  ShowTimes('With fusion', fused_times)
+
+
+def PreaggregationWorkload(config, measures):
+  """Requests by each dimension and, less often, by each pair of them."""
+  dimensions = [d['function']['predicate_name'] + '()'
+                for d in config['dimensions']
+                if not d['function'].get('parameters') and 'constant' not in d]
+  requests = []
+  for repetition in range(3):
+    requests.extend({'measures': measures[:2], 'dimensions': [d], 'filters': []}
+                    for d in dimensions)
+  requests.extend({'measures': measures[:2], 'dimensions': list(pair),
+                   'filters': []}
+                  for pair in itertools.combinations(dimensions, 2))
+  return requests
+
+
+def BenchmarkPreaggregation(config, request, repetitions):
+  """Latency of requests computed from facts vs from summary tables."""
+  model = olap.CompiledOlapModel(config)
+  with tempfile.TemporaryDirectory() as directory:
+    preaggregates = preaggregation.Preaggregates(
+        config, model, os.path.join(directory, 'preaggregates.sqlite'),
+        budget_rows=config.get('preaggregation_budget_rows', 100000))
+    if not preaggregates.measures:
+      print('Config has no measures of default fact table declaring rollup.')
+      return
+    requests = PreaggregationWorkload(config, preaggregates.measures)
+    for r in requests:
+      preaggregates.Log(olap.Olap(config, r, model))
+    print('Logged requests: %d, distinct views: %d' % (
+        len(requests), len(preaggregates.frequencies)))
+    unused_result, refresh_times = Timed(preaggregates.Refresh, 1)
+    if not preaggregates.supported:
+      print('Summary tables are built for SQLite engine only.')
+      return
+    stats = preaggregates.Stats()
+    print('Summary tables: %d, rows: %d, budget: %d rows' % (
+        stats['summary_tables'], stats['summary_rows'], stats['budget_rows']))
+    for summary_table in preaggregates.summary_tables.values():
+      print('  %-50s %d rows' % (
+          ', '.join(summary_table.view.dimensions), summary_table.size))
+    ShowTimes('Choosing and building summary tables', refresh_times)
+    distinct_requests = [json.loads(r) for r in
+                         dict.fromkeys(json.dumps(r) for r in requests)]
+    def Compile(routing):
+      result = []
+      for r in distinct_requests:
+        o = olap.Olap(config, r, model, preaggregates=routing)
+        with contextlib.redirect_stdout(io.StringIO()):
+          result.append(o.CompileSQL(o.GetLogicProgram()))
+      return result
+    from_facts = Compile(None)
+    routed = Compile(preaggregates)
+    print('Requests computed from summary tables: %d of %d' % (
+        preaggregates.Stats()['routed'], len(distinct_requests)))
+    pool = connection_pool.ConnectionPool()
+    def Run(sqls):
+      return [server.RunSqlInProcess(sql, pool) for sql in sqls]
+    facts_result, facts_times = Timed(lambda: Run(from_facts), repetitions)
+    routed_result, routed_times = Timed(lambda: Run(routed), repetitions)
+    assert all(sorted(a[1], key=repr) == sorted(b[1], key=repr)
+               for a, b in zip(facts_result, routed_result)), (
+        'Summary tables disagree with facts.')
+    ShowTimes('From facts', facts_times)
+    ShowTimes('From summary tables', routed_times)
+
+
+def BenchmarkSerialization(config, request, repetitions):
+  """Encoding report data as JSON rows, JSON columns and Arrow stream."""
+  o = olap.Olap(config, request)
+  with contextlib.redirect_stdout(io.StringIO()):
+    sql = o.CompileSQL(o.GetLogicProgram())
+  assert o.engine == 'sqlite', 'In-process execution requires SQLite engine.'
+  header, rows = server.RunSqlInProcess(sql, connection_pool.ConnectionPool())
+  response = {'sql': sql, 'data': [header] + list(rows)}
+  formats = ['rows', 'columns']
+  if columnar.pyarrow is not None:
+    formats.append('arrow')
+  print('Report: %d columns, %d rows' % (len(header), len(rows)))
+  for result_format in formats:
+    (unused_content_type, body), times = Timed(
+        lambda: columnar.EncodeResponse(response, result_format), repetitions)
+    ShowTimes('%s (%d bytes)' % (result_format, len(body)), times)
+
+
+def BenchmarkArgMax(config, request, repetitions):
+  """ArgMin/ArgMax aggregates of Logica package vs LogicLM on 1M rows.
+
+  Config and request are not used, the table is synthetic.
+  """
+  num_rows = 1000000
+  rng = random.Random(0)
+  rows = [(i, rng.randrange(100), rng.random(), 'name%d' % rng.randrange(10**6))
+          for i in range(num_rows)]
+  connections = {}
+  for name, module in [('logica', logica_sqlite3_logica),
+                       ('logiclm', sqlite3_logica)]:
+    connection = sqlite3.connect(':memory:')
+    module.ExtendConnectionWithLogicaFunctions(connection)
+    connection.execute('CREATE TABLE T (id, category, score, name)')
+    connection.executemany('INSERT INTO T VALUES (?, ?, ?, ?)', rows)
+    connections[name] = connection
+  print('Table: %d rows' % num_rows)
+  queries = [
+    ('ArgMax limit 1', 'SELECT ArgMax(id, score, 1) FROM T'),
+    ('ArgMin limit 10', 'SELECT ArgMin(id, score, 10) FROM T'),
+    ('ArgMax limit 100 on text', 'SELECT ArgMax(id, name, 100) FROM T'),
+    ('ArgMax limit 3 by 100 groups',
+     'SELECT category, ArgMax(id, score, 3) FROM T GROUP BY category'),
+    # Values of 100 categories are tied, which rows win ties must agree.
+    ('ArgMin limit 10 on ties', 'SELECT ArgMin(name, category, 10) FROM T'),
+    ('ArgMax limit 3 on ties by 100 groups',
+     'SELECT category, ArgMax(name, category, 3) FROM T GROUP BY category'),
+  ]
+  for query_name, sql in queries:
+    results = {}
+    for name, connection in connections.items():
+      results[name], times = Timed(
+          lambda: connection.execute(sql).fetchall(), repetitions)
+      ShowTimes('%s, %s' % (query_name, name), times)
+    assert results['logica'] == results['logiclm'], (
+        'Aggregates disagree on %s.' % query_name)
+
+
+BENCHMARKS = {
+  'execution': BenchmarkExecution,
+  'parsing': BenchmarkParsing,
+  'fusion': BenchmarkFusion,
+  'preaggregation': BenchmarkPreaggregation,
+  'serialization': BenchmarkSerialization,
+  'argmax': BenchmarkArgMax,
+}
+
+# Config with its database in the repo, so benchmarks run out of the box.
+DEFAULT_CONFIG = 'examples/car_1/car_1.json'
+DEFAULT_REQUEST = {
+  'measures': ['NumCars()', 'AvgWeight()'],
+  'dimensions': ['Continent()', 'Year()'],
+  'filters': [],
+}
+
+
+def main(argv):
+  if len(argv) < 2 or argv[1] not in BENCHMARKS:
+    print('Usage: %s <%s> [config] [request] [repetitions]' % (
+        argv[0], '|'.join(BENCHMARKS)))
+    return
+  config_filename = argv[2] if len(argv) > 2 else DEFAULT_CONFIG
+  with open(config_filename) as f:
+    config = json.loads(f.read())
+  request = json.loads(argv[3]) if len(argv) > 3 else DEFAULT_REQUEST
+  repetitions = int(argv[4]) if len(argv) > 4 else 10
+  print(color.Format('{warning}Benchmark %s{end} on %s' % (
+      argv[1], config_filename)))
+  BENCHMARKS[argv[1]](config, request, repetitions)
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -1,16 +1,11 @@
-import sqlite3
-import duckdb
 import re
 import pandas as pd
 import os
 import sys
-import sqlite3_logica
-
-def run_query(sqlite_file_name, sql_file, sql_query):
-    # Connect to the database
-    conn = sqlite3.connect(sqlite_file_name)
-    sqlite3_logica.ExtendConnectionWithLogicaFunctions(conn)
+import connection_pool
+import duckdb_execution
 
+def apply_schema(conn, sql_file):
     cursor = conn.cursor()
 
     # Check if schema already exists
@@ -25,73 +20,109 @@ def run_query(sqlite_file_name, sql_file, sql_query):
         if not cursor.fetchone():
             print(f"Applying schema from {sql_file}")
             cursor.executescript(sql_script)
+    conn.commit()
 
-    df = pd.read_sql_query(sql_query, conn)
-    
+def get_pool(sqlite_file_name, sql_file):
+    """Pool of warm connections to the database, schema is applied once."""
+    return connection_pool.GetPool(
+        sqlite_file_name,
+        bootstrap_key=os.path.realpath(sql_file),
+        bootstrap=lambda conn: apply_schema(conn, sql_file))
 
-    conn.commit()
-    conn.close()
+def run_query(sqlite_file_name, sql_file, sql_query):
+    with get_pool(sqlite_file_name, sql_file).Connection() as conn:
+        df = pd.read_sql_query(sql_query, conn)
     return df
 
-def run_query_duckdb(sqlite_file_name, sql_file, sql_query):
+def database_name_of(sqlite_file_name):
+    return re.sub(r'\W+', '_', os.path.basename(sqlite_file_name).replace('.', '_'))
+
+def duckdb_type_of(declared_type):
+    """DuckDB type of a column by SQLite affinity of its declared type.
+
+    Columns of other declared types, e.g. DATE, keep the type that pandas
+    infers from their values.
+    """
+    declared_type = declared_type.upper()
+    if 'INT' in declared_type:
+        return 'BIGINT'
+    if any(t in declared_type for t in ('CHAR', 'CLOB', 'TEXT')):
+        return 'VARCHAR'
+    if any(t in declared_type for t in ('REAL', 'FLOA', 'DOUB', 'NUMERIC', 'DECIMAL')):
+        return 'DOUBLE'
+    return None
+
+def import_table_to_duckdb(database, conn, table):
+    """Copies the SQLite table into DuckDB with declared column types.
+
+    SQLite columns are dynamically typed, so values that do not convert to
+    the declared type become NULL.
+    """
+    df = pd.read_sql_query(f'SELECT * FROM "{table}"', conn)
+    columns = [(name, duckdb_type_of(declared_type)) for
+               (unused_cid, name, declared_type, *unused_rest) in
+               conn.execute(f'PRAGMA table_info("{table}")')]
+    select = ', '.join(
+        f'TRY_CAST("{name}" AS {duckdb_type}) AS "{name}"' if duckdb_type
+        else f'"{name}"' for name, duckdb_type in columns)
+    database.connection.register('imported_table', df)
+    try:
+        database.connection.execute(
+            f'CREATE TABLE "{table}" AS SELECT {select} FROM imported_table')
+    finally:
+        database.connection.unregister('imported_table')
+
+def bootstrap_duckdb(database, sqlite_file_name, sql_file, import_tables):
+    """Makes tables of the SQLite database visible to DuckDB by their names.
+
+    Tables are either imported into DuckDB columnar storage with their
+    declared types, or read from the attached SQLite file by views.
+    """
+    # Schema is applied to the SQLite file, same as for run_query.
+    with get_pool(sqlite_file_name, sql_file).Connection() as conn:
+        tables = [name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' "
+            "AND name NOT LIKE 'sqlite_%'")]
+        if import_tables:
+            for table in tables:
+                import_table_to_duckdb(database, conn, table)
+    if not import_tables:
+        database_name = database_name_of(sqlite_file_name)
+        database.Attach(database_name, sqlite_file_name,
+                        ' (TYPE sqlite, READ_ONLY)')
+        for table in tables:
+            database.connection.execute(
+                f'CREATE VIEW "{table}" AS SELECT * FROM {database_name}."{table}"')
+
+def get_duckdb(sqlite_file_name, sql_file, import_tables=False):
+    """Long-lived DuckDB database with tables of the SQLite database.
+
+    SQLite file is attached, or its tables are imported, once per process.
+    """
+    return duckdb_execution.GetDatabase(
+        (sqlite_file_name, import_tables),
+        bootstrap=lambda database: bootstrap_duckdb(
+            database, sqlite_file_name, sql_file, import_tables))
+
+def run_query_duckdb(sqlite_file_name, sql_file, sql_query, import_tables=False):
     """
-    Runs a SQL query on a DuckDB database, optionally applying a schema
-    from a SQL file if the tables don't exist in the attached SQLite database.
+    Runs a SQL query on a long-lived DuckDB database holding tables of the
+    SQLite database, applying the schema from a SQL file if they don't exist.
 
     Args:
         sqlite_file_name (str): The path to the SQLite database file.
         sql_file (str): The path to the SQL file containing the schema.
         sql_query (str): The SQL query to execute.
+        import_tables (bool): Whether to copy tables into DuckDB instead of
+            reading the attached SQLite file.
 
     Returns:
         pandas.DataFrame: The result of the SQL query as a pandas DataFrame.
     """
-    # Connect to an in-memory DuckDB database
-    conn = duckdb.connect(':memory:')
-    database_name = re.sub(r'\W+', '_', os.path.basename(sqlite_file_name).replace('.', '_')) # Sanitize db name
-
+    cursor = get_duckdb(sqlite_file_name, sql_file, import_tables).Cursor()
     try:
-        # Attach the SQLite database
-        conn.execute(f"ATTACH '{sqlite_file_name}' AS {database_name} (TYPE sqlite);")
-
-        # Check if schema already exists by querying the attached database's tables
-        with open(sql_file, 'r') as f:
-            sql_script = f.read()
-
-        table_names = re.findall(r'CREATE TABLE\s+"?(\w+)"?', sql_script, re.IGNORECASE)
-
-        if table_names:
-            first_table = table_names[0]
-            try:
-                # Check if the first table exists in the attached SQLite database
-                result = conn.execute(f"SELECT 1 FROM {database_name}.{first_table} LIMIT 1;").fetchone()
-                if result:
-                    print(f"Schema already exists in {sqlite_file_name}. Skipping schema application.")
-                else:
-                    print(f"Applying schema from {sql_file} to DuckDB")
-                    for statement in sql_script.split(';'):
-                        cleaned_statement = statement.strip()
-                        if cleaned_statement:
-                            try:
-                                conn.execute(cleaned_statement)
-                            except duckdb.ParserException as e:
-                                print(f"Error executing schema statement: {cleaned_statement}")
-                                print(f"Parser Error: {e}")
-            except duckdb.CatalogException:
-                print(f"Applying schema from {sql_file} to DuckDB (table check failed)")
-                for statement in sql_script.split(';'):
-                    cleaned_statement = statement.strip()
-                    if cleaned_statement:
-                        try:
-                            conn.execute(cleaned_statement)
-                        except duckdb.ParserException as e:
-                            print(f"Error executing schema statement: {cleaned_statement}")
-                            print(f"Parser Error: {e}")
-
-        # Run the query against the attached SQLite database
-        df = conn.execute(f"SELECT * FROM {database_name}.({sql_query})").fetchdf()
-
+        # Columns are converted to the DataFrame as a whole, not row by row.
+        df = cursor.execute(sql_query).fetchdf()
     finally:
-        conn.close()
-
-    return df
\ No newline at end of file
+        cursor.close()
+    return df
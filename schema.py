@@ -46,15 +46,26 @@ def List(x):
     'items': x
   }
 
+def Enum(values):
+  return {'enum': values}
+
 def Measure():
   return Object({
     'aggregating_function': PredicateSignature(),
-    'fact_table': String()
+    'fact_table': String(),
+    # How values of the measure over finer groups combine into the value
+    # over a coarser group, if they do.
+    'rollup': Enum(['sum', 'count', 'min', 'max'])
   })
 
 def Dimension():
   return Object({
-    'function': PredicateSignature()
+    'function': PredicateSignature(),
+    # Value of the dimension if it is the same for all facts, e.g. Total().
+    'constant': {},
+    # Whether each fact has exactly one value of the dimension, so that
+    # reports can be rolled up over it. Inferred from the program if absent.
+    'single_valued': {'type': 'boolean'}
   })
 
 def Filter():
@@ -93,3 +104,86 @@ def OlapConfig():
     'dimensions': List(Dimension()),
     'filters': List(Filter())
   })
+
+
+olap_config_validator = None
+
+
+def OlapConfigValidator():
+  """Validator of OlapConfig, schema is checked and compiled once."""
+  global olap_config_validator
+  if olap_config_validator is None:
+    olap_config_schema = OlapConfig()
+    validator_class = jsonschema.validators.validator_for(olap_config_schema)
+    validator_class.check_schema(olap_config_schema)
+    olap_config_validator = validator_class(olap_config_schema)
+  return olap_config_validator
+
+
+def ValidateOlapConfig(config):
+  """Raises jsonschema.ValidationError, same as jsonschema.validate."""
+  error = jsonschema.exceptions.best_match(
+      OlapConfigValidator().iter_errors(config))
+  if error is not None:
+    raise error
+
+
+class FrozenDict(dict):
+  """Dictionary that can not be modified."""
+
+  def ReadOnly(self, *args, **kwargs):
+    raise TypeError('%s can not be modified.' % type(self).__name__)
+
+  __setitem__ = ReadOnly
+  __delitem__ = ReadOnly
+  __ior__ = ReadOnly
+  clear = ReadOnly
+  pop = ReadOnly
+  popitem = ReadOnly
+  setdefault = ReadOnly
+  update = ReadOnly
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+
+def Freeze(value):
+  if isinstance(value, dict):
+    return FrozenDict((k, Freeze(v)) for k, v in value.items())
+  if isinstance(value, (list, tuple)):
+    return tuple(Freeze(v) for v in value)
+  return value
+
+
+class ValidatedConfig(FrozenDict):
+  """OlapConfig that passed validation, Olap does not validate it again.
+
+  Config is deep-copied and frozen, so it stays valid however the dictionary
+  it was built from is changed later.
+  """
+
+  def __new__(cls, config):
+    if isinstance(config, ValidatedConfig):
+      return config
+    return super().__new__(cls)
+
+  def __init__(self, config):
+    if isinstance(config, ValidatedConfig):
+      return
+    ValidateOlapConfig(config)
+    dict.__init__(self, Freeze(config))
+
+  def __reduce__(self):
+    return (ValidatedConfig, (Thaw(self),))
+
+
+def Thaw(value):
+  """Plain mutable copy of a frozen value."""
+  if isinstance(value, dict):
+    return {k: Thaw(v) for k, v in value.items()}
+  if isinstance(value, tuple):
+    return [Thaw(v) for v in value]
+  return value
@@ -16,16 +16,30 @@
 
 
 import cgi
+from concurrent import futures
+import contextlib
+import copy
+import gzip
+import hashlib
 import json
 from http import server
 import socketserver
+import threading
 import traceback
 import time
 import os
 import tempfile
 from urllib import parse
 import ai
+import caching
+import columnar
+import connection_pool
+import fusion
+import materialize
 import olap
+import preaggregation
+import rollup
+import schema
 from logica.tools import run_in_terminal
 from logica.parser_py import parse as parse_logica
 from logica.compiler import rule_translate
@@ -35,13 +49,70 @@ from logica.common import sqlite3_logica
 from logica.common import color
 import io
 
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import duckdb_execution
+except ImportError:
+  duckdb_execution = None
+
 
 class LogicLMServerHeart:
   def __init__(self, config):
     self.request_counter = 0
     self.nous = ai.AI.Get()
-    self.prompt_template = ai.GetPromptTemplate(config)
-    self.config = config
+    # Validated once here, so that Olap of every request does not revalidate.
+    self.config = schema.ValidatedConfig(config)
+    self.olap_model = olap.CompiledOlapModel(self.config)
+    self.prompt_template = ai.GetCompiledPromptTemplate(self.config)
+    self.plan_cache = caching.PlanCache(config.get('plan_cache_size', 256))
+    # Results of engines without database fingerprint, which would not see
+    # changes of the data, are cached only if result_cache_ttl_seconds is set.
+    self.result_cache_ttl_seconds = config.get('result_cache_ttl_seconds')
+    self.result_cache = caching.ResultCache(
+        ttl_seconds=config.get('result_cache_ttl_seconds', 300),
+        max_bytes=config.get('result_cache_max_bytes', 64 * 1024 * 1024))
+    # In 'in_process' mode SQLite reports run the already compiled SQL on a
+    # pooled connection and DuckDB reports on a long-lived database, in
+    # 'logica' mode the program is run by Logica.
+    self.execution_mode = config.get('execution_mode', 'in_process')
+    # Streamed reports longer than stream_buffer_rows hold their connection
+    # while the client reads them, so others wait for connections only for
+    # connection_timeout_seconds.
+    self.connection_pool = connection_pool.ConnectionPool(
+        acquire_timeout_seconds=config.get('connection_timeout_seconds', 30))
+    self.aggregate_cache = rollup.AggregateCache(
+        ttl_seconds=config.get('result_cache_ttl_seconds', 300))
+    self.materializer = None
+    if config.get('materialized_fact_tables'):
+      self.materializer = materialize.Materializer(
+          self.config, self.olap_model, config.get('snapshot_database'),
+          config.get('snapshot_refresh_seconds', 3600),
+          config.get('snapshot_max_tables', 64),
+          on_evict=self.plan_cache.Clear)
+      self.materializer.Start()
+    self.preaggregates = None
+    if config.get('preaggregation_budget_rows'):
+      # Plans routed to summary tables of a previous refresh are recompiled.
+      self.preaggregates = preaggregation.Preaggregates(
+          self.config, self.olap_model, config.get('preaggregation_database'),
+          config['preaggregation_budget_rows'],
+          config.get('preaggregation_refresh_seconds', 600),
+          on_refresh=self.plan_cache.Clear)
+      self.preaggregates.Start()
+    # Printing whole result tables to stdout is for debugging only.
+    self.print_results = config.get('print_results', False)
+    self.stream_max_rows = config.get('stream_max_rows', 1000000)
+    self.stream_max_bytes = config.get('stream_max_bytes', 256 * 1024 * 1024)
+    self.stream_buffer_rows = config.get('stream_buffer_rows', 10000)
+    self.batch_workers = config.get('batch_workers', 4)
+    self.fuse_requests = config.get('fuse_requests', True)
+    # Maps asset name to (file fingerprint, StaticAsset).
+    self.static_assets = {}
+    self.static_assets_lock = threading.Lock()
     color.CHR_ERROR = '<span style="color:red;">'
     color.CHR_END = '</span>'
     color.CHR_WARNING = '<span style="font-weight: bold">'
@@ -97,6 +168,26 @@ class LogicLMServerHeart:
     with open(self.StaticFilename('logiclm.png'), 'rb') as logo_file:
       return logo_file.read()
 
+  def Asset(self, name):
+    """Rendered index.html or logiclm.png, rebuilt when the file changes.
+
+    Config of the heart is immutable, so assets depend only on the file.
+    """
+    fingerprint = caching.FileFingerprint(self.StaticFilename(name))
+    with self.static_assets_lock:
+      known_fingerprint, asset = self.static_assets.get(name, (None, None))
+    if known_fingerprint == fingerprint:
+      return asset
+    if name == 'index.html':
+      asset = StaticAsset(self.Html().encode('utf8'), 'text/html', 'no-cache')
+    elif name == 'logiclm.png':
+      asset = StaticAsset(self.LogoPng(), 'image/png', 'public, max-age=3600')
+    else:
+      assert False, name
+    with self.static_assets_lock:
+      self.static_assets[name] = (fingerprint, asset)
+    return asset
+
   # TODO: Refactor this.
   def LegacyIntelligenceConfig(self):
     intelligence_config = {}
@@ -119,8 +210,8 @@ class LogicLMServerHeart:
     return intelligence_config
 
   def NaturalLanguageToRequestJson(self, user_request):
-    json_request_str = self.nous(self.prompt_template.replace('__USER_REQUEST__',
-                                                              user_request))
+    self.nous.CheckPromptSize(self.prompt_template, user_request)
+    json_request_str = self.nous(self.prompt_template.Render(user_request))
     print('AI response:', json_request_str)
     json_request = json.loads(json_request_str)
     json_request['exampleQuery'] = user_request
@@ -128,70 +219,452 @@ class LogicLMServerHeart:
     json_request['intelligence_config'] = self.LegacyIntelligenceConfig()
     return json_request
   
-  def RunJson(self, json_request):
-    if len(json_request['measures']) == 0:
-      # TODO: We should add NumRecords by default or
-      # allow requests without measures.
-      json_request['measures'] = ['NumRecords()']
-    if len(json_request['dimensions']) == 0:
-      json_request['dimensions'] = ['Total()']
-    if len(json_request['dimensions']) < 1 or len(json_request['measures']) < 1:
-      json_request['nice_error'] = '<i>Please specify at least one measure and at least one dimension.</i>'
-      return 'Fail(true)', "select 'fail'", []
-
-    o = olap.Olap(self.config, json_request)
-    charting_call = o.AsPredicateCall(json_request['chartType'])
-    json_request['chart_type_predicate_call'] = {
-      'predicate_name': charting_call.predicate_name,
-      'arguments': {k: v.AsJson() for k, v in charting_call.named_args.items()}
-    }
+  def CompilePlan(self, o, json_request):
+    """Builds Logica program and SQL for the request, None on failure."""
     try:
-      logic_program = str(o.GetFullLogicProgram())
+      incremental_program = o.GetLogicProgram()
+      logic_program = o.GetFullLogicProgram(incremental_program)
     except parse_logica.ParsingException as e:
       print('Failure of parsing:')
       e.ShowMessage()
       s = io.StringIO()
       e.ShowMessage(stream=s)
       json_request['nice_error'] = s.getvalue()
-      return 'Fail(true)', "select 'fail'", [] 
+      return None
 
     print('Logic program:')
     print(logic_program)
 
     try:
-      sql = o.GetSQL()
+      sql = o.CompileSQL(incremental_program)
     except parse_logica.ParsingException as e:
       print('Failure of parsing when building SQL:')
       e.ShowMessage()
       s = io.StringIO()
       e.ShowMessage(stream=s)
       json_request['nice_error'] = s.getvalue()
-      return 'Fail(true)', "select 'fail'", []
+      return None
     except rule_translate.RuleCompileException as e:
       print('Failure of compilation when building SQL:')
       e.ShowMessage()
       s = io.StringIO()
       e.ShowMessage(stream=s)
       json_request['nice_error'] = s.getvalue()
-      return 'Fail(true)', "select 'fail'", []
+      return None
     except infer.TypeErrorCaughtException as e:
       print('Failure of typing when building SQL:')
       e.ShowMessage()
       s = io.StringIO()
       e.ShowMessage(stream=s)
       json_request['nice_error'] = s.getvalue()
+      return None
+    return logic_program, sql, o.engine
+
+  def CachesResults(self, engine):
+    if self.result_cache_ttl_seconds is None:
+      return caching.HasDatabaseFingerprint(engine)
+    return self.result_cache_ttl_seconds > 0
+
+  def AnnotateChartType(self, json_request):
+    charting_call = olap.ParsePredicateCall(json_request['chartType']).Term()
+    json_request['chart_type_predicate_call'] = {
+      'predicate_name': charting_call.predicate_name,
+      'arguments': {k: v.AsJson() for k, v in charting_call.named_args.items()}
+    }
+
+  def PrepareJson(self, json_request):
+    """Olap of the request with defaults filled in, None on failure."""
+    if len(json_request['measures']) == 0:
+      # TODO: We should add NumRecords by default or
+      # allow requests without measures.
+      json_request['measures'] = ['NumRecords()']
+    if len(json_request['dimensions']) == 0:
+      json_request['dimensions'] = ['Total()']
+    if len(json_request['dimensions']) < 1 or len(json_request['measures']) < 1:
+      json_request['nice_error'] = '<i>Please specify at least one measure and at least one dimension.</i>'
+      return None
+
+    o = olap.Olap(self.config, json_request, self.olap_model,
+                  self.materializer, self.preaggregates)
+    if self.preaggregates:
+      self.preaggregates.Log(o)
+    self.AnnotateChartType(json_request)
+    return o
+
+  def PlanJson(self, json_request):
+    """Logica program, SQL and engine of the request, None on failure."""
+    o = self.PrepareJson(json_request)
+    if o is None:
+      return None
+    return self.PlanOlap(o, json_request)
+
+  def PlanOlap(self, o, json_request):
+    request_key = olap.CanonicalRequest(json_request)
+    plan = self.plan_cache.Get(self.config, request_key)
+    if plan is None:
+      plan = self.CompilePlan(o, json_request)
+      if plan is None:
+        return None
+      self.plan_cache.Put(self.config, request_key, plan)
+    return plan
+
+  def RunJson(self, json_request):
+    o = self.PrepareJson(json_request)
+    if o is None:
       return 'Fail(true)', "select 'fail'", []
+    rolled_up = self.aggregate_cache.Get(o)
+    if rolled_up is not None:
+      print('Answered from cached report of finer granularity.')
+      return rolled_up
+    plan = self.PlanOlap(o, json_request)
+    if plan is None:
+      return 'Fail(true)', "select 'fail'", []
+    logic_program, sql, engine = plan
 
-    with  tempfile.TemporaryDirectory('LogicLM') as temp_dir:
-      temp_file = '%s/report.l' % temp_dir
-      with open(temp_file, 'w') as w:
-        w.write(logic_program)
-      header, rows = run_in_terminal.Run(temp_file, 'Report', output_format='header_rows')
-    data = [header] + rows
-    print('Data:', data)
-    print(sqlite3_logica.ArtisticTable(header, rows))
+    caches_results = self.CachesResults(engine)
+    data = self.result_cache.Get(sql) if caches_results else None
+    if data is None:
+      header, rows = self.Execute(logic_program, sql, engine)
+      data = [header] + rows
+      if caches_results:
+        self.result_cache.Put(sql, data)
+    header, rows = data[0], data[1:]
+    if self.print_results:
+      print('Data:', data)
+      print(sqlite3_logica.ArtisticTable(header, rows))
+    else:
+      print('Data: %d rows.' % len(rows))
+    if caches_results:
+      self.aggregate_cache.Put(o, logic_program, sql, data)
     return logic_program, sql, data
 
+  def StreamJson(self, json_request):
+    """Like RunJson, but returns header and an iterator over rows.
+
+    In-process SQLite rows are read from the cursor as they are consumed.
+    Header is None if the request failed.
+    """
+    plan = self.PlanJson(json_request)
+    if plan is None:
+      return 'Fail(true)', "select 'fail'", None, iter([])
+    logic_program, sql, engine = plan
+
+    data = self.result_cache.Get(sql) if self.CachesResults(engine) else None
+    if data is not None:
+      return logic_program, sql, data[0], iter(data[1:])
+    if self.execution_mode == 'in_process' and engine == 'sqlite':
+      rows = IterateSqlInProcess(sql, self.connection_pool,
+                                 self.stream_buffer_rows)
+      header = next(rows)
+      return logic_program, sql, header, rows
+    header, rows = self.Execute(logic_program, sql, engine)
+    return logic_program, sql, header, iter(rows)
+
+  def ExecuteConfig(self, json_request):
+    """Response to /execute_config, errors are reported in nice_error."""
+    try:
+      logic_program, sql, data = self.RunJson(json_request)
+      response = json_request | {
+        'data': data,
+        'sql': sql,
+        'logical_program': logic_program,
+      }
+    except KeyError as e:
+      response = json_request | {
+        'nice_error': 'Silly LLM produced an unknown entity: ' + str(e)
+      }
+      print(traceback.format_exc())
+    except Exception as e:
+      response = json_request | {
+        'nice_error': 'Ouch, I have got an error:' + str(e)
+      }
+      print(traceback.format_exc())
+    return response
+
+  def ExecuteBatch(self, json_requests, submit=None):
+    """Responses to /execute_config of each request, e.g. dashboard tiles.
+
+    Identical requests are executed once, and unless fuse_requests is
+    disabled in the config, requests differing only in measures are computed
+    by one fused report, see fusion.py. Responses of fused requests carry SQL
+    and Logica program of the fused report. Reports are compiled and run by
+    submit, which takes a function with its arguments and returns a future,
+    e.g. to run them on the SQL executor of the asyncio server. By default
+    they run on batch_workers threads. SQLite reports each take a connection
+    from the pool.
+    """
+    unique_requests = {}
+    for json_request in json_requests:
+      unique_requests.setdefault(BatchKey(json_request), json_request)
+    unique_keys = list(unique_requests)
+    unique_list = [unique_requests[key] for key in unique_keys]
+    if self.fuse_requests:
+      groups = fusion.FuseRequests(self.config, self.olap_model, unique_list)
+    else:
+      groups = [(None, [i]) for i in range(len(unique_list))]
+    with contextlib.ExitStack() as stack:
+      if submit is None:
+        num_workers = max(1, min(self.batch_workers, len(groups)))
+        submit = stack.enter_context(
+            futures.ThreadPoolExecutor(num_workers)).submit
+      group_futures = [
+          submit(self.ExecuteGroup, report,
+                 [unique_list[i] for i in indices])
+          for report, indices in groups]
+      # Reports of the other groups finish even if one of them fails.
+      futures.wait(group_futures)
+    responses = {}
+    for (unused_report, indices), future in zip(groups, group_futures):
+      for i, response in zip(indices, future.result()):
+        responses[unique_keys[i]] = response
+    return [responses[BatchKey(json_request)] for json_request in json_requests]
+
+  def ExecuteGroup(self, report, json_requests):
+    """Responses to requests of the fused report, or to each if it is None."""
+    group_responses = None
+    if report is not None:
+      group_responses = self.ExecuteFused(report)
+    if group_responses is None:
+      group_responses = [self.ExecuteConfig(copy.deepcopy(r))
+                         for r in json_requests]
+    return group_responses
+
+  def ExecuteFused(self, report):
+    """Responses to requests of fusion.FusedReport, None on failure.
+
+    Each response has its own data, and SQL of the fused report it was
+    computed by.
+    """
+    fused_response = self.ExecuteConfig(copy.deepcopy(report.request))
+    if 'nice_error' in fused_response or not fused_response.get('data'):
+      return None
+    responses = []
+    for json_request in report.requests:
+      json_request = copy.deepcopy(json_request)
+      try:
+        self.AnnotateChartType(json_request)
+      except Exception:
+        return None
+      responses.append(json_request | {
+        'data': report.Split(fused_response['data'], json_request),
+        'sql': fused_response['sql'],
+        'logical_program': fused_response['logical_program'],
+      })
+    return responses
+
+  def ExecuteConfigStreamed(self, json_request, stream_format):
+    """Pieces of streamed response to /execute_config."""
+    try:
+      logic_program, sql, header, rows = self.StreamJson(json_request)
+    except Exception as e:
+      if isinstance(e, KeyError):
+        error = 'Silly LLM produced an unknown entity: ' + str(e)
+      else:
+        error = 'Ouch, I have got an error:' + str(e)
+      print(traceback.format_exc())
+      logic_program, sql, header, rows = None, None, None, iter([])
+      json_request = json_request | {'nice_error': error}
+    response = json_request | {
+      'sql': sql,
+      'logical_program': logic_program,
+    }
+    return StreamedResponse(response, header, rows, stream_format,
+                            self.stream_max_rows, self.stream_max_bytes)
+
+  def Execute(self, logic_program, sql, engine):
+    """Header and rows of the report."""
+    if self.execution_mode == 'in_process' and engine == 'sqlite':
+      return RunSqlInProcess(sql, self.connection_pool)
+    if (self.execution_mode == 'in_process' and engine == 'duckdb' and
+        duckdb_execution):
+      return duckdb_execution.GetDatabase(
+          self.config['logica_program']).RunSqlScript(sql)
+    return RunLogicProgram(logic_program)
+
+  def CacheStats(self):
+    return {'plans': self.plan_cache.Stats(),
+            'results': self.result_cache.Stats(),
+            'aggregates': self.aggregate_cache.Stats(),
+            'snapshots': (self.materializer.Stats()
+                          if self.materializer else None),
+            'preaggregates': (self.preaggregates.Stats()
+                              if self.preaggregates else None)}
+
+
+class StaticAsset:
+  """Static response body with precompressed variants and strong ETags."""
+
+  def __init__(self, body, content_type, cache_control):
+    self.content_type = content_type
+    self.cache_control = cache_control
+    self.etag = hashlib.sha256(body).hexdigest()[:32]
+    self.bodies = {'identity': body}
+    compressed = {'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+      compressed['br'] = brotli.compress(body)
+    for encoding, compressed_body in compressed.items():
+      # Already compressed formats, e.g. PNG, are served as is.
+      if len(compressed_body) < len(body):
+        self.bodies[encoding] = compressed_body
+
+  def Encoding(self, accept_encoding):
+    """Best available encoding allowed by Accept-Encoding header."""
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+      encoding, *parameters = item.strip().split(';')
+      if any(p.strip() in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+             for p in parameters):
+        continue
+      accepted.add(encoding.strip().lower())
+    for encoding in ['br', 'gzip']:
+      if encoding in self.bodies and (encoding in accepted or '*' in accepted):
+        return encoding
+    return 'identity'
+
+  def ETag(self, encoding):
+    # Representations in different encodings must have different strong tags.
+    if encoding == 'identity':
+      return '"%s"' % self.etag
+    return '"%s-%s"' % (self.etag, encoding)
+
+  def Response(self, request_headers):
+    """Status, headers and body of response to a GET request."""
+    encoding = self.Encoding(request_headers.get('Accept-Encoding'))
+    etag = self.ETag(encoding)
+    headers = {'Content-Type': self.content_type,
+               'ETag': etag,
+               'Cache-Control': self.cache_control,
+               'Vary': 'Accept-Encoding'}
+    if_none_match = request_headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or etag in [
+        t.strip() for t in if_none_match.split(',')]:
+      return 304, headers, b''
+    if encoding != 'identity':
+      headers['Content-Encoding'] = encoding
+    return 200, headers, self.bodies[encoding]
+
+
+def BatchKey(json_request):
+  return json.dumps(json_request, sort_keys=True)
+
+
+def RunLogicProgram(logic_program):
+  """Runs the program with Logica, compiling it again."""
+  with  tempfile.TemporaryDirectory('LogicLM') as temp_dir:
+    temp_file = '%s/report.l' % temp_dir
+    with open(temp_file, 'w') as w:
+      w.write(logic_program)
+    return run_in_terminal.Run(temp_file, 'Report', output_format='header_rows')
+
+
+def RunSqlInProcess(sql, pool):
+  """Runs SQL compiled from the program on a pooled SQLite connection."""
+  with pool.Connection() as connection:
+    return connection_pool.RunSqlScript(connection, sql)
+
+
+def IterateSqlInProcess(sql, pool, buffer_rows=10000, batch_size=1000):
+  """Yields header and then rows of SQL run on a pooled connection.
+
+  Up to buffer_rows rows are read before the header is yielded. If that is
+  all of them, the connection is released right away, otherwise it is held
+  until the rest of rows is read or the iterator is closed.
+  """
+  connection = pool.Acquire()
+  try:
+    cursor = connection_pool.ExecuteSqlScript(connection, sql)
+    header = [d[0] for d in cursor.description]
+    rows = cursor.fetchmany(buffer_rows + 1)
+  except Exception:
+    pool.Discard(connection)
+    raise
+  if len(rows) <= buffer_rows:
+    cursor.close()
+    pool.Release(connection)
+    yield header
+    yield from rows
+    return
+  failed = False
+  try:
+    yield header
+    yield from rows
+    while batch := cursor.fetchmany(batch_size):
+      yield from batch
+  except Exception:
+    failed = True
+    pool.Discard(connection)
+    raise
+  finally:
+    if not failed:
+      cursor.close()
+      pool.Release(connection)
+
+
+def StreamedResponse(response, header, rows, stream_format,
+                     max_rows, max_bytes):
+  """Yields pieces of the response body, rows are written as they are read.
+
+  In 'json' format the body is the same object as a non-streamed response,
+  with 'data' written row by row. In 'ndjson' format the first line is the
+  response with 'header', followed by a line per row. Both end with the
+  number of rows sent and whether rows beyond max_rows or max_bytes were
+  dropped.
+  """
+  if stream_format == 'ndjson':
+    yield json.dumps(response | {'header': header}) + '\n'
+  else:
+    yield json.dumps(response)[:-1] + ', "data": ['
+    if header is not None:
+      yield json.dumps(header)
+  num_rows = 0
+  num_bytes = 0
+  truncated = False
+  error = None
+  try:
+    for row in rows:
+      if stream_format == 'ndjson':
+        piece = json.dumps(row) + '\n'
+      else:
+        piece = ', ' + json.dumps(row)
+      if num_rows >= max_rows or num_bytes + len(piece) > max_bytes:
+        truncated = True
+        break
+      num_rows += 1
+      num_bytes += len(piece)
+      yield piece
+  except Exception as e:
+    error = 'Ouch, I have got an error:' + str(e)
+    print(traceback.format_exc())
+  finally:
+    if hasattr(rows, 'close'):
+      rows.close()
+  summary = {'num_rows': num_rows, 'truncated': truncated}
+  if error:
+    summary['nice_error'] = error
+  if stream_format == 'ndjson':
+    yield json.dumps(summary) + '\n'
+  else:
+    yield '], ' + json.dumps(summary)[1:]
+
+
+STREAM_CONTENT_TYPES = {
+  'json': 'application/json',
+  'ndjson': 'application/x-ndjson'
+}
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def StreamFormat(url, headers):
+  """Format of streamed response if requested, None otherwise."""
+  stream_format = parse.parse_qs(url.query).get('stream', [None])[0]
+  if stream_format is None and 'application/x-ndjson' in headers.get(
+      'Accept', ''):
+    stream_format = 'ndjson'
+  if stream_format not in STREAM_CONTENT_TYPES:
+    return None
+  return stream_format
+
 
 def MakeSimpleLogicLMServer(config):
   heart = LogicLMServerHeart(config)
@@ -216,46 +689,103 @@ def MakeSimpleLogicLMServer(config):
         json_request = json.loads(
           self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
         print('JSON request:', json_request)
+        stream_format = StreamFormat(url, self.headers)
+        if stream_format:
+          self.SendChunked(
+              self.heart.ExecuteConfigStreamed(json_request, stream_format),
+              STREAM_CONTENT_TYPES[stream_format])
+          return
+        result_format = columnar.ResultFormat(parse.parse_qs(url.query),
+                                              self.headers)
+        if result_format is None:
+          self.send_response(406)
+          self.send_header('Content-type', 'text/plain')
+          self.end_headers()
+          self.wfile.write(b'Unknown result format, or pyarrow is missing.')
+          return
+        response = self.heart.ExecuteConfig(json_request)
+        content_type, body = columnar.EncodeResponse(response, result_format)
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.end_headers()
+        self.wfile.write(body)
+      if url.path == '/execute_batch':
         try:
-          logic_program, sql, data = self.heart.RunJson(json_request)
-          response = json_request | {
-            'data': data,
-            'sql': sql,
-            'logical_program': logic_program,
-          }
-        except KeyError as e:
-          response = json_request | {
-            'nice_error': 'Silly LLM produced an unknown entity: ' + str(e)
-          }
-          print(traceback.format_exc())
-        except Exception as e:
-          response = json_request | {
-            'nice_error': 'Ouch, I have got an error:' + str(e)
-          }
-          print(traceback.format_exc())
+          json_requests = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        except ValueError:
+          json_requests = None
+        if not (isinstance(json_requests, list) and
+                all(isinstance(r, dict) for r in json_requests)):
+          self.send_response(400)
+          self.send_header('Content-type', 'text/plain')
+          self.end_headers()
+          self.wfile.write(b'Batch must be a JSON list of requests.')
+          return
+        print('Batch of %d requests.' % len(json_requests))
+        responses = self.heart.ExecuteBatch(json_requests)
         self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-type', 'application/json')
         self.end_headers()
-        self.wfile.write(bytes(json.dumps(response), 'utf8'))
+        self.wfile.write(bytes(json.dumps({'results': responses}), 'utf8'))
+
+    def SendChunked(self, pieces, content_type):
+      """Sends pieces with chunked transfer encoding."""
+      # Chunked encoding requires HTTP/1.1, connection is closed after the
+      # response as other responses do not declare their length.
+      self.protocol_version = 'HTTP/1.1'
+      self.send_response(200)
+      self.send_header('Content-type', content_type)
+      self.send_header('Transfer-Encoding', 'chunked')
+      self.send_header('Connection', 'close')
+      self.end_headers()
+      buffer = []
+      buffered_bytes = 0
+      try:
+        for piece in pieces:
+          buffer.append(piece.encode('utf8'))
+          buffered_bytes += len(buffer[-1])
+          if buffered_bytes >= STREAM_CHUNK_BYTES:
+            self.WriteChunk(b''.join(buffer))
+            buffer = []
+            buffered_bytes = 0
+        if buffer:
+          self.WriteChunk(b''.join(buffer))
+        self.wfile.write(b'0\r\n\r\n')
+      finally:
+        pieces.close()
+
+    def WriteChunk(self, data):
+      self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def SendAsset(self, asset):
+      status, headers, body = asset.Response(self.headers)
+      self.send_response(status)
+      for name, value in headers.items():
+        self.send_header(name, value)
+      if status == 200:
+        self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
 
     def do_GET(self) -> None:
       url = parse.urlparse(self.path)
-      supported_paths = ['/index.html', '/logiclm.png']
+      supported_paths = ['/index.html', '/logiclm.png', '/cache_stats']
       if url.path not in supported_paths:
         path = '/index.html'
       else:
         path = url.path
       if path == '/index.html':
+        self.SendAsset(self.heart.Asset('index.html'))
+        return
+      if path == '/cache_stats':
         self.send_response(200)
-        self.send_header('Content-type', 'text/html')
+        self.send_header('Content-type', 'application/json')
         self.end_headers()
-        self.wfile.write(bytes(self.heart.Html(), 'utf8'))
+        self.wfile.write(bytes(json.dumps(self.heart.CacheStats()), 'utf8'))
         return
       if path == '/logiclm.png':
-        self.send_response(200)
-        self.send_header('Content-type', 'image/png')
-        self.end_headers()
-        self.wfile.write(self.heart.LogoPng())
+        self.SendAsset(self.heart.Asset('logiclm.png'))
         return
 
       self.send_response(200)
@@ -274,6 +804,10 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn,
 
 
 def StartServer(config):
+  if config.get('server_mode', 'threaded') == 'async':
+    import async_server
+    async_server.StartServer(config)
+    return
   simple_server = MakeSimpleLogicLMServer(config)
   port = config.get('port', 1791)
   server_instance = ThreadedTCPServer(('localhost', port), simple_server)
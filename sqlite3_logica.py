@@ -1,12 +1,12 @@
 """Provides connection to SQLite extended with UDFs needed by Logica."""
 
+import bisect
 import csv
 import hashlib
 import io
 import math
 import sys
 import sqlite3
-import heapq
 import json
 import re
 
@@ -30,32 +30,99 @@ def LoadJson(s):
     print('Failed to parse JSON object: %s' % s, file=sys.stderr)
     raise e
 
-class ArgMin:
-  """ArgMin user defined aggregate function."""
+class ArgBest:
+  """Base of ArgMin and ArgMax user defined aggregate functions.
+
+  The first row picks the step. With limit 1 only the best row is kept.
+  With a larger limit the best rows so far are kept sorted, and a row is
+  inserted only if its value beats the value of the worst of them, which
+  is then dropped. Without a limit all rows are sorted in the end. Rows
+  are compared as (value, arg), so ties are resolved as by a heap of such
+  tuples. Types of values are not probed per row, comparison of
+  incompatible values raises TypeError, which is reported as incompatible
+  values.
+  """
+  name = None
+  reverse = False
+
   def __init__(self):
-      self.result = []
+    self.result = []
+    self.limit = None
+    self.step = self.FirstStep
 
-  def step(self, arg, value, limit):
+  def FirstStep(self, arg, value, limit):
     if limit is not None and limit <= 0:
-      raise Exception('ArgMin\'s limit must be positive.')
-    if len(self.result) > 0:
-      if DeFactoType(value) != DeFactoType(self.result[0][0]):
-        raise Exception('ArgMin got incompatible values: %s vs %s' %
-                        (repr(value), repr(self.result[0][0])))
-    if limit is None or len(self.result) < limit - 1:
-      self.result.append((value, arg))
-    elif len(self.result) == limit - 1:
-      self.result.append((value, arg))
-      heapq._heapify_max(self.result)
-    elif len(self.result) == limit:
-      if self.result[0][0] > value:
-        heapq._heapreplace_max(self.result, (value, arg))
+      raise Exception('%s\'s limit must be positive.' % self.name)
+    self.first_value = value
+    self.limit = limit
+    if limit == 1:
+      self.best_value = value
+      self.best_arg = arg
+      self.step = self.StepBest
     else:
-      print("ArgMin error:", self.result, arg, value, limit)
-      raise Exception('ArgMin error')
+      self.result.append((value, arg))
+      self.step = self.StepAll if limit is None else self.StepFill
+
+  def StepAll(self, arg, value, limit):
+    self.result.append((value, arg))
+
+  def StepFill(self, arg, value, limit):
+    self.result.append((value, arg))
+    if len(self.result) == self.limit:
+      self.StartBounded()
+
+  def StartBounded(self):
+    self.Sort()
+    self.threshold = self.Worst()[0]
+    self.step = self.StepBounded
+
+  def Sort(self):
+    try:
+      self.result.sort()
+    except TypeError as e:
+      raise self.Incompatible([v for v, _ in self.result]) or e
+
+  def Incompatible(self, values):
+    first_type = DeFactoType(self.first_value)
+    for value in values:
+      if DeFactoType(value) != first_type:
+        return Exception('%s got incompatible values: %s vs %s' %
+                         (self.name, repr(value), repr(self.first_value)))
+    return None
 
   def finalize(self):
-    return json.dumps([x[1] for x in sorted(self.result)])
+    if self.limit == 1:
+      return json.dumps([self.best_arg])
+    self.Sort()
+    args = [x[1] for x in self.result]
+    if self.reverse:
+      args.reverse()
+    return json.dumps(args)
+
+
+class ArgMin(ArgBest):
+  """ArgMin user defined aggregate function."""
+  name = 'ArgMin'
+
+  def Worst(self):
+    return self.result[-1]
+
+  def StepBest(self, arg, value, limit):
+    try:
+      if value < self.best_value:
+        self.best_value = value
+        self.best_arg = arg
+    except TypeError as e:
+      raise self.Incompatible([value]) or e
+
+  def StepBounded(self, arg, value, limit):
+    try:
+      if value < self.threshold:
+        bisect.insort(self.result, (value, arg))
+        self.result.pop()
+        self.threshold = self.result[-1][0]
+    except TypeError as e:
+      raise self.Incompatible([value]) or e
 
 
 class TakeFirst:
@@ -70,32 +137,30 @@ class TakeFirst:
     return self.result
 
 
-class ArgMax:
+class ArgMax(ArgBest):
   """ArgMax user defined aggregate function."""
-  def __init__(self):
-      self.result = []
-
-  def step(self, arg, value, limit):
-    if limit is not None and limit <= 0:
-      raise Exception('ArgMax\'s limit must be positive.')
-    if len(self.result) > 0:
-      if DeFactoType(value) != DeFactoType(self.result[0][0]):
-        raise Exception('ArgMax got incompatible values: %s vs %s' %
-                        (repr(value), repr(self.result[0][0])))
-    if limit is None or len(self.result) < limit - 1:
-      self.result.append((value, arg))
-    elif len(self.result) == limit - 1:
-      self.result.append((value, arg))
-      heapq.heapify(self.result)
-    elif len(self.result) == limit:
-      if self.result[0][0] < value:
-        heapq.heapreplace(self.result, (value, arg))
-    else:
-      print('ArgMax error:', self.result, arg, value, limit)
-      raise Exception('ArgMax error')
-
-  def finalize(self):
-      return json.dumps([x[1] for x in reversed(sorted(self.result))])
+  name = 'ArgMax'
+  reverse = True
+
+  def Worst(self):
+    return self.result[0]
+
+  def StepBest(self, arg, value, limit):
+    try:
+      if value > self.best_value:
+        self.best_value = value
+        self.best_arg = arg
+    except TypeError as e:
+      raise self.Incompatible([value]) or e
+
+  def StepBounded(self, arg, value, limit):
+    try:
+      if value > self.threshold:
+        bisect.insort(self.result, (value, arg))
+        del self.result[0]
+        self.threshold = self.result[0][0]
+    except TypeError as e:
+      raise self.Incompatible([value]) or e
 
 
 class DistinctListAgg:
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+#
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests of ArgMin and ArgMax against the heap based ones of Logica."""
+
+import itertools
+import random
+import unittest
+
+import sqlite3_logica
+from logica.common import sqlite3_logica as logica_sqlite3_logica
+
+
+def Aggregate(aggregate_class, rows, limit):
+  """Result of the aggregate over (arg, value) rows, as SQLite computes it."""
+  aggregate = aggregate_class()
+  for arg, value in rows:
+    aggregate.step(arg, value, limit)
+  return aggregate.finalize()
+
+
+class ArgBestTest(unittest.TestCase):
+
+  def assertAgreesWithLogica(self, rows, limit):
+    for name in ['ArgMin', 'ArgMax']:
+      self.assertEqual(
+          Aggregate(getattr(sqlite3_logica, name), rows, limit),
+          Aggregate(getattr(logica_sqlite3_logica, name), rows, limit),
+          '%s limit %s over %s' % (name, limit, rows))
+
+  def testFirstRowWinsTiesAtLimitOne(self):
+    rows = [(0, 'b'), (1, 'c'), (2, 'a'), (3, 'c'), (4, 'a')]
+    self.assertEqual(Aggregate(sqlite3_logica.ArgMax, rows, 1), '[1]')
+    self.assertEqual(Aggregate(sqlite3_logica.ArgMin, rows, 1), '[2]')
+    self.assertAgreesWithLogica(rows, 1)
+
+  def testRejectsRowsTyingWithWorstAtLimit(self):
+    rows = [(0, 'c'), (1, 'c'), (2, 'c'), (3, 'b'), (4, 'c'), (5, 'd')]
+    # Rows 2 and 4 tie with the worst of the best two and are rejected, then
+    # row 5 evicts the smaller of the tied (value, arg) pairs.
+    self.assertEqual(Aggregate(sqlite3_logica.ArgMax, rows, 2), '[5, 1]')
+    self.assertAgreesWithLogica(rows, 2)
+
+  def testAgreesWithLogicaOnTies(self):
+    rng = random.Random(0)
+    for limit, num_rows in itertools.product([1, 2, 3, 5, None],
+                                             [1, 2, 5, 20]):
+      for unused_case in range(20):
+        rows = [(rng.randrange(4), rng.randrange(3)) for _ in range(num_rows)]
+        self.assertAgreesWithLogica(rows, limit)
+
+  def testSortsAllRowsWithoutLimit(self):
+    rows = [(0, 2.5), (1, -1), (2, 7), (3, 2.5)]
+    self.assertEqual(Aggregate(sqlite3_logica.ArgMin, rows, None),
+                     '[1, 0, 3, 2]')
+    self.assertEqual(Aggregate(sqlite3_logica.ArgMax, rows, None),
+                     '[2, 3, 0, 1]')
+    self.assertAgreesWithLogica(rows, None)
+
+  def testReportsIncompatibleValues(self):
+    rows = [(0, 1), (1, 2), (2, 'a'), (3, 0)]
+    for name, limit in itertools.product(['ArgMin', 'ArgMax'], [1, 2, None]):
+      with self.assertRaisesRegex(Exception,
+                                  '%s got incompatible values' % name):
+        Aggregate(getattr(sqlite3_logica, name), rows, limit)
+      with self.assertRaisesRegex(Exception,
+                                  '%s got incompatible values' % name):
+        Aggregate(getattr(logica_sqlite3_logica, name), rows, limit)
+
+  def testRejectsNonPositiveLimit(self):
+    with self.assertRaisesRegex(Exception, 'limit must be positive'):
+      Aggregate(sqlite3_logica.ArgMax, [(0, 1)], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()